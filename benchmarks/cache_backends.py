@@ -0,0 +1,130 @@
+"""
+Compares seeding writes and tile reads of the file cache with the MBTiles
+cache, both as configured by MapProxy and with the batched WAL writes used by
+djmp seed workers.
+
+    $ python benchmarks/cache_backends.py --meta-tiles 200 > cache_backends.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'djmp.settings')
+
+import django
+django.setup()
+
+from PIL import Image
+from mapproxy.cache.file import FileCache
+from mapproxy.cache.mbtiles import MBTilesCache
+from mapproxy.cache.tile import Tile
+from mapproxy.image import ImageSource
+
+from djmp.mbtiles import BatchedMBTilesCache, prepare_mbtiles
+
+META_SIZE = 4
+
+
+def encoded_tiles(count):
+    tiles = []
+    for i in range(count):
+        img = Image.new('RGBA', (256, 256), (i * 20 % 256, 120, 200, 255))
+        noise = Image.frombytes('L', (256, 256), os.urandom(256 * 256))
+        img.putalpha(noise.point(lambda v: 255 if v > 8 else 0))
+        buf = BytesIO()
+        img.save(buf, 'png')
+        tiles.append(buf.getvalue())
+    return tiles
+
+
+def meta_tiles(num_meta_tiles, level=14):
+    for i in range(num_meta_tiles):
+        x0 = (i % 64) * META_SIZE
+        y0 = (i // 64) * META_SIZE
+        yield [(x0 + dx, y0 + dy, level) for dy in range(META_SIZE) for dx in range(META_SIZE)]
+
+
+def disk_usage(path):
+    files = 0
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            files += 1
+            size += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+    return files, size
+
+
+def run(name, cache, workdir, bodies, num_meta_tiles, num_reads):
+    coords = []
+    start = time.time()
+    for i, meta in enumerate(meta_tiles(num_meta_tiles)):
+        tiles = [Tile(c, source=ImageSource(BytesIO(bodies[(i + j) % len(bodies)])))
+                 for j, c in enumerate(meta)]
+        cache.store_tiles(tiles)
+        # the seed workers call cleanup after each meta tile
+        if hasattr(cache, 'cleanup'):
+            cache.cleanup()
+        coords.extend(meta)
+    if hasattr(cache, 'flush'):
+        cache.flush()
+    write_seconds = time.time() - start
+
+    sample = random.sample(coords, min(num_reads, len(coords)))
+    start = time.time()
+    for coord in sample:
+        tile = Tile(coord)
+        cache.load_tile(tile)
+        tile.source.as_buffer().read()
+    read_seconds = time.time() - start
+
+    files, size = disk_usage(workdir)
+    return {
+        'cache': name,
+        'tiles': len(coords),
+        'write_seconds': round(write_seconds, 4),
+        'write_tiles_per_second': round(len(coords) / write_seconds, 1),
+        'read_seconds': round(read_seconds, 4),
+        'read_tiles_per_second': round(len(sample) / read_seconds, 1),
+        'files': files,
+        'disk_bytes': size,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--meta-tiles', type=int, default=200)
+    parser.add_argument('--reads', type=int, default=1000)
+    args = parser.parse_args()
+
+    bodies = encoded_tiles(16)
+    base = tempfile.mkdtemp(prefix='djmp-bench-')
+    results = []
+    try:
+        for name in ('file', 'mbtiles', 'mbtiles-wal-batched'):
+            workdir = os.path.join(base, name)
+            os.makedirs(workdir)
+            if name == 'file':
+                cache = FileCache(workdir, 'png', directory_layout='tms')
+            elif name == 'mbtiles':
+                cache = MBTilesCache(os.path.join(workdir, 'bench.mbtiles'))
+            else:
+                filename = os.path.join(workdir, 'bench.mbtiles')
+                prepare_mbtiles(filename)
+                cache = BatchedMBTilesCache(filename, batch_size=512, flush_interval=5)
+            results.append(run(name, cache, workdir, bodies, args.meta_tiles, args.reads))
+    finally:
+        shutil.rmtree(base)
+
+    json.dump({'benchmark': 'cache_backends', 'results': results}, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Compares two benchmark result files and exits with status 1 if a
+measurement got slower than the threshold.
+
+    $ python benchmarks/compare.py before.json after.json --threshold 0.2
+"""
+import argparse
+import json
+import sys
+
+
+def load_results(filename):
+    with open(filename) as f:
+        data = json.load(f)
+    results = data['results']
+    if isinstance(results, list):
+        # cache_backends.py reports a list of runs per cache type
+        return dict((r['cache'], r) for r in results)
+    return results
+
+
+def compare(before, after, metric, threshold):
+    rows = []
+    for name in sorted(set(before) & set(after)):
+        old = before[name].get(metric)
+        new = after[name].get(metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / float(old)
+        rows.append((name, old, new, change, change > threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--metric', default='median_ms')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown reported as regression (default 0.1 = 10%%)')
+    args = parser.parse_args()
+
+    rows = compare(load_results(args.before), load_results(args.after), args.metric, args.threshold)
+    width = max([len(r[0]) for r in rows] + [4])
+    for name, old, new, change, regressed in rows:
+        sys.stdout.write('{}  {:>12}  {:>12}  {:>+8.1%}{}\n'.format(
+            name.ljust(width), old, new, change, '  REGRESSION' if regressed else ''))
+    if any(r[4] for r in rows):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Measures the cold start of a Django process with djmp: django.setup() and
+importing the URLconf in fresh interpreters, and reports the modules that
+should only be imported once a tile is served or a tileset is seeded.
+Exits with status 1 if the median start takes longer than --budget-ms or a
+deferred module was imported.
+
+    $ python benchmarks/import_time.py --budget-ms 1000
+
+With --importtime (Python 3.7+) the slowest imports reported by
+`python -X importtime` are added to the results.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# imported on first use by djmp, see djmp.tests.LazyImportTest
+DEFERRED_MODULES = ['mapproxy', 'pyproj', 'webtest', 'psutil', 'PIL']
+
+CHILD = '''
+import json, os, sys, time
+sys.path.insert(0, {root!r})
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'djmp.settings')
+start = time.time()
+import django
+django.setup()
+setup = time.time()
+import djmp.urls
+urls = time.time()
+json.dump({{
+    'setup_ms': (setup - start) * 1000.0,
+    'urls_ms': (urls - setup) * 1000.0,
+    'deferred_modules': sorted(m for m in {deferred!r} if m in sys.modules),
+}}, sys.stdout)
+'''
+
+
+def run_child(importtime=False):
+    args = [sys.executable]
+    if importtime:
+        args += ['-X', 'importtime']
+    args += ['-c', CHILD.format(root=ROOT, deferred=DEFERRED_MODULES)]
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=ROOT)
+    out, err = process.communicate()
+    if process.returncode:
+        raise RuntimeError(err)
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1]), err.decode('utf-8')
+
+
+def slowest_imports(stderr, count):
+    # "import time: self [us] | cumulative | imported package"
+    imports = []
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            self_us, cumulative_us, name = [part.strip() for part in line[len('import time:'):].split('|')]
+            if cumulative_us.isdigit():
+                imports.append((int(cumulative_us), name))
+    imports.sort(reverse=True)
+    return [{'module': name, 'cumulative_ms': round(us / 1000.0, 3)} for us, name in imports[:count]]
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--budget-ms', type=float, help='fail if the median start takes longer')
+    parser.add_argument('--importtime', action='store_true',
+                        help='add the slowest imports of python -X importtime (Python 3.7+)')
+    args = parser.parse_args()
+
+    runs = [run_child()[0] for i in range(args.repeat)]
+    total_ms = median([run['setup_ms'] + run['urls_ms'] for run in runs])
+    results = {
+        'django_setup_ms': round(median([run['setup_ms'] for run in runs]), 3),
+        'import_urls_ms': round(median([run['urls_ms'] for run in runs]), 3),
+        'start_ms': round(total_ms, 3),
+        'deferred_modules_imported': runs[0]['deferred_modules'],
+    }
+    if args.importtime:
+        if sys.version_info < (3, 7):
+            parser.error('-X importtime needs Python 3.7 or later')
+        results['slowest_imports'] = slowest_imports(run_child(importtime=True)[1], 20)
+
+    json.dump({
+        'benchmark': 'import_time',
+        'environment': {
+            'python': platform.python_version(),
+            'budget_ms': args.budget_ms,
+        },
+        'results': results,
+    }, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+    if results['deferred_modules_imported'] or (args.budget_ms and total_ms > args.budget_ms):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
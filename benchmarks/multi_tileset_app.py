@@ -0,0 +1,147 @@
+"""
+Compares a MapProxy app per tileset with the multi tileset app
+(DJMP_MULTI_TILESET_APP): the memory held by the apps of many tilesets, the
+time to build them and the latency of tile requests through the Django view
+that MapProxy answers from its cache.
+
+    $ python benchmarks/multi_tileset_app.py > multi_tileset_app.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'djmp.settings')
+
+import django
+django.setup()
+
+import mapproxy.version
+import psutil
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+from django.test.utils import setup_test_environment
+
+from djmp.multiapp import MultiTilesetApps, multi_tileset_apps
+from djmp.stubserver import StubUpstream
+from djmp.tilecache import hot_tile_cache
+from djmp.views import get_mapproxy
+
+from serving_path import PASSWORD, create_tileset, timed
+
+
+def rss_mb():
+    gc.collect()
+    return psutil.Process(os.getpid()).memory_info().rss / (1024.0 * 1024.0)
+
+
+def measure_apps(mode, tilesets):
+    """
+    Returns the memory in MB and the seconds it takes to build and keep the
+    apps of `tilesets`.
+    """
+    before = rss_mb()
+    start = time.time()
+    if mode == 'per_tileset':
+        apps = [get_mapproxy(tileset) for tileset in tilesets]
+    else:
+        apps = MultiTilesetApps(1)
+        apps.app(tilesets[0])
+    duration = time.time() - start
+    return {'rss_mb': round(rss_mb() - before, 3), 'build_s': round(duration, 3)}
+
+
+def bench_tile_requests(client, tilesets, repeat):
+    uris = [
+        reverse('tileset_mapproxy', args=(tileset.pk, '/wmts/{}/EPSG3857/6/32/23.png'.format(tileset.name)))
+        for tileset in tilesets
+    ]
+    random.shuffle(uris)
+    uris = (uris * (repeat // len(uris) + 1))[:repeat]
+    for uri in set(uris):
+        # fill the MapProxy caches
+        assert client.get(uri).status_code == 200, uri
+
+    def get(i):
+        # MapProxy answers from its own cache
+        hot_tile_cache.clear()
+        res = client.get(uris[i])
+        assert res.status_code == 200, (uris[i], res.status_code)
+
+    results = {}
+    results['tileset_mapproxy_cache_hit_per_tileset_app'] = timed(get, repeat)
+    multi_tileset_apps.enabled = True
+    try:
+        client.get(uris[0])
+        results['tileset_mapproxy_cache_hit_multi_tileset_app'] = timed(get, repeat)
+    finally:
+        multi_tileset_apps.enabled = False
+    return results
+
+
+def create_tilesets(count, server_url, directory):
+    user = User.objects.create_user('bench', password=PASSWORD)
+    return [create_tileset('bench_{}'.format(i), user, server_url, directory) for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tilesets', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--measure-apps', choices=['per_tileset', 'multi_tileset'],
+                        help='only print the memory and build time of one kind of app')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    setup_test_environment()
+    db_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    upstream = StubUpstream().start()
+    directory = tempfile.mkdtemp(prefix='djmp-bench-')
+    results = {}
+    try:
+        tilesets = create_tilesets(args.tilesets, upstream.url, directory)
+        if args.measure_apps:
+            json.dump(measure_apps(args.measure_apps, tilesets), sys.stdout)
+            return
+
+        client = Client(HTTP_HOST='localhost')
+        client.login(username='bench', password=PASSWORD)
+        results.update(bench_tile_requests(client, tilesets, args.repeat))
+    finally:
+        upstream.stop()
+        shutil.rmtree(directory)
+        connection.creation.destroy_test_db(db_name, verbosity=0)
+
+    # every kind of app is measured in a fresh process
+    for mode in ('per_tileset', 'multi_tileset'):
+        out = subprocess.check_output([
+            sys.executable, __file__, '--tilesets', str(args.tilesets), '--measure-apps', mode])
+        for key, value in json.loads(out).items():
+            results['{}_apps_{}'.format(mode, key)] = value
+
+    json.dump({
+        'benchmark': 'multi_tileset_app',
+        'environment': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'mapproxy': mapproxy.version.version,
+            'tilesets': args.tilesets,
+        },
+        'results': results,
+    }, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Measures EPSG:4326 WMS requests against a local stub WMS for a tileset that
+only caches EPSG:3857 tiles, so MapProxy reprojects them for every request,
+and for a tileset that also caches native EPSG:4326 tiles (cache_grids).
+
+    $ python benchmarks/reprojection.py > reprojection.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'djmp.settings')
+
+import django
+django.setup()
+
+import mapproxy.version
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+from django.test.utils import setup_test_environment
+
+from djmp.helpers import generate_confs
+from djmp.stubserver import StubUpstream
+from djmp.tileranges import tile_ranges
+
+from serving_path import PASSWORD, create_tileset, timed
+
+
+def getmap_uris(tileset, grid, level, count):
+    """
+    GetMap requests for `count` EPSG:4326 tiles of `level`, like a tiled WMS
+    client in EPSG:4326 sends them.
+    """
+    x0, y0, x1, y1 = tile_ranges(tileset, grid)[level]
+    coords = [(x, y, level) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+    random.shuffle(coords)
+    uris = []
+    for coord in coords[:count]:
+        bbox = grid.tile_bbox(coord)
+        uris.append(
+            reverse('tileset_mapproxy', args=(tileset.pk, '/service')) +
+            '?SERVICE=WMS&VERSION=1.1.1&REQUEST=GetMap&STYLES=&FORMAT=image/png&SRS=EPSG:4326'
+            '&WIDTH=256&HEIGHT=256&LAYERS={}&BBOX={}'.format(tileset.name, ','.join(repr(v) for v in bbox))
+        )
+    return uris
+
+
+def bench_getmap(client, tileset, grid, level, count):
+    uris = getmap_uris(tileset, grid, level, count)
+
+    def get(i):
+        res = client.get(uris[i])
+        assert res.status_code == 200 and res['Content-Type'] == 'image/png', (uris[i], res.status_code)
+
+    # the first pass fills the cache, the second one is served from it
+    return {
+        'wms_4326_cold': timed(get, len(uris)),
+        'wms_4326_cached': timed(get, len(uris)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tiles', type=int, default=50)
+    parser.add_argument('--level', type=int, default=10)
+    parser.add_argument('--upstream-latency', type=float, default=0.0,
+                        help='seconds the stub upstream waits before answering')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    setup_test_environment()
+    db_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    upstream = StubUpstream(latency=args.upstream_latency).start()
+    directory = tempfile.mkdtemp(prefix='djmp-bench-')
+    results = {}
+    upstream_requests = {}
+    try:
+        user = User.objects.create_user('bench', password=PASSWORD)
+        client = Client(HTTP_HOST='localhost')
+        client.login(username='bench', password=PASSWORD)
+        for name, cache_grids in (('EPSG3857', 'EPSG3857'), ('EPSG3857_EPSG4326', 'EPSG3857,EPSG4326')):
+            tileset = create_tileset(name, user, upstream.url, directory)
+            tileset.cache_grids = cache_grids
+            tileset.save()
+            mapproxy_cf, seed_cf = generate_confs(tileset)
+            grid = mapproxy_cf.grids['EPSG4326'].tile_grid()
+            random.seed(args.seed)
+            requests = upstream.requests
+            for key, value in bench_getmap(client, tileset, grid, args.level, args.tiles).items():
+                results['{}_{}'.format(key, name)] = value
+            upstream_requests[name] = upstream.requests - requests
+    finally:
+        upstream.stop()
+        shutil.rmtree(directory)
+        connection.creation.destroy_test_db(db_name, verbosity=0)
+
+    json.dump({
+        'benchmark': 'reprojection',
+        'environment': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'mapproxy': mapproxy.version.version,
+            'upstream_latency': args.upstream_latency,
+            'level': args.level,
+        },
+        'results': results,
+        'upstream_requests': upstream_requests,
+    }, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""
+Measures the tile serving path against a local stub WMS: building the
+MapProxy configuration and app, tile requests through the Django view for
+upstream misses, MapProxy cache hits and hot tile cache hits, the status
+endpoint with large seed progress logs and GuardianAuthorization.read_list
+with many tilesets.
+
+    $ python benchmarks/serving_path.py > before.json
+    $ python benchmarks/serving_path.py > after.json
+    $ python benchmarks/compare.py before.json after.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'djmp.settings')
+
+import django
+django.setup()
+
+import mapproxy.version
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.http import HttpRequest
+from django.test.client import Client
+from django.test.utils import setup_test_environment
+from tastypie.bundle import Bundle
+
+from djmp import decorators, guardian_auth
+from djmp.guardian_auth import GuardianAuthorization
+from djmp.helpers import generate_confs, get_lock_filename, get_progress_log_filename, get_status
+from djmp.models import Tileset
+from djmp.stubserver import StubUpstream
+from djmp.tilecache import hot_tile_cache
+from djmp.views import get_mapproxy
+
+PASSWORD = 'bench'
+
+
+def timed(func, repeat):
+    samples = []
+    for i in range(repeat):
+        start = time.time()
+        func(i)
+        samples.append((time.time() - start) * 1000.0)
+    samples.sort()
+    return {
+        'runs': repeat,
+        'min_ms': round(samples[0], 3),
+        'median_ms': round(samples[len(samples) // 2], 3),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+        'mean_ms': round(sum(samples) / len(samples), 3),
+    }
+
+
+def create_tileset(name, user, server_url, directory):
+    tileset = Tileset.objects.create(
+        name=name,
+        created_by=user.username,
+        source_type='wms',
+        server_url=server_url,
+        layer_name='bench',
+        layer_zoom_start=0,
+        layer_zoom_stop=14,
+        bbox_x0=0, bbox_y0=40, bbox_x1=10, bbox_y1=50,
+        cache_type='file',
+        directory_layout='tms',
+        directory=directory,
+    )
+    tileset.add_read_perm(user)
+    return tileset
+
+
+def tile_uris(tileset, level, count):
+    """
+    Tile paths of `count` different meta tiles, so every request is a miss.
+    """
+    mapproxy_cf, seed_cf = generate_confs(tileset)
+    grid = mapproxy_cf.caches['tileset_cache'].caches()[0][0]
+    _, _, coords = grid.get_affected_level_tiles(tileset.bbox_3857(), level)
+    coords = [c for c in coords if c is not None and c[0] % 4 == 0 and c[1] % 4 == 0]
+    random.shuffle(coords)
+    return [
+        reverse('tileset_mapproxy', args=(tileset.pk, '/wmts/{}/EPSG3857/{}/{}/{}.png'.format(
+            tileset.name, z, x, y)))
+        for x, y, z in coords[:count]
+    ]
+
+
+def bench_tile_requests(client, tileset, repeat):
+    uris = tile_uris(tileset, 14, repeat)
+
+    def get(uri, cache_status):
+        res = client.get(uri)
+        assert res.status_code == 200, (uri, res.status_code)
+        assert res['X-Djmp-Cache'] == cache_status, (uri, res['X-Djmp-Cache'])
+
+    def get_from_disk(uri):
+        # drop the hot tile cache so MapProxy answers from its own cache
+        hot_tile_cache.clear()
+        get(uri, 'miss')
+
+    results = {}
+    hot_tile_cache.clear()
+    results['tileset_mapproxy_miss'] = timed(lambda i: get(uris[i], 'miss'), len(uris))
+    results['tileset_mapproxy_cache_hit'] = timed(lambda i: get_from_disk(uris[i]), len(uris))
+    for uri in uris:
+        client.get(uri)
+    results['tileset_mapproxy_hot_hit'] = timed(lambda i: get(uris[i], 'hit'), len(uris))
+    return results
+
+
+def write_progress_log(tileset, lines):
+    # same shape as mapproxy.seed.util.ProgressLog output
+    with open(get_progress_log_filename(tileset), 'w') as f:
+        for i in range(lines):
+            level = 6 + i * 8 // lines
+            f.write('[15:11:11]  {}  {:.2f}% 0.00000, 672645.84891, 18432942.24503, 18831637.78456 '
+                    '(112 tiles) ETA: 2015-07-07-15:11:12\n'.format(level, 100.0 * i / lines))
+            f.write('[15:11:16]  87.50%   0000                 ETA: 2015-07-07-15:11:17\r')
+    with open(get_lock_filename(tileset), 'w') as f:
+        f.write('{}\n'.format(os.getpid()))
+
+
+def bench_status(tileset, log_sizes, repeat):
+    results = {}
+    for lines in log_sizes:
+        write_progress_log(tileset, lines)
+        results['get_status_log_{}_lines'.format(lines)] = timed(lambda i: get_status(tileset), repeat)
+    os.remove(get_lock_filename(tileset))
+    return results
+
+
+def bench_read_list(user, num_tilesets, server_url, directory, repeat):
+    others = User.objects.create_user('other', password=PASSWORD)
+    for i in range(num_tilesets):
+        # the benchmark user can see every other tileset
+        create_tileset('list_{}'.format(i), user if i % 2 else others, server_url, directory)
+
+    request = HttpRequest()
+    request.user = User.objects.get(pk=user.pk)
+    bundle = Bundle(request=request)
+    auth = GuardianAuthorization()
+
+    def read_list(i):
+        # a fresh user object per run, guardian caches permissions on it
+        request.user = User.objects.get(pk=user.pk)
+        auth.read_list(Tileset.objects.all(), bundle)
+
+    return {'guardian_read_list_{}_tilesets'.format(num_tilesets): timed(read_list, repeat)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--tiles', type=int, default=100)
+    parser.add_argument('--upstream-latency', type=float, default=0.0,
+                        help='seconds the stub upstream waits before answering')
+    parser.add_argument('--log-lines', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--tilesets', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    # measure the permission checks as deployed with guardian
+    decorators.ENABLE_GUARDIAN_PERMISSIONS = True
+    guardian_auth.ENABLE_GUARDIAN_PERMISSIONS = True
+
+    setup_test_environment()
+    db_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    upstream = StubUpstream(latency=args.upstream_latency).start()
+    directory = tempfile.mkdtemp(prefix='djmp-bench-')
+    results = {}
+    try:
+        user = User.objects.create_user('bench', password=PASSWORD)
+        tileset = create_tileset('bench', user, upstream.url, directory)
+
+        results['generate_confs'] = timed(lambda i: generate_confs(tileset), args.repeat)
+        results['get_mapproxy'] = timed(lambda i: get_mapproxy(tileset), args.repeat)
+
+        client = Client(HTTP_HOST='localhost')
+        client.login(username='bench', password=PASSWORD)
+        results.update(bench_tile_requests(client, tileset, args.tiles))
+        results.update(bench_status(tileset, args.log_lines, max(1, args.repeat // 5)))
+        results.update(bench_read_list(user, args.tilesets, upstream.url, directory, max(1, args.repeat // 5)))
+    finally:
+        upstream.stop()
+        shutil.rmtree(directory)
+        connection.creation.destroy_test_db(db_name, verbosity=0)
+
+    json.dump({
+        'benchmark': 'serving_path',
+        'environment': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'mapproxy': mapproxy.version.version,
+            'upstream_latency': args.upstream_latency,
+        },
+        'results': results,
+        'upstream_requests': upstream.requests,
+    }, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
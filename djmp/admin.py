@@ -1,20 +1,74 @@
-from django.contrib import admin
+from datetime import timedelta
+
+from django.contrib import admin, messages
 from guardian.admin import GuardedModelAdmin
 
-from .models import Tileset
+from .heatmap import warm_process_spawn
+from .models import SeedJob, SeedLevel, Tileset
+from .seedestimate import estimate_seed, over_budget
+from .settings import DJMP_WARM_LEVELS, DJMP_WARM_TILES
 
 
 def seed_action(modeladmin, request, queryset):
     for tileset in queryset:
-        tileset.seed()
+        res = tileset.seed()
+        if res['status'] != 'started':
+            modeladmin.message_user(request, '{}: {}'.format(tileset.name, res.get('error') or res['status']),
+                                    messages.WARNING)
 
 seed_action.short_description = "Seed selected Tilesets"
 
 
+def warm_action(modeladmin, request, queryset):
+    for tileset in queryset:
+        warm_process_spawn(tileset, DJMP_WARM_TILES, DJMP_WARM_LEVELS, refresh=True)
+        modeladmin.message_user(request, '{}: re-seeding the {} most requested tiles'.format(
+            tileset.name, DJMP_WARM_TILES))
+
+warm_action.short_description = "Re-seed hot areas of selected Tilesets"
+
+
+def estimate_action(modeladmin, request, queryset):
+    for tileset in queryset:
+        estimate = estimate_seed(tileset)
+        error = over_budget(estimate)
+        modeladmin.message_user(request, '{}: {} tiles, {} MB, {} seeding (zoom {}-{}){}'.format(
+            tileset.name, estimate['tiles'], round(estimate['bytes'] / 1048576.0, 1),
+            timedelta(seconds=int(estimate['duration'])), tileset.layer_zoom_start, tileset.layer_zoom_stop,
+            ', ' + error if error else ''), messages.WARNING if error else messages.INFO)
+
+estimate_action.short_description = "Estimate the seed of selected Tilesets"
+
+
+def cleanup_action(modeladmin, request, queryset):
+    for tileset in queryset:
+        tileset.cleanup()
+
+cleanup_action.short_description = "Remove tiles outside the coverage of selected Tilesets"
+
+
 class TilesetAdmin(GuardedModelAdmin):
     readonly_fields = ('size', 'layer_uuid',)
     list_display = ('id', 'name', 'layer_name', 'server_url', 'created_by', 'created_at')
     search_fields = ['name']
-    actions = [seed_action]
+    actions = [seed_action, estimate_action, warm_action, cleanup_action]
 
 admin.site.register(Tileset, TilesetAdmin)
+
+
+class SeedLevelInline(admin.TabularInline):
+    model = SeedLevel
+    extra = 0
+    can_delete = False
+    readonly_fields = ('level', 'tiles', 'skipped', 'bytes', 'duration', 'tiles_per_second',
+                       'upstream_requests', 'upstream_p50_ms', 'upstream_p95_ms')
+
+
+class SeedJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'tileset', 'kind', 'started_at', 'duration', 'tiles', 'bytes', 'tiles_per_second')
+    list_filter = ('tileset', 'kind')
+    readonly_fields = ('tileset', 'kind', 'started_at', 'finished_at', 'workers', 'tiles', 'skipped', 'bytes',
+                       'duration', 'tiles_per_second')
+    inlines = [SeedLevelInline]
+
+admin.site.register(SeedJob, SeedJobAdmin)
@@ -1,10 +1,13 @@
 import importlib
 
 from django.conf import settings
+from tastypie import fields
+from tastypie.authorization import ReadOnlyAuthorization
+from tastypie.bundle import Bundle
 from tastypie.constants import ALL, ALL_WITH_RELATIONS
 from tastypie.resources import ModelResource
 
-from .models import Tileset
+from .models import SeedJob, SeedLevel, Tileset
 
 module_name, class_name = settings.DJMP_AUTHORIZATION_CLASS.rsplit(".", 1)
 auth_class = getattr(importlib.import_module(module_name), class_name)
@@ -19,3 +22,50 @@ class TilesetResource(ModelResource):
         resource_name = 'tilesets'
         authorization = auth_class()
         always_return_data = True
+
+
+class SeedJobAuthorization(ReadOnlyAuthorization):
+    """
+    Seed jobs can be read by everyone allowed to read their tileset.
+    """
+    tileset_authorization = auth_class()
+
+    def read_list(self, object_list, bundle):
+        tilesets = Tileset.objects.filter(pk__in=object_list.values('tileset_id'))
+        readable = self.tileset_authorization.read_list(tilesets, bundle)
+        if readable is True:
+            return object_list
+        return object_list.filter(tileset__in=[tileset.pk for tileset in readable])
+
+    def read_detail(self, object_list, bundle):
+        tileset = bundle.obj.tileset
+        return self.tileset_authorization.read_detail(
+            Tileset.objects.filter(pk=tileset.pk), Bundle(obj=tileset, request=bundle.request))
+
+
+class SeedLevelResource(ModelResource):
+    """Seed Job Level API Resource"""
+
+    class Meta:
+        queryset = SeedLevel.objects.all()
+        resource_name = 'seed_levels'
+        excludes = ['id']
+        include_resource_uri = False
+
+
+class SeedJobResource(ModelResource):
+    """Seed Job API Resource"""
+    tileset = fields.ForeignKey(TilesetResource, 'tileset')
+    levels = fields.ToManyField(SeedLevelResource, 'levels', full=True)
+
+    class Meta:
+        queryset = SeedJob.objects.select_related('tileset').prefetch_related('levels')
+        allowed_methods = ['get']
+        resource_name = 'seed_jobs'
+        authorization = SeedJobAuthorization()
+        filtering = {
+            'tileset': ALL,
+            'kind': ALL,
+            'started_at': ALL,
+        }
+        ordering = ['started_at', 'tiles_per_second']
@@ -0,0 +1,59 @@
+import threading
+from collections import OrderedDict
+
+from .settings import DJMP_TILESET_APP_CACHE_SIZE
+
+
+class TilesetAppCache(object):
+    """
+    Per process LRU of the MapProxy apps of the `size` most recently used
+    tilesets. An app is only returned while the MapProxy configuration of
+    its tileset is unchanged (`fingerprint`).
+    """
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def get(self, tileset_pk, fingerprint):
+        with self._lock:
+            entry = self._entries.pop(tileset_pk, None)
+            if entry is None or entry[0] != fingerprint:
+                self.misses += 1
+                return None
+            # re-insert to mark as most recently used
+            self._entries[tileset_pk] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, tileset_pk, fingerprint, app):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries.pop(tileset_pk, None)
+            self._entries[tileset_pk] = (fingerprint, app)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def __contains__(self, tileset_pk):
+        with self._lock:
+            return tileset_pk in self._entries
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'apps': len(self._entries), 'size': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+tileset_apps = TilesetAppCache(DJMP_TILESET_APP_CACHE_SIZE)
@@ -0,0 +1,131 @@
+import logging
+import multiprocessing
+import os
+import time
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+from .helpers import (
+    close_db_connections, get_lock_file, prepare_seed, remove_lock_file, seed_process_target
+)
+from .metrics import process_metrics
+
+log = logging.getLogger('djmapproxy')
+
+
+def seed_tileset(tileset, zoom_start=None, zoom_stop=None, on_tiles=None):
+    """
+    Seeds a tileset in this process while holding its lock file, with the
+    zoom range overridden by `zoom_start` and `zoom_stop` for this seed only.
+    """
+    result = {'status': 'seeded', 'error': None}
+    lock_file = get_lock_file(tileset)
+    if lock_file is None:
+        result['status'] = 'already started'
+        return result
+    lock_file.write('{}\n'.format(os.getpid()))
+    lock_file.close()
+    try:
+        if zoom_start is not None:
+            tileset.layer_zoom_start = zoom_start
+        if zoom_stop is not None:
+            tileset.layer_zoom_stop = zoom_stop
+        tasks, progress_logger = prepare_seed(tileset, on_tiles)
+        # removes the lock file once the tiles are seeded
+        seed_process_target(tileset, tasks, progress_logger)
+    except Exception as e:
+        log.exception('unable to seed tileset {}'.format(tileset.pk))
+        result['status'] = 'failed'
+        result['error'] = str(e)
+        remove_lock_file(tileset)
+    return result
+
+
+def _seed_target(tileset, zoom_start, zoom_stop, queue):
+    start = time.time()
+    result = seed_tileset(tileset, zoom_start, zoom_stop, lambda count: queue.put(('tiles', tileset.pk, count)))
+    result['duration'] = time.time() - start
+    queue.put(('done', tileset.pk, result))
+
+
+def batch_seed(tilesets, concurrency=2, zoom_start=None, zoom_stop=None, progress=None, interval=5.0):
+    """
+    Seeds `tilesets` in up to `concurrency` processes of their own. Every
+    `interval` seconds and after each tileset `progress(status)` is called
+    with the tilesets seeding, done and total, the tiles seeded and the tiles
+    per second since the last call. Returns the result of every tileset by pk
+    and a summary.
+    """
+    queue = multiprocessing.Queue()
+    pending = list(tilesets)
+    running = {}
+    results = {}
+    tiles = {}
+    start = last_report = time.time()
+    reported_tiles = 0
+
+    def report():
+        now = time.time()
+        total_tiles = sum(tiles.values())
+        status = {
+            'seeding': sorted(tileset.name for tileset, process in running.values()),
+            'done': len(results),
+            'total': len(results) + len(running) + len(pending),
+            'tiles': total_tiles,
+            'tiles_per_second': (total_tiles - reported_tiles) / (now - last_report) if now > last_report else 0.0,
+        }
+        if progress is not None:
+            progress(status)
+        return now, total_tiles
+
+    def set_queued(count):
+        # the metrics view reports the tilesets waiting for a seed process
+        process_metrics.set_gauge('djmp_seed_queued', {}, count)
+        process_metrics.flush()
+
+    # job processes must not share the database connections of this process
+    close_db_connections()
+    set_queued(len(pending))
+    while pending or running:
+        while pending and len(running) < concurrency:
+            tileset = pending.pop(0)
+            process = multiprocessing.Process(target=_seed_target, args=(tileset, zoom_start, zoom_stop, queue))
+            process.start()
+            running[tileset.pk] = (tileset, process)
+            tiles[tileset.pk] = 0
+            set_queued(len(pending))
+
+        try:
+            message, pk, value = queue.get(timeout=min(interval, 1.0))
+        except Empty:
+            for pk, (tileset, process) in list(running.items()):
+                # killed or crashed without a result
+                if process.exitcode not in (None, 0):
+                    results[pk] = {'status': 'failed', 'error': 'exit code {}'.format(process.exitcode),
+                                   'duration': time.time() - start, 'tiles': tiles[pk]}
+                    del running[pk]
+        else:
+            if message == 'tiles':
+                tiles[pk] += value
+            elif pk in running:
+                running.pop(pk)[1].join()
+                results[pk] = dict(value, tiles=tiles[pk])
+                last_report, reported_tiles = report()
+
+        if time.time() - last_report >= interval:
+            last_report, reported_tiles = report()
+
+    duration = time.time() - start
+    summary = {
+        'tilesets': len(results),
+        'seeded': sum(1 for r in results.values() if r['status'] == 'seeded'),
+        'failed': sum(1 for r in results.values() if r['status'] == 'failed'),
+        'skipped': sum(1 for r in results.values() if r['status'] == 'already started'),
+        'tiles': sum(tiles.values()),
+        'duration': duration,
+        'tiles_per_second': sum(tiles.values()) / duration if duration else 0.0,
+    }
+    return results, summary
@@ -0,0 +1,119 @@
+import logging
+import uuid
+
+from .tileranges import in_tile_ranges
+
+log = logging.getLogger('djmapproxy')
+
+# tiles loaded from the cache with one call, mbtiles and gpkg caches read them with one query
+LOAD_CHUNK = 64
+
+
+def parse_tile_list(tiles=(), ranges=()):
+    """
+    Returns the (x, y, z) coordinates of `tiles` ('z/x/y' strings, also comma
+    separated) and `ranges` ('z/x0/y0/x1/y1' strings, bounds included).
+    Raises ValueError for malformed coordinates.
+    """
+    coords = []
+    for value in tiles:
+        for part in value.split(','):
+            if not part:
+                continue
+            z, x, y = _ints(part, 3)
+            coords.append((x, y, z))
+    for value in ranges:
+        z, x0, y0, x1, y1 = _ints(value, 5)
+        if x0 > x1 or y0 > y1:
+            raise ValueError('empty tile range {}'.format(value))
+        coords.append((x0, y0, x1, y1, z))
+    return coords
+
+
+def _ints(value, count):
+    parts = value.split('/')
+    if len(parts) != count or not all(p.isdigit() for p in parts):
+        raise ValueError('invalid tile {}'.format(value))
+    return [int(p) for p in parts]
+
+
+def coverage_order(coords, ranges, limit):
+    """
+    Returns the tiles of `coords` inside the tile `ranges` of the tileset,
+    without duplicates and sorted by level, column and row like the caches
+    store them. Raises ValueError if there are more than `limit`.
+    """
+    tiles = set()
+    for coord in coords:
+        if len(coord) == 3:
+            if in_tile_ranges(ranges, *coord):
+                tiles.add(coord)
+            continue
+        x0, y0, x1, y1, z = coord
+        if z not in ranges:
+            continue
+        rx0, ry0, rx1, ry1 = ranges[z]
+        x0, y0, x1, y1 = max(x0, rx0), max(y0, ry0), min(x1, rx1), min(y1, ry1)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > limit:
+            raise ValueError('more than {} tiles requested'.format(limit))
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                tiles.add((x, y, z))
+    if len(tiles) > limit:
+        raise ValueError('more than {} tiles requested'.format(limit))
+    return sorted(tiles, key=lambda t: (t[2], t[0], t[1]))
+
+
+def tile_manager_of(mapproxy_cf, grid_name='EPSG3857'):
+    for grid, extent, tile_manager in mapproxy_cf.caches['tileset_cache'].caches():
+        if grid.name == grid_name:
+            return grid, tile_manager
+    return None, None
+
+
+def load_tiles(tile_manager, coords, render=False):
+    """
+    Yields the (x, y, z) and encoded image of the cached tiles of `coords` in
+    their order. With `render` the tiles that are not cached are rendered,
+    tiles that cannot be rendered are left out.
+    """
+    from mapproxy.cache.tile import Tile
+    from mapproxy.source import SourceError
+
+    with tile_manager.session():
+        for i in range(0, len(coords), LOAD_CHUNK):
+            chunk = coords[i:i + LOAD_CHUNK]
+            if not render:
+                tiles = [Tile(coord) for coord in chunk]
+                tile_manager.cache.load_tiles(tiles)
+            else:
+                try:
+                    tiles = tile_manager.load_tile_coords(chunk)
+                except SourceError as e:
+                    log.warn('unable to render tiles {}..{}: {}'.format(chunk[0], chunk[-1], e))
+                    continue
+            for tile in tiles:
+                if tile.source is None:
+                    continue
+                buf = tile.source_buffer(image_opts=tile_manager.image_opts, seekable=True)
+                buf.seek(0)
+                yield tile.coord, buf.read()
+
+
+def multipart_tiles(tiles, boundary=None):
+    """
+    Returns the boundary and a generator of the multipart/mixed body with a
+    part per (coord, content type, body) of `tiles`, Content-Location is z/x/y.
+    """
+    boundary = boundary or uuid.uuid4().hex
+
+    def body():
+        for (x, y, z), content_type, data in tiles:
+            yield (
+                '--{}\r\nContent-Type: {}\r\nContent-Location: {}/{}/{}\r\nContent-Length: {}\r\n\r\n'.format(
+                    boundary, content_type, z, x, y, len(data)
+                ).encode('ascii') + data + b'\r\n'
+            )
+        yield '--{}--\r\n'.format(boundary).encode('ascii')
+
+    return boundary, body()
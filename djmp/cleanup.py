@@ -0,0 +1,170 @@
+import errno
+import logging
+import os
+import re
+import shutil
+import sqlite3
+from multiprocessing.pool import ThreadPool
+
+from .tileranges import in_tile_ranges
+
+log = logging.getLogger('djmapproxy')
+
+TILE_NAME_RE = re.compile(r'^(\d+)\.[a-z]+$')
+
+
+def _tile_coord(level, parts):
+    """
+    Returns (x, y, z) of a tile below its level directory for the tms
+    (x/y.ext) and tc (xxx/xxx/xxx/yyy/yyy/yyy.ext) layouts, or None.
+    """
+    match = TILE_NAME_RE.match(parts[-1])
+    if match is None or not all(p.isdigit() for p in parts[:-1]):
+        return None
+    parts = parts[:-1] + [match.group(1)]
+    if len(parts) == 2:
+        return int(parts[0]), int(parts[1]), level
+    if len(parts) == 6:
+        return int(''.join(parts[:3])), int(''.join(parts[3:])), level
+    return None
+
+
+def _reclaimable_bytes(st):
+    # hardlinked tiles only free their blocks with the last link
+    return st.st_size if st.st_nlink <= 1 else 0
+
+
+def _remove_tree(directory):
+    removed = {'tiles': 0, 'bytes': 0}
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            removed['tiles'] += 1
+            removed['bytes'] += _reclaimable_bytes(st)
+    shutil.rmtree(directory, ignore_errors=True)
+    return removed
+
+
+def _clean_directory(args):
+    directory, level, prefix, ranges, remove_before = args
+    removed = {'tiles': 0, 'bytes': 0}
+    for root, dirs, files in os.walk(directory, topdown=False):
+        rel = os.path.relpath(root, directory)
+        rel_parts = prefix + ([] if rel == os.curdir else rel.split(os.sep))
+        for name in files:
+            coord = _tile_coord(level, rel_parts + [name])
+            if coord is None:
+                continue
+            filename = os.path.join(root, name)
+            try:
+                st = os.lstat(filename)
+            except OSError:
+                continue
+            if in_tile_ranges(ranges, *coord) and (remove_before is None or st.st_mtime >= remove_before):
+                continue
+            try:
+                os.remove(filename)
+            except OSError as ex:
+                log.warn('unable to remove {}: {}'.format(filename, ex))
+                continue
+            removed['tiles'] += 1
+            removed['bytes'] += _reclaimable_bytes(st)
+        try:
+            os.rmdir(root)
+        except OSError as ex:
+            if ex.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                raise
+    return removed
+
+
+def cleanup_file_cache(cache_dir, ranges, remove_before=None, concurrency=4):
+    """
+    Removes the tiles of a file cache outside of `ranges` ({level: (x0, y0,
+    x1, y1)}) or last written before the `remove_before` timestamp. Levels
+    are split by their first sub directory and cleaned by `concurrency`
+    threads. Returns the number of removed tiles and the bytes reclaimed.
+    """
+    removed = {'tiles': 0, 'bytes': 0}
+    if not os.path.isdir(cache_dir):
+        return removed
+    jobs = []
+    for level_name in sorted(os.listdir(cache_dir)):
+        level_dir = os.path.join(cache_dir, level_name)
+        # e.g. single_color_tiles, linked tiles are removed with their links
+        if not level_name.isdigit() or not os.path.isdir(level_dir):
+            continue
+        level = int(level_name)
+        if level not in ranges:
+            for key, value in _remove_tree(level_dir).items():
+                removed[key] += value
+            continue
+        for name in sorted(os.listdir(level_dir)):
+            if os.path.isdir(os.path.join(level_dir, name)):
+                jobs.append((os.path.join(level_dir, name), level, [name], ranges, remove_before))
+
+    pool = ThreadPool(concurrency)
+    try:
+        for result in pool.imap_unordered(_clean_directory, jobs):
+            for key, value in result.items():
+                removed[key] += value
+    finally:
+        pool.close()
+        pool.join()
+
+    for level_name in os.listdir(cache_dir):
+        try:
+            os.rmdir(os.path.join(cache_dir, level_name))
+        except OSError:
+            pass
+    return removed
+
+
+def cleanup_mbtiles(filename, ranges):
+    """
+    Deletes the tiles of an MBTiles cache outside of `ranges` and compacts
+    the file. MapProxy stores the rows of the grid, like `ranges` they count
+    from the north.
+    """
+    removed = {'tiles': 0, 'bytes': 0}
+    if not os.path.isfile(filename):
+        return removed
+    db = sqlite3.connect(filename, timeout=30)
+    try:
+        where = ['zoom_level NOT IN ({})'.format(','.join(str(int(level)) for level in ranges) or 'NULL')]
+        for level, (x0, y0, x1, y1) in sorted(ranges.items()):
+            where.append(
+                '(zoom_level = {z} AND (tile_column < {x0} OR tile_column > {x1} OR '
+                'tile_row < {y0} OR tile_row > {y1}))'.format(z=level, x0=x0, x1=x1, y0=y0, y1=y1)
+            )
+        where = ' OR '.join(where)
+        count, size = db.execute('SELECT COUNT(*), SUM(LENGTH(tile_data)) FROM tiles WHERE ' + where).fetchone()
+        if count:
+            db.execute('DELETE FROM tiles WHERE ' + where)
+            db.commit()
+            db.execute('VACUUM')
+        removed['tiles'] = count
+        removed['bytes'] = size or 0
+    finally:
+        db.close()
+    return removed
+
+
+def cleanup_compact_cache(cache_dir, ranges):
+    """
+    Removes the level directories of a compact cache outside the zoom range.
+    Single tiles cannot be removed from bundles without rewriting them.
+    """
+    removed = {'tiles': 0, 'bytes': 0}
+    if not os.path.isdir(cache_dir):
+        return removed
+    for name in sorted(os.listdir(cache_dir)):
+        if re.match(r'^L\d+$', name) and int(name[1:]) not in ranges:
+            level_dir = os.path.join(cache_dir, name)
+            for root, dirs, files in os.walk(level_dir):
+                for filename in files:
+                    removed['bytes'] += os.path.getsize(os.path.join(root, filename))
+            shutil.rmtree(level_dir, ignore_errors=True)
+    return removed
@@ -0,0 +1,97 @@
+import os
+import struct
+
+# Direct reads from MapProxy compact caches (ArcGIS bundles). Each bundle stores
+# 128x128 tiles of one level in L<zz>/R<row>C<col>.bundle (+ .bundlx for v1).
+# See mapproxy.cache.compact for the writing side.
+BUNDLE_GRID_SIZE = 128
+
+BUNDLEX_V1_HEADER_SIZE = 16
+BUNDLE_V2_HEADER_SIZE = 64
+
+INT32LE = struct.Struct('<L')
+INT64LE = struct.Struct('<Q')
+
+
+def bundle_base_filename(cache_dir, x, y, z):
+    c = x // BUNDLE_GRID_SIZE * BUNDLE_GRID_SIZE
+    r = y // BUNDLE_GRID_SIZE * BUNDLE_GRID_SIZE
+    return os.path.join(cache_dir, 'L%02d' % z, 'R%04xC%04x' % (r, c))
+
+
+def _pread(fd, offset, size):
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+def _read_v1(base_filename, x, y):
+    try:
+        fd = os.open(base_filename + '.bundlx', os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        # index is stored column major with 5 byte offsets
+        pos = BUNDLEX_V1_HEADER_SIZE + (x * BUNDLE_GRID_SIZE + y) * 5
+        offset = INT64LE.unpack(_pread(fd, pos, 5) + b'\x00\x00\x00')[0]
+    finally:
+        os.close(fd)
+    if not offset:
+        return None
+
+    try:
+        # removed between the two opens, e.g. by a cleanup
+        fd = os.open(base_filename + '.bundle', os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        size = INT32LE.unpack(_pread(fd, offset, 4))[0]
+        if not size:
+            return None
+        return _pread(fd, offset + 4, size)
+    finally:
+        os.close(fd)
+
+
+def _read_v2(base_filename, x, y):
+    try:
+        fd = os.open(base_filename + '.bundle', os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        # row major index, size in the upper 24 bits, offset in the lower 40
+        pos = BUNDLE_V2_HEADER_SIZE + (y * BUNDLE_GRID_SIZE + x) * 8
+        value = INT64LE.unpack(_pread(fd, pos, 8))[0]
+        size = value >> 40
+        if not size:
+            return None
+        return _pread(fd, value & 0xffffffffff, size)
+    finally:
+        os.close(fd)
+
+
+def read_bundle_tile(cache_dir, version, x, y, z):
+    """
+    Returns the encoded tile at x/y/z of a compact cache or None if it is
+    not cached. Needs a single open() for v2 bundles and two for v1.
+    """
+    base_filename = bundle_base_filename(cache_dir, x, y, z)
+    x = x % BUNDLE_GRID_SIZE
+    y = y % BUNDLE_GRID_SIZE
+    if version == 1:
+        return _read_v1(base_filename, x, y)
+    return _read_v2(base_filename, x, y)
+
+
+def bundle_files(cache_dir):
+    """
+    Yields the paths of all bundle files below a compact cache directory.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    for level_dir in sorted(os.listdir(cache_dir)):
+        level_path = os.path.join(cache_dir, level_dir)
+        if not level_dir.startswith('L') or not os.path.isdir(level_path):
+            continue
+        for name in os.listdir(level_path):
+            if name.endswith('.bundle') or name.endswith('.bundlx'):
+                yield os.path.join(level_path, name)
@@ -5,10 +5,12 @@ from django.shortcuts import get_object_or_404
 
 from .models import Tileset
 from .settings import ENABLE_GUARDIAN_PERMISSIONS
+from .timing import get_timing
 
 def view_tileset_permissions(view_func):
     def _wrapped_view(request, *args, **kwargs):
         tileset_pk = kwargs.get('pk')
+        timing = get_timing(request)
 
         # if permissions aren't enabled just pass through
         if ENABLE_GUARDIAN_PERMISSIONS == False:
@@ -17,8 +19,9 @@ def view_tileset_permissions(view_func):
         if tileset_pk is None:
             raise ValueError('no tileset pk provided')
 
-        tileset = get_object_or_404(Tileset, pk=tileset_pk)
-        allowed = request.user.has_perm('view_tileset', tileset)
+        with timing.stage('auth'):
+            tileset = get_object_or_404(Tileset, pk=tileset_pk)
+            allowed = request.user.has_perm('view_tileset', tileset)
 
         if not allowed:
             response = HttpResponse("forbidden", status=403)
@@ -0,0 +1,111 @@
+import os
+import hashlib
+import logging
+
+log = logging.getLogger('djmapproxy')
+
+# MapProxy keeps the targets of link_single_color_images here (see
+# mapproxy.cache.file.FileCache._single_color_tile_location)
+SINGLE_COLOR_DIR = 'single_color_tiles'
+
+
+def _tile_files(cache_dir):
+    for dirpath, dirnames, filenames in os.walk(cache_dir):
+        # caches with several grids have one below every grid directory
+        if SINGLE_COLOR_DIR in dirnames:
+            dirnames.remove(SINGLE_COLOR_DIR)
+        for name in filenames:
+            yield os.path.join(dirpath, name)
+
+
+def _is_single_color(path):
+    from PIL import Image
+    from mapproxy.image import is_single_color_image
+
+    try:
+        return is_single_color_image(Image.open(path)) is not False
+    except IOError:
+        return False
+
+
+def link_single_color_tiles(cache_dir, max_tile_bytes):
+    """
+    Replaces identical uniform-colour tiles of a file cache with hardlinks to
+    a single copy. Only files up to `max_tile_bytes` are read. Returns the
+    number of tiles that were linked.
+    """
+    by_size = {}
+    for path in _tile_files(cache_dir):
+        st = os.lstat(path)
+        if os.path.islink(path) or st.st_size > max_tile_bytes:
+            continue
+        by_size.setdefault(st.st_size, []).append((path, st))
+
+    linked = 0
+    for size, files in by_size.items():
+        if len(files) < 2:
+            continue
+        by_hash = {}
+        for path, st in files:
+            with open(path, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+            by_hash.setdefault(digest, []).append((path, st))
+
+        for digest, same in by_hash.items():
+            master, master_st = same[0]
+            if len(same) < 2 or not _is_single_color(master):
+                continue
+            for path, st in same[1:]:
+                if (st.st_dev, st.st_ino) == (master_st.st_dev, master_st.st_ino):
+                    continue
+                # link next to the tile and rename, readers never see a missing tile
+                tmp_path = path + '.dedup'
+                try:
+                    os.link(master, tmp_path)
+                    os.rename(tmp_path, path)
+                    linked += 1
+                except OSError as ex:
+                    log.warn('unable to link {} to {}: {}'.format(path, master, ex))
+                    if os.path.exists(tmp_path):
+                        os.unlink(tmp_path)
+    return linked
+
+
+def dedup_stats(cache_dir):
+    """
+    Counts the tiles of a file cache that share their data with other tiles,
+    either as hardlinks or as MapProxy single colour symlinks, and the bytes and
+    inodes this saves compared to one file per tile. Symlinks need an inode
+    each, so only hardlinks save inodes.
+    """
+    groups = {}
+    symlinks = 0
+    for path in _tile_files(cache_dir):
+        st = os.lstat(path)
+        if os.path.islink(path):
+            try:
+                target = os.stat(path)
+            except OSError:
+                continue
+            symlinks += 1
+        elif st.st_nlink > 1:
+            target = st
+        else:
+            continue
+        group = groups.setdefault((target.st_dev, target.st_ino), [0, target.st_blocks * 512, False])
+        group[0] += 1
+        group[2] = group[2] or os.path.islink(path)
+
+    bytes_saved = 0
+    inodes_saved = 0
+    for tiles, size, via_symlink in groups.values():
+        bytes_saved += (tiles - 1) * size
+        # symlinks replace one inode with another and add the shared target
+        inodes_saved += -1 if via_symlink else tiles - 1
+    return {
+        'linked_tiles': sum(g[0] for g in groups.values()),
+        'unique_tiles': len(groups),
+        'symlinks': symlinks,
+        'bytes_saved': bytes_saved,
+        'inodes_saved': inodes_saved,
+    }
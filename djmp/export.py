@@ -0,0 +1,204 @@
+import logging
+import os
+import sqlite3
+import time
+from multiprocessing.pool import ThreadPool
+
+from .batchtiles import tile_manager_of
+from .settings import DJMP_EXPORT_BATCH_SIZE
+from .tileindex import index_stored_tiles, tile_index_writer
+from .tileranges import level_tile_range, tile_ranges
+
+log = logging.getLogger('djmapproxy')
+
+EXPORT_FORMATS = ('mbtiles', 'gpkg')
+
+
+def parse_bbox(value):
+    """
+    Returns the [x0, y0, x1, y1] of a comma separated EPSG:4326 bbox, or
+    raises ValueError.
+    """
+    bbox = [float(v) for v in value.split(',')]
+    if len(bbox) != 4 or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+        raise ValueError('invalid bbox {}'.format(value))
+    return bbox
+
+
+def export_ranges(tileset, grid, bbox=None, zoom_start=None, zoom_stop=None):
+    """
+    Returns the tile ranges of an EPSG:4326 `bbox` and zoom range inside the
+    bbox and zoom range of the tileset as {level: (x0, y0, x1, y1)}.
+    """
+    from mapproxy.srs import SRS
+
+    ranges = tile_ranges(tileset, grid)
+    if zoom_start is not None or zoom_stop is not None:
+        ranges = dict(
+            (level, tile_range) for level, tile_range in ranges.items()
+            if (zoom_start is None or level >= zoom_start) and (zoom_stop is None or level <= zoom_stop)
+        )
+    if bbox is not None:
+        grid_bbox = SRS(4326).transform_bbox_to(grid.srs, bbox)
+        for level, (x0, y0, x1, y1) in list(ranges.items()):
+            bx0, by0, bx1, by1 = level_tile_range(grid, grid_bbox, level)
+            x0, y0, x1, y1 = max(x0, bx0), max(y0, by0), min(x1, bx1), min(y1, by1)
+            if x0 > x1 or y0 > y1:
+                del ranges[level]
+            else:
+                ranges[level] = (x0, y0, x1, y1)
+    return ranges
+
+
+def count_tiles(ranges):
+    return sum((x1 - x0 + 1) * (y1 - y0 + 1) for x0, y0, x1, y1 in ranges.values())
+
+
+def tile_chunks(ranges, size):
+    """
+    Yields lists of at most `size` (x, y, z) coordinates of `ranges` ordered
+    by level, column and row.
+    """
+    chunk = []
+    for level in sorted(ranges):
+        x0, y0, x1, y1 = ranges[level]
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                chunk.append((x, y, level))
+                if len(chunk) >= size:
+                    yield chunk
+                    chunk = []
+    if chunk:
+        yield chunk
+
+
+class ExportWriter(object):
+    """
+    Writes encoded tiles to a new MBTiles or GeoPackage file with one
+    executemany/commit per `batch_size` tiles. MBTiles rows count from the
+    south, GeoPackage rows like the grid from the north.
+    """
+    def __init__(self, filename, export_format, grid, name, batch_size):
+        self.filename = filename
+        self.export_format = export_format
+        self.batch_size = batch_size
+        self.tiles = 0
+        self._pending = []
+        if export_format == 'gpkg':
+            from mapproxy.cache.geopackage import GeopackageCache
+            self.table_name = GeopackageCache(filename, grid, name).table_name
+        else:
+            from mapproxy.cache.mbtiles import MBTilesCache
+            MBTilesCache(filename)
+            self.table_name = 'tiles'
+        self.db = sqlite3.connect(filename)
+
+    def add(self, coord, data):
+        x, y, z = coord
+        if self.export_format == 'mbtiles':
+            y = 2 ** z - 1 - y
+        self._pending.append((z, x, y, sqlite3.Binary(data)))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        self.db.executemany(
+            'INSERT OR REPLACE INTO [{}] (zoom_level, tile_column, tile_row, tile_data) VALUES (?,?,?,?)'.format(
+                self.table_name),
+            self._pending
+        )
+        self.db.commit()
+        self.tiles += len(self._pending)
+        self._pending = []
+
+    def set_metadata(self, metadata):
+        if self.export_format == 'mbtiles':
+            self.db.executemany('INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)', sorted(metadata.items()))
+            self.db.commit()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+def _render_chunk(args):
+    tile_manager, chunk = args
+    from mapproxy.source import SourceError
+
+    try:
+        with tile_manager.session():
+            tile_manager.load_tile_coords(chunk)
+    except SourceError as e:
+        log.warn('unable to render tiles {}..{}: {}'.format(chunk[0], chunk[-1], e))
+        return 0
+    return len(chunk)
+
+
+def render_missing(tile_manager, ranges, concurrency, chunk_size=16):
+    """
+    Renders the tiles of `ranges` that are not cached in `concurrency`
+    threads.
+    """
+    pool = ThreadPool(concurrency)
+    try:
+        chunks = ((tile_manager, chunk) for chunk in tile_chunks(ranges, chunk_size))
+        return sum(pool.imap_unordered(_render_chunk, chunks))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def export_tiles(tileset, filename, export_format='mbtiles', bbox=None, zoom_start=None, zoom_stop=None,
+                 render=False, concurrency=2, mapproxy_cf=None):
+    """
+    Copies the cached tiles of an EPSG:4326 `bbox` and zoom range of a
+    tileset to a new MBTiles or GeoPackage file, reading and writing
+    `DJMP_EXPORT_BATCH_SIZE` tiles at a time. With `render` the missing
+    tiles are rendered first. Returns the number of exported tiles and
+    the seconds it took.
+    """
+    from mapproxy.cache.tile import TileCollection
+    from .helpers import generate_confs
+
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError('unknown export format {}'.format(export_format))
+    start = time.time()
+    if mapproxy_cf is None:
+        mapproxy_cf, seed_cf = generate_confs(tileset)
+    grid, tile_manager = tile_manager_of(mapproxy_cf)
+    ranges = export_ranges(tileset, grid, bbox, zoom_start, zoom_stop)
+    if render:
+        render_missing(index_stored_tiles(tileset, tile_manager), ranges, concurrency)
+        tile_index_writer.flush()
+
+    if os.path.exists(filename):
+        os.remove(filename)
+    writer = ExportWriter(filename, export_format, grid, tileset.name, DJMP_EXPORT_BATCH_SIZE)
+    try:
+        with tile_manager.session():
+            for chunk in tile_chunks(ranges, DJMP_EXPORT_BATCH_SIZE):
+                tiles = TileCollection(chunk)
+                tile_manager.cache.load_tiles(tiles)
+                for tile in tiles:
+                    if tile.source is None:
+                        continue
+                    buf = tile.source_buffer(image_opts=tile_manager.image_opts, seekable=True)
+                    buf.seek(0)
+                    writer.add(tile.coord, buf.read())
+        writer.flush()
+        if ranges:
+            export_bbox = bbox or tileset.bbox()
+            writer.set_metadata({
+                'name': tileset.name,
+                'type': 'baselayer',
+                'version': '1.1',
+                'format': 'jpg' if tileset.image_format == 'jpeg' else 'png',
+                'bounds': ','.join(repr(float(v)) for v in export_bbox),
+                'minzoom': str(min(ranges)),
+                'maxzoom': str(max(ranges)),
+            })
+    finally:
+        writer.close()
+    return {'tiles': writer.tiles, 'duration': time.time() - start}
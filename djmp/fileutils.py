@@ -0,0 +1,27 @@
+import errno
+import json
+import os
+
+
+def makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+
+
+def write_json(filename, data):
+    # readers in other processes never see a partly written file
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp_filename, filename)
+
+
+def read_json(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
@@ -0,0 +1,193 @@
+import atexit
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+
+from .fileutils import makedirs
+from .helpers import close_db_connections, generate_confs, get_tileset_base_folder, touch_seed_stamp
+from .settings import DJMP_HEAT_MAP, DJMP_HEAT_MAP_FLUSH_INTERVAL
+
+log = logging.getLogger('djmapproxy')
+
+
+def get_heat_map_filename(tileset):
+    return '{}/{}.heat'.format(get_tileset_base_folder(tileset), tileset.name)
+
+
+def internal_tile_coord(tile):
+    """
+    Returns the (x, y, z) coordinate MapProxy stores a parsed tile request
+    under, or None for grids the heat map does not track.
+    """
+    service, grid, z, x, y, ext = tile
+    if grid != 'EPSG3857':
+        return None
+    if service == 'tms':
+        # global-mercator profile, see tilecache.TILE_PATH_RE
+        z += 1
+        y = 2 ** z - 1 - y
+    return x, y, z
+
+
+def _connect(filename):
+    db = sqlite3.connect(filename, timeout=30)
+    db.execute(
+        'CREATE TABLE IF NOT EXISTS hits ('
+        'z INTEGER, x INTEGER, y INTEGER, count INTEGER, PRIMARY KEY (z, x, y))'
+    )
+    return db
+
+
+class TileHits(object):
+    """
+    Counts the tile requests of this process and adds them to the heat map
+    file of each tileset at most every `flush_interval` seconds.
+    """
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._pending = {}
+        self._last_flush = time.time()
+
+    def record(self, filename, coord):
+        x, y, z = coord
+        with self._lock:
+            if os.getpid() != self._pid:
+                # hits counted before the fork are flushed by the parent
+                self._pid = os.getpid()
+                self._pending = {}
+            hits = self._pending.setdefault(filename, {})
+            hits[(z, x, y)] = hits.get((z, x, y), 0) + 1
+        if self._last_flush + self.flush_interval < time.time():
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+        for filename, hits in pending.items():
+            try:
+                makedirs(os.path.dirname(filename))
+                db = _connect(filename)
+                try:
+                    db.executemany('INSERT OR IGNORE INTO hits VALUES (?, ?, ?, 0)', hits.keys())
+                    db.executemany(
+                        'UPDATE hits SET count = count + ? WHERE z = ? AND x = ? AND y = ?',
+                        [(count,) + key for key, count in hits.items()]
+                    )
+                    db.commit()
+                finally:
+                    db.close()
+            except (sqlite3.Error, OSError) as ex:
+                log.warn('unable to write {} tile hits to {}: {}'.format(len(hits), filename, ex))
+
+
+tile_hits = TileHits(DJMP_HEAT_MAP_FLUSH_INTERVAL)
+atexit.register(tile_hits.flush)
+
+
+def record_tile_hit(tileset, tile, response):
+    if not DJMP_HEAT_MAP or tile is None or response.status_code != 200 \
+            or response.get('X-Djmp-Cache') == 'out-of-bounds':
+        return
+    coord = internal_tile_coord(tile)
+    if coord is not None:
+        tile_hits.record(get_heat_map_filename(tileset), coord)
+
+
+def hot_tiles(tileset, limit):
+    """
+    Returns the `limit` most requested tiles as (x, y, z, count), most
+    requested first.
+    """
+    filename = get_heat_map_filename(tileset)
+    if not os.path.isfile(filename):
+        return []
+    db = _connect(filename)
+    try:
+        rows = db.execute('SELECT x, y, z, count FROM hits ORDER BY count DESC LIMIT ?', (limit,))
+        return [tuple(row) for row in rows]
+    finally:
+        db.close()
+
+
+def clear_heat_map(tileset):
+    try:
+        os.remove(get_heat_map_filename(tileset))
+    except OSError:
+        pass
+
+
+def warm_tiles(tileset, hot, levels):
+    """
+    Returns the hot tiles and their children down to `levels` zoom levels
+    below them, within the zoom range of the tileset.
+    """
+    coords = set()
+    for x, y, z, count in hot:
+        for level in range(max(z, tileset.layer_zoom_start), min(z + levels, tileset.layer_zoom_stop) + 1):
+            scale = 2 ** (level - z)
+            for child_x in range(x * scale, (x + 1) * scale):
+                for child_y in range(y * scale, (y + 1) * scale):
+                    coords.add((child_x, child_y, level))
+    return coords
+
+
+def warm_tileset(tileset, limit, levels, refresh=False):
+    """
+    Seeds the `limit` most requested tiles of the tileset and the tiles
+    `levels` zoom levels below them. With `refresh` they are rendered again
+    even if they are cached, e.g. after the source data changed.
+    """
+    from .tileindex import index_stored_tiles, tile_index_writer
+
+    mapproxy_cf, seed_cf = generate_confs(tileset)
+    grid, extent, tile_manager = mapproxy_cf.caches['tileset_cache'].caches()[0]
+    index_stored_tiles(tileset, tile_manager)
+    hot = hot_tiles(tileset, limit)
+    coords = warm_tiles(tileset, hot, levels)
+    meta_grid = tile_manager.meta_grid
+    if meta_grid:
+        # one request per meta tile
+        seed_coords = set(meta_grid.main_tile(coord) for coord in coords)
+    else:
+        seed_coords = coords
+
+    rendered = 0
+    with tile_manager.session():
+        if refresh:
+            # MapProxy only renders a meta tile if its main tile is missing
+            if meta_grid:
+                remove_coords = [t for c in seed_coords for t in meta_grid.tile_list(c) if t is not None]
+            else:
+                remove_coords = list(coords)
+            tile_manager.remove_tile_coords(remove_coords)
+            if remove_coords:
+                # tile caches of all worker processes drop the removed tiles
+                touch_seed_stamp(tileset)
+        for coord in sorted(seed_coords, key=lambda c: (c[2], c[0], c[1])):
+            if not tile_manager.is_cached(coord):
+                tile_manager.load_tile_coords([coord])
+                rendered += 1
+    tile_index_writer.flush()
+    return {'hot_tiles': len(hot), 'tiles': len(coords), 'rendered_meta_tiles': rendered}
+
+
+def warm_process_spawn(tileset, limit, levels, refresh=False):
+    """
+    Warms the tileset in another process, like seeding does. Returns its pid.
+    """
+    close_db_connections()
+    process = multiprocessing.Process(target=warm_process_target, args=(tileset, limit, levels, refresh))
+    process.start()
+    return process.pid
+
+
+def warm_process_target(tileset, limit, levels, refresh):
+    res = warm_tileset(tileset, limit, levels, refresh)
+    log.debug('warmed tileset {}: {} meta tiles rendered around {} hot tiles'.format(
+        tileset.id, res['rendered_meta_tiles'], res['hot_tiles']))
@@ -1,24 +1,30 @@
-import yaml
+import json
 import os
 import errno
+import itertools
 import time
 import multiprocessing
-import psutil
 import logging
 from datetime import datetime
-from dateutil import parser
+from io import BytesIO
 
+from django.db import connections
+from django.utils import timezone
 from django.utils.text import slugify
-from mapproxy.seed.seeder import seed
-from mapproxy.seed.config import SeedingConfiguration, SeedConfigurationError, ConfigurationError
-from mapproxy.seed.spec import validate_seed_conf
-from mapproxy.config.loader import ProxyConfiguration
-from mapproxy.config.spec import validate_options
-from mapproxy.config.config import load_default_config, load_config
-from mapproxy.seed import seeder
-from mapproxy.seed import util
 
-from .mapproxy_config import get_mapproxy_conf, get_seed_conf, u_to_str
+from .cleanup import cleanup_compact_cache, cleanup_file_cache, cleanup_mbtiles
+from .compact import bundle_files
+from .dedup import dedup_stats, link_single_color_tiles
+from .mapproxy_config import (
+    cache_grids, get_mapproxy_conf, get_seed_conf, get_compact_directory, get_file_cache_directory,
+    get_grid_cache_directory, get_mbtiles_filename, u_to_str
+)
+from .metrics import process_metrics
+from .seedstats import SeedStats, percentile, record_seed_stats
+from .settings import DJMP_CLEANUP_CONCURRENCY, DJMP_SEED_STATS_MAX_SAMPLES, DJMP_TILE_DEDUP_MAX_TILE_BYTES
+from .tilecache import hot_tile_cache, shared_tile_cache
+from .tileranges import tile_ranges
+from .timing import latency_histograms
 
 
 log = logging.getLogger('djmapproxy')
@@ -28,24 +34,18 @@ def generate_confs(tileset, ignore_warnings=True, renderd=False):
     """
     Takes a Tileset object and returns mapproxy and seed config files
     """
-    # Start with a sane configuration using MapProxy's defaults
-    mapproxy_config = load_default_config()
+    import yaml
+    from mapproxy.seed.config import SeedingConfiguration, SeedConfigurationError
+    from mapproxy.seed.spec import validate_seed_conf
 
     tileset_conf_json = get_mapproxy_conf(tileset)
     tileset_conf = yaml.safe_load(tileset_conf_json)
 
-    # merge our config
-    load_config(mapproxy_config, config_dict=tileset_conf)
+    mapproxy_cf = load_proxy_configuration(tileset_conf, ignore_warnings, renderd)
 
     seed_conf_json = get_seed_conf(tileset)
     seed_conf = yaml.safe_load(seed_conf_json)
 
-    errors, informal_only = validate_options(mapproxy_config)
-    if not informal_only or (errors and not ignore_warnings):
-        raise ConfigurationError('invalid configuration - {}'.format(', '.join(errors)))
-
-    mapproxy_cf = ProxyConfiguration(mapproxy_config, seed=seed, renderd=renderd)
-
     errors, informal_only = validate_seed_conf(seed_conf)
     if not informal_only:
         raise SeedConfigurationError('invalid seed configuration - {}'.format(', '.join(errors)))
@@ -54,6 +54,29 @@ def generate_confs(tileset, ignore_warnings=True, renderd=False):
     return mapproxy_cf, seed_cf
 
 
+def load_proxy_configuration(conf, ignore_warnings=True, renderd=False):
+    """
+    Merges a MapProxy configuration dict into MapProxy's defaults and returns
+    the validated ProxyConfiguration.
+    """
+    from mapproxy.config.config import load_default_config, load_config
+    from mapproxy.config.loader import ConfigurationError, ProxyConfiguration
+    from mapproxy.config.spec import validate_options
+    from mapproxy.seed.seeder import seed
+
+    # Start with a sane configuration using MapProxy's defaults
+    mapproxy_config = load_default_config()
+
+    # merge our config
+    load_config(mapproxy_config, config_dict=conf)
+
+    errors, informal_only = validate_options(mapproxy_config)
+    if not informal_only or (errors and not ignore_warnings):
+        raise ConfigurationError('invalid configuration - {}'.format(', '.join(errors)))
+
+    return ProxyConfiguration(mapproxy_config, seed=seed, renderd=renderd)
+
+
 def get_tileset_dir(tileset):
     folder = get_tileset_base_folder(tileset)
     if not os.path.exists(folder):
@@ -68,14 +91,179 @@ def get_tileset_base_folder(tileset):
 def get_tileset_location(tileset):
     if tileset.cache_type == 'file':
         return get_tileset_dir(tileset)
+    elif tileset.cache_type == 'mbtiles':
+        get_tileset_dir(tileset)
+        return get_mbtiles_filename(tileset)
     elif tileset.cache_type == 'gpkg':
         return '{}/{}.gpkg'.format(get_tileset_dir(tileset), tileset.name)
+    elif tileset.cache_type == 'compact':
+        # bundles are created on the first store, report the directory early
+        location = os.path.abspath(get_compact_directory(tileset))
+        if not os.path.exists(location):
+            os.makedirs(location)
+        return location
+
+
+def get_progress_log_filename(tileset):
+    return '{}/{}.progress_log'.format(get_tileset_dir(tileset), tileset.name)
 
 
 def get_lock_filename(tileset):
     return '{}/generate_tileset_{}.lck'.format(get_tileset_dir(tileset), tileset.id)
 
 
+def get_seed_stamp_filename(tileset):
+    return '{}/{}.seeded'.format(get_tileset_base_folder(tileset), tileset.name)
+
+
+def touch_seed_stamp(tileset):
+    get_tileset_dir(tileset)
+    filename = get_seed_stamp_filename(tileset)
+    with open(filename, 'a'):
+        os.utime(filename, None)
+
+
+def get_seed_generation(tileset):
+    """
+    Returns the time the last seed of this tileset finished, or None. Tile caches
+    use it to notice that their entries are outdated.
+    """
+    try:
+        return os.stat(get_seed_stamp_filename(tileset)).st_mtime
+    except OSError:
+        return None
+
+
+def get_seed_stats_dir(tileset):
+    return '{}/{}.seed_stats'.format(get_tileset_dir(tileset), tileset.name)
+
+
+def save_seed_job(tileset, stats, started_at):
+    """
+    Stores the statistics collected while seeding as a SeedJob with one
+    SeedLevel per zoom level.
+    """
+    levels, workers = stats.collect()
+    finished_at = timezone.now()
+    duration = (finished_at - started_at).total_seconds()
+    tiles = sum(counts['tiles'] for counts in levels.values())
+    job = tileset.seed_jobs.create(
+        started_at=started_at,
+        finished_at=finished_at,
+        workers=workers,
+        tiles=tiles,
+        skipped=sum(counts['skipped'] for counts in levels.values()),
+        bytes=sum(counts['bytes'] for counts in levels.values()),
+        duration=duration,
+        tiles_per_second=tiles / duration if duration else 0
+    )
+    for level, counts in sorted(levels.items()):
+        level_duration = counts['seconds'] / max(workers, 1)
+        job.levels.create(
+            level=level,
+            tiles=counts['tiles'],
+            skipped=counts['skipped'],
+            bytes=counts['bytes'],
+            duration=level_duration,
+            tiles_per_second=counts['tiles'] / level_duration if level_duration else 0,
+            upstream_requests=counts['upstream_requests'],
+            upstream_p50_ms=percentile(counts['upstream_ms'], 0.5),
+            upstream_p95_ms=percentile(counts['upstream_ms'], 0.95)
+        )
+    return job
+
+
+def get_dedup_stats_filename(tileset):
+    return '{}/{}.dedup'.format(get_tileset_base_folder(tileset), tileset.name)
+
+
+def dedup_tiles(tileset):
+    """
+    Runs the hardlink pass over a freshly seeded file cache and records how
+    many bytes and inodes the deduplication saves.
+    """
+    if tileset.cache_type != 'file' or tileset.tile_dedup == 'none':
+        return None
+    cache_dir = get_file_cache_directory(tileset)
+    if tileset.tile_dedup == 'hardlink':
+        link_single_color_tiles(cache_dir, DJMP_TILE_DEDUP_MAX_TILE_BYTES)
+    stats = dedup_stats(cache_dir)
+    stats['mode'] = tileset.tile_dedup
+    get_tileset_dir(tileset)
+    with open(get_dedup_stats_filename(tileset), 'w') as f:
+        json.dump(stats, f)
+    return stats
+
+
+def get_dedup_stats(tileset):
+    try:
+        with open(get_dedup_stats_filename(tileset)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def cleanup_tiles(tileset, remove_before=None):
+    """
+    Removes the cached tiles outside the current zoom range and bbox of the
+    tileset and, for file caches, the tiles written before the
+    `remove_before` timestamp. MBTiles files are compacted, compact caches
+    only lose whole levels. The cleanup is recorded as a SeedJob of kind
+    cleanup.
+    """
+    from .tileindex import build_tile_index, get_tile_index_filename
+
+    mapproxy_cf, seed_cf = generate_confs(tileset)
+
+    started_at = timezone.now()
+    removed = {'tiles': 0, 'bytes': 0}
+    for grid, extent, tile_manager in mapproxy_cf.caches['tileset_cache'].caches():
+        ranges = tile_ranges(tileset, grid)
+        if tileset.cache_type == 'file':
+            grid_removed = cleanup_file_cache(
+                tile_manager.cache.cache_dir, ranges, remove_before, DJMP_CLEANUP_CONCURRENCY)
+        elif tileset.cache_type == 'mbtiles':
+            grid_removed = cleanup_mbtiles(get_mbtiles_filename(tileset), ranges)
+        elif tileset.cache_type == 'compact':
+            grid_removed = cleanup_compact_cache(tile_manager.cache.cache_dir, ranges)
+        else:
+            grid_removed = {}
+        for key, value in grid_removed.items():
+            removed[key] += value
+
+    finished_at = timezone.now()
+    duration = (finished_at - started_at).total_seconds()
+    job = tileset.seed_jobs.create(
+        kind='cleanup',
+        started_at=started_at,
+        finished_at=finished_at,
+        tiles=removed['tiles'],
+        bytes=removed['bytes'],
+        duration=duration,
+        tiles_per_second=removed['tiles'] / duration if duration else 0
+    )
+    if removed['tiles'] or removed['bytes']:
+        # tile caches of all worker processes drop the removed tiles
+        touch_seed_stamp(tileset)
+        if os.path.isfile(get_tile_index_filename(tileset)):
+            build_tile_index(tileset)
+    return cleanup_report(job)
+
+
+def cleanup_report(job):
+    return {
+        'tiles': job.tiles,
+        'bytes': job.bytes,
+        'duration': round(job.duration, 3),
+        'finished': job.finished_at.isoformat(),
+    }
+
+
+def get_cleanup_report(tileset):
+    job = tileset.seed_jobs.filter(kind='cleanup').first()
+    return cleanup_report(job) if job is not None else None
+
+
 def update_tileset_stats(tileset):
     size, updated = get_tileset_stats(tileset)
 
@@ -94,12 +282,86 @@ def get_tileset_stats(tileset):
     
     stat = os.stat(tileset_location)
     if stat:
-        size =  os.popen('du -sh %s' % tileset_location).read().split('\t')[0]
-        updated = datetime.fromtimestamp(stat.st_ctime).isoformat()
+        paths = [tileset_location]
+        if tileset.cache_type == 'mbtiles':
+            # uncheckpointed seed writes live in the write-ahead log
+            paths += [p for p in (tileset_location + '-wal', tileset_location + '-shm') if os.path.exists(p)]
+        size = os.popen('du -shc %s' % ' '.join(paths)).read().splitlines()[-1].split('\t')[0]
+        updated = stat.st_ctime
+        if tileset.cache_type == 'compact':
+            # bundles are updated in place, the directory ctime does not change
+            bundles = [f for grid in cache_grids(tileset) for f in bundle_files(get_grid_cache_directory(tileset, grid))]
+            updated = max([updated] + [os.stat(f).st_mtime for f in bundles])
+        updated = datetime.fromtimestamp(updated).isoformat()
         return size, updated
     return None
 
 
+def get_encoding_savings_filename(tileset):
+    return '{}/{}.encoding'.format(get_tileset_base_folder(tileset), tileset.name)
+
+
+def estimate_encoding_savings(tileset, max_samples=16):
+    """
+    Estimates the storage saved by the tileset's image format by re-encoding
+    a sample of cached tiles from the highest zoom levels as RGBA PNG.
+    """
+    from mapproxy.cache.tile import Tile
+
+    mapproxy_cf, seed_cf = generate_confs(tileset)
+    grid, extent, tile_manager = mapproxy_cf.caches['tileset_cache'].caches()[0]
+    bbox = tileset.bbox_3857()
+
+    sampled = []
+    for level in range(tileset.layer_zoom_stop, tileset.layer_zoom_start - 1, -1):
+        _, _, coords = grid.get_affected_level_tiles(bbox, level)
+        tiles = [Tile(c) for c in itertools.islice(coords, max_samples) if c is not None]
+        tile_manager.cache.load_tiles(tiles)
+        sampled.extend(t for t in tiles if t.source)
+        if len(sampled) >= max_samples:
+            break
+
+    stored_bytes = 0
+    png_bytes = 0
+    for tile in sampled[:max_samples]:
+        stored_bytes += len(tile.source.as_buffer().read())
+        buf = BytesIO()
+        tile.source.as_image().convert('RGBA').save(buf, 'png')
+        png_bytes += len(buf.getvalue())
+
+    return {
+        'format': tileset.image_format,
+        'sampled_tiles': len(sampled[:max_samples]),
+        'sampled_bytes': stored_bytes,
+        'rgba_png_bytes': png_bytes,
+        'saved_percent': round(100.0 * (png_bytes - stored_bytes) / png_bytes, 1) if png_bytes else None,
+    }
+
+
+def record_encoding_savings(tileset):
+    """
+    Estimates the storage saved by the image format of a freshly seeded
+    tileset and records it for the status view.
+    """
+    if tileset.image_format == 'png':
+        return None
+    savings = estimate_encoding_savings(tileset)
+    get_tileset_dir(tileset)
+    with open(get_encoding_savings_filename(tileset), 'w') as f:
+        json.dump(savings, f)
+    return savings
+
+
+def get_encoding_savings(tileset):
+    try:
+        with open(get_encoding_savings_filename(tileset)) as f:
+            savings = json.load(f)
+    except (IOError, ValueError):
+        return None
+    # recorded before the image format changed
+    return savings if savings['format'] == tileset.image_format else None
+
+
 def add_tileset_file_attribs(target_object, tileset):
     size, updated = get_tileset_stats(tileset)
     target_object['size'] = size
@@ -107,6 +369,9 @@ def add_tileset_file_attribs(target_object, tileset):
 
 
 def get_status(tileset):
+    from dateutil import parser
+    from .tileindex import tile_index_stats
+
     res = {
         'current': {
             'status': 'unknown'
@@ -123,6 +388,16 @@ def get_status(tileset):
         res['current']['status'] = 'ready'
         # get the size and time last updated for the tileset
         add_tileset_file_attribs(res['current'], tileset)
+        if tileset.image_format != 'png':
+            res['current']['encoding'] = get_encoding_savings(tileset)
+        if tileset.tile_dedup != 'none':
+            res['current']['dedup'] = get_dedup_stats(tileset)
+        cleanup = get_cleanup_report(tileset)
+        if cleanup is not None:
+            res['current']['cleanup'] = cleanup
+        tile_index = tile_index_stats(tileset)
+        if tile_index is not None:
+            res['current']['tile_index'] = tile_index
         # get the size and time last updated for the 'pending' tileset
         add_tileset_file_attribs(res['pending'], tileset)
 
@@ -133,8 +408,7 @@ def get_status(tileset):
             if process:
                 # if tileset generation is in progress
                 res['pending']['status'] = 'in progress'
-                tileset_location = get_tileset_location(tileset, 'progress_log')
-                log_filename = '%s/%s.progress_log' % (tileset_location, tileset.name)
+                log_filename = get_progress_log_filename(tileset)
                 if os.path.isfile(log_filename):
                     with open(log_filename, 'r') as f:
                         lines = f.read().replace('\r', '\n')
@@ -180,7 +454,11 @@ def get_status(tileset):
         res.pop('pending', None)
         res['current']['status'] = 'not generated'
 
-    
+    res['latency'] = latency_histograms.stats(tileset.pk)
+    res['hot_tile_cache'] = hot_tile_cache.stats(tileset.pk)
+    if shared_tile_cache.enabled:
+        res['shared_tile_cache'] = shared_tile_cache.stats(tileset.pk, get_seed_generation(tileset))
+
     return res
     
 
@@ -197,49 +475,124 @@ def get_status(tileset):
 # gain for the current use case. Instead of using daemon processes, they should use another mechanism to track/kill
 # child processes so that each celery task can launch other processes.
 def seed_process_spawn(tileset):
+    tasks, progress_logger = prepare_seed(tileset)
+    close_db_connections()
+    # launch the task using another process
+    process = multiprocessing.Process(target=seed_process_target, args=(tileset, tasks, progress_logger))
+    pid = None
+    if 'preparing_to_start' == get_pid_from_lock_file(tileset):
+        process.start()
+        pid = process.pid
+    else:
+        log.debug(' Not starting process. cancel was requested.')
+    return pid
+
+
+def prepare_seed(tileset, on_tiles=None):
+    """
+    Returns the seed tasks of a tileset and the progress logger writing its
+    progress log. `on_tiles(count)` is called with the newly seeded tiles.
+    """
+    from .mbtiles import prepare_mbtiles, use_batched_writes
+    from .seedprogress import SeedProgressLog
+
     mapproxy_conf, seed_conf = generate_confs(tileset)
 
     # if there is an old _generating one around, back it up
-    tileset_location = get_tileset_location(tileset)
+    tileset_dir = get_tileset_dir(tileset)
 
     backup_millis = int(round(time.time() * 1000))
-    generating_filename = '%s/%s.generating' % (tileset_location, tileset.name)
+    generating_filename = '%s/%s.generating' % (tileset_dir, tileset.name)
     if os.path.isfile(generating_filename):
         os.rename(generating_filename, '{}_{}'.format(generating_filename, backup_millis))
 
     # if there is an old progress_log around, back it up
-    log_filename = '%s/%s.progress_log' % (tileset_location, tileset.name)
+    log_filename = get_progress_log_filename(tileset)
     if os.path.isfile(log_filename):
         os.rename(log_filename, '{}_{}'.format(log_filename, backup_millis))
 
     # generate the new gpkg as name.generating file
     out = open(log_filename, 'w+')
-    progress_logger = util.ProgressLog(out=out, verbose=True, silent=False)
+    progress_logger = SeedProgressLog(tileset.pk, out=out, verbose=True, silent=False, on_tiles=on_tiles)
     tasks = seed_conf.seeds(['tileset_seed'])
-    # launch the task using another process
-    process = multiprocessing.Process(target=seed_process_target, args=(tileset, tasks, progress_logger))
+    if tileset.cache_type == 'mbtiles':
+        prepare_mbtiles(get_tileset_location(tileset))
+        use_batched_writes(tasks)
+    return tasks, progress_logger
+
+
+def seed_process_target(tileset, tasks, progress_logger):
+    from mapproxy.seed import seeder
+    from .tileindex import ensure_tile_index, record_tile_index, tile_index_writer
+
+    started_at = timezone.now()
+    # the metrics view counts running seed jobs from the metrics files of the seed processes
+    labels = {'tileset': str(tileset.pk)}
+    process_metrics.set_gauge('djmp_seed_running', labels, 1)
+    process_metrics.flush()
+    try:
+        stats = SeedStats(get_seed_stats_dir(tileset), DJMP_SEED_STATS_MAX_SAMPLES)
+        stats.remove()
+        record_seed_stats(tasks, stats)
+        index_filename = ensure_tile_index(tileset)
+        if index_filename is not None:
+            record_tile_index(tasks, index_filename)
+        seeder.seed(tasks=tasks, progress_logger=progress_logger)
+        tile_index_writer.flush()
+        log.debug('start seeding. tileset {}'.format(tileset.id))
+        # now that we have generated the new gpkg file, backup the last one, then rename
+        # the _generating one to the main name
+        # if os.path.isfile(get_tileset_filename(tileset_name)):
+        #     millis = int(round(time.time() * 1000))
+        #     os.rename(get_tileset_filename(tileset_name), '{}_{}'.format(get_tileset_filename(tileset_name), millis))
+        # os.rename(get_tileset_filename(tileset_name, 'generating'), get_tileset_filename(tileset_name))
+        # the tiles are seeded, a failing bookkeeping step must not skip the others
+        for step, args in ((dedup_tiles, (tileset,)),
+                           (record_encoding_savings, (tileset,)),
+                           (save_seed_job, (tileset, stats, started_at))):
+            try:
+                step(*args)
+            except Exception:
+                log.exception('{} failed for tileset {}'.format(step.__name__, tileset.id))
+        stats.remove()
+    finally:
+        # tile caches of all worker processes drop their entries for this
+        # tileset, also for the tiles of a failed seed
+        touch_seed_stamp(tileset)
+        remove_lock_file(tileset)
+        process_metrics.set_gauge('djmp_seed_running', labels, 0)
+        process_metrics.flush()
+
+
+def close_db_connections():
+    # a forked job process must not share the database connections of this process
+    for connection in connections.all():
+        if not connection.in_atomic_block:
+            connection.close()
+
+
+def cleanup_process_spawn(tileset, remove_before=None):
+    close_db_connections()
+    process = multiprocessing.Process(target=cleanup_process_target, args=(tileset, remove_before))
     pid = None
     if 'preparing_to_start' == get_pid_from_lock_file(tileset):
         process.start()
         pid = process.pid
     else:
-        log.debug(' Not starting process. cancel was requested.')
+        log.debug(' Not starting cleanup process. cancel was requested.')
     return pid
 
 
-def seed_process_target(tileset, tasks, progress_logger):
-    seeder.seed(tasks=tasks, progress_logger=progress_logger)
-    log.debug('start seeding. tileset {}'.format(tileset.id))
-    # now that we have generated the new gpkg file, backup the last one, then rename
-    # the _generating one to the main name
-    # if os.path.isfile(get_tileset_filename(tileset_name)):
-    #     millis = int(round(time.time() * 1000))
-    #     os.rename(get_tileset_filename(tileset_name), '{}_{}'.format(get_tileset_filename(tileset_name), millis))
-    # os.rename(get_tileset_filename(tileset_name, 'generating'), get_tileset_filename(tileset_name))
-    remove_lock_file(tileset)
-
-
-def get_lock_file(tileset):
+def cleanup_process_target(tileset, remove_before):
+    try:
+        report = cleanup_tiles(tileset, remove_before)
+        log.debug('cleaned up tileset {}: {} tiles, {} bytes'.format(tileset.id, report['tiles'], report['bytes']))
+    finally:
+        remove_lock_file(tileset)
+        process_metrics.flush()
+
+
+def get_lock_file(tileset, remove_stale=True):
     flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY
     lock_file = None
 
@@ -248,7 +601,12 @@ def get_lock_file(tileset):
     except OSError as e:
         if e.errno == errno.EEXIST:
             # Failed, file already exists.
-            pass
+            pid = get_pid_from_lock_file(tileset)
+            if remove_stale and is_int_str(pid) and not is_pid_running(pid):
+                # left behind by a job process that was killed
+                log.debug('removing the stale lock file of process {}'.format(pid))
+                remove_lock_file(tileset)
+                return get_lock_file(tileset, remove_stale=False)
         else:
             # Something unexpected went wrong so re-raise the exception.
             raise
@@ -282,6 +640,8 @@ def get_pid_from_lock_file(tileset):
 
 
 def get_process_from_pid(pid):
+    import psutil
+
     process = None
     if is_int_str(pid):
         try:
@@ -292,7 +652,18 @@ def get_process_from_pid(pid):
     return process
 
 
+def is_pid_running(pid):
+    import psutil
+
+    try:
+        return psutil.Process(int(pid)).status() != psutil.STATUS_ZOMBIE
+    except (psutil.NoSuchProcess, ValueError):
+        return False
+
+
 def get_is_process_running(pid):
+    import psutil
+
     process = None
     if is_int_str(pid):
         try:
@@ -0,0 +1,45 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from djmp.export import EXPORT_FORMATS, count_tiles, export_ranges, export_tiles, parse_bbox
+from djmp.batchtiles import tile_manager_of
+from djmp.helpers import generate_confs
+from djmp.models import Tileset
+from djmp.settings import DJMP_EXPORT_RENDER_CONCURRENCY
+
+
+class Command(BaseCommand):
+    help = 'Exports the cached tiles of a bbox and zoom range of a tileset to an MBTiles or GeoPackage file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tileset_id', type=int)
+        parser.add_argument('filename', help='file to write, replaced if it exists')
+        parser.add_argument('--format', choices=EXPORT_FORMATS,
+                            help='mbtiles or gpkg, guessed from the file extension if omitted')
+        parser.add_argument('--bbox', help='x0,y0,x1,y1 in EPSG:4326, the tileset bbox if omitted')
+        parser.add_argument('--zoom-start', type=int)
+        parser.add_argument('--zoom-stop', type=int)
+        parser.add_argument('--render', action='store_true', help='render missing tiles first')
+        parser.add_argument('--concurrency', type=int, default=DJMP_EXPORT_RENDER_CONCURRENCY,
+                            help='threads rendering missing tiles')
+
+    def handle(self, *args, **options):
+        try:
+            tileset = Tileset.objects.get(pk=options['tileset_id'])
+        except Tileset.DoesNotExist:
+            raise CommandError('unknown tileset: {}'.format(options['tileset_id']))
+        export_format = options['format'] or os.path.splitext(options['filename'])[1].lstrip('.')
+        if export_format not in EXPORT_FORMATS:
+            raise CommandError('unknown format {}, use --format'.format(export_format))
+        try:
+            bbox = parse_bbox(options['bbox']) if options['bbox'] else None
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        mapproxy_cf, seed_cf = generate_confs(tileset)
+        ranges = export_ranges(tileset, tile_manager_of(mapproxy_cf)[0], bbox, options['zoom_start'], options['zoom_stop'])
+        self.stdout.write('exporting up to {} tiles of {} levels'.format(count_tiles(ranges), len(ranges)))
+        res = export_tiles(tileset, options['filename'], export_format, bbox, options['zoom_start'],
+                           options['zoom_stop'], options['render'], options['concurrency'], mapproxy_cf)
+        self.stdout.write('{}: {tiles} tiles in {duration:.1f}s'.format(options['filename'], **res))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from djmp.models import Tileset
+from djmp.settings import DJMP_IMPORT_BATCH_SIZE, DJMP_IMPORT_CONCURRENCY
+from djmp.tileimport import import_tiles, tile_source
+
+
+class Command(BaseCommand):
+    help = 'Imports the tiles of an MBTiles or GeoPackage file or a z/x/y directory into the cache of a tileset.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tileset_id', type=int)
+        parser.add_argument('source', help='MBTiles or GeoPackage file or z/x/y directory')
+        parser.add_argument('--format', choices=['mbtiles', 'gpkg', 'dir'],
+                            help='source format, guessed from the source if omitted')
+        parser.add_argument('--table', help='GeoPackage tile table, the first one if omitted')
+        parser.add_argument('--tms', action='store_true', help='rows of the directory count from the south')
+        parser.add_argument('--concurrency', type=int, default=DJMP_IMPORT_CONCURRENCY,
+                            help='number of import processes')
+        parser.add_argument('--batch-size', type=int, default=DJMP_IMPORT_BATCH_SIZE,
+                            help='tiles stored with one write')
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help='seconds between progress lines')
+
+    def handle(self, *args, **options):
+        try:
+            tileset = Tileset.objects.get(pk=options['tileset_id'])
+        except Tileset.DoesNotExist:
+            raise CommandError('unknown tileset: {}'.format(options['tileset_id']))
+        try:
+            source = tile_source(options['source'], options['format'], options['table'], options['tms'])
+        except (ValueError, IOError, OSError) as e:
+            raise CommandError(str(e))
+
+        def progress(status):
+            self.stdout.write('{done}/{jobs} jobs, {tiles} tiles, {skipped} skipped, {tiles_per_second:.1f} tiles/s'.format(
+                **status))
+
+        res = import_tiles(tileset, source, options['concurrency'], options['batch_size'], progress, options['interval'])
+        if res is None:
+            raise CommandError('tileset {} is seeding or cleaning up'.format(tileset.pk))
+        self.stdout.write('{}: {tiles} tiles ({bytes} bytes) imported, {skipped} outside the tileset skipped, '
+                          '{reencoded} encoded again, {invalid} invalid in {duration:.1f}s'.format(tileset.name, **res))
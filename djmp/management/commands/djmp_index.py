@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from djmp.models import Tileset
+from djmp.tileindex import build_tile_index
+
+
+class Command(BaseCommand):
+    help = 'Builds the tile index of tilesets from the tiles in their caches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tileset_ids', nargs='*', type=int,
+                            help='tilesets to index, all if omitted')
+
+    def handle(self, *args, **options):
+        tilesets = Tileset.objects.all()
+        if options['tileset_ids']:
+            tilesets = tilesets.filter(pk__in=options['tileset_ids'])
+            missing = set(options['tileset_ids']) - set(t.pk for t in tilesets)
+            if missing:
+                raise CommandError('unknown tilesets: {}'.format(', '.join(str(pk) for pk in sorted(missing))))
+
+        for tileset in tilesets:
+            start = time.time()
+            tiles = build_tile_index(tileset)
+            if tiles is None:
+                self.stdout.write('{}: {} caches are not indexed'.format(tileset.name, tileset.cache_type))
+                continue
+            self.stdout.write('{}: {} tiles indexed in {:.3f}s'.format(tileset.name, tiles, time.time() - start))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from djmp.models import Tileset
+from djmp.prewarm import most_requested_tilesets, prewarm
+from djmp.settings import DJMP_PREWARM_TILESETS
+
+
+class Command(BaseCommand):
+    help = 'Builds the MapProxy apps of the most requested tilesets before a process serves tiles.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tileset_ids', nargs='*', type=int,
+                            help='tilesets to pre-warm, the most requested if omitted')
+        parser.add_argument('--tilesets', type=int, default=DJMP_PREWARM_TILESETS,
+                            help='number of most requested tilesets to pre-warm')
+        parser.add_argument('--all', action='store_true',
+                            help='pre-warm all tilesets')
+
+    def handle(self, *args, **options):
+        if options['tileset_ids']:
+            tilesets = Tileset.objects.filter(pk__in=options['tileset_ids'])
+            missing = set(options['tileset_ids']) - set(t.pk for t in tilesets)
+            if missing:
+                raise CommandError('unknown tilesets: {}'.format(', '.join(str(pk) for pk in sorted(missing))))
+        else:
+            tilesets = most_requested_tilesets(None if options['all'] else options['tilesets'])
+
+        def progress(tileset, result):
+            if result['error']:
+                self.stderr.write('{}: failed after {:.3f}s: {}'.format(tileset.name, result['duration'], result['error']))
+            else:
+                self.stdout.write('{}: {:.3f}s'.format(tileset.name, result['duration']))
+
+        summary = prewarm(tilesets, progress)
+        self.stdout.write('{tilesets} tilesets pre-warmed in {duration:.3f}s, {errors} errors'.format(**summary))
+        if summary['errors']:
+            raise CommandError('{} tilesets could not be pre-warmed'.format(summary['errors']))
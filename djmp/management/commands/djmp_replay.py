@@ -0,0 +1,174 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+try:
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl
+except ImportError:
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import WSGIRequestHandler, WSGIServer
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+from django.test.utils import setup_test_environment
+
+from djmp.models import Tileset
+from djmp.replay import generate_sessions, http_sender, parse_log, replay, request_path
+from djmp.settings import ENABLE_GUARDIAN_PERMISSIONS
+from djmp.stubserver import StubUpstream
+from djmp.tilecache import TILE_PATH_RE
+
+
+class _ThreadedWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class LocalServer(object):
+    """
+    Serves this project with a threaded WSGI server on a test database, with
+    tilesets that fetch their tiles from a local stub upstream.
+    """
+    def __init__(self, upstream_latency):
+        self.upstream_latency = upstream_latency
+
+    def start(self):
+        setup_test_environment()
+        self.directory = tempfile.mkdtemp(prefix='djmp-replay-')
+        if connection.vendor == 'sqlite':
+            # server threads open their own connections, an in-memory test
+            # database would be empty for them
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(self.directory, 'db.sqlite3')
+        self.db_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        self.upstream = StubUpstream(latency=self.upstream_latency).start()
+        self.server = _ThreadedWSGIServer(('127.0.0.1', 0), _QuietRequestHandler)
+        self.server.set_app(get_wsgi_application())
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def create_tileset(self, name, **kwargs):
+        tileset = Tileset.objects.create(
+            name=name,
+            created_by='djmp_replay',
+            source_type='wms',
+            server_url=self.upstream.url,
+            layer_name='replay',
+            cache_type='file',
+            directory_layout='tms',
+            directory=self.directory,
+            **kwargs
+        )
+        if ENABLE_GUARDIAN_PERMISSIONS:
+            from guardian.utils import get_anonymous_user
+            tileset.add_read_perm(get_anonymous_user())
+        return tileset
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.upstream.stop()
+        connection.creation.destroy_test_db(self.db_name, verbosity=0)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _layer_name(path_info, query):
+    match = TILE_PATH_RE.match(path_info)
+    if match:
+        return match.group('layer')
+    # WMS and KVP requests name their layer in the query string
+    params = dict((k.lower(), v) for k, v in parse_qsl(query))
+    return (params.get('layers') or params.get('layer') or '').split(',')[0] or None
+
+
+class Command(BaseCommand):
+    help = ('Replays a tile request log or generated pan/zoom sessions against tileset_mapproxy '
+            'and reports throughput, latency percentiles and cache hit ratios as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--log', help='access log to replay, common/combined log format or one path per line')
+        parser.add_argument('--sessions', type=int, default=10, help='generated sessions if no log is given')
+        parser.add_argument('--steps', type=int, default=20, help='pan/zoom steps of each generated session')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--tileset', type=int, help='tileset of the generated sessions (with --url)')
+        parser.add_argument('--url', help='server to replay against, e.g. http://localhost:8000')
+        parser.add_argument('--local', action='store_true',
+                            help='replay against a local server, test database and stub upstream')
+        parser.add_argument('--upstream-latency', type=float, default=0.0,
+                            help='seconds the local stub upstream waits before answering')
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--rate', type=float, default=0, help='requests per second, 0 for as fast as possible')
+        parser.add_argument('--header', action='append', default=[],
+                            help='extra request header, e.g. "Cookie: sessionid=..."')
+        parser.add_argument('--limit', type=int, help='replay at most this many requests')
+
+    def handle(self, *args, **options):
+        if bool(options['url']) == bool(options['local']):
+            raise CommandError('give either --url or --local')
+        if not options['log'] and not options['local'] and options['tileset'] is None:
+            raise CommandError('generated sessions against --url need --tileset')
+
+        requests = None
+        if options['log']:
+            with open(options['log']) as f:
+                requests = parse_log(f)
+            if not requests:
+                raise CommandError('no tileset requests found in {}'.format(options['log']))
+
+        headers = dict(h.split(':', 1) for h in options['header'])
+        headers = dict((k.strip(), v.strip()) for k, v in headers.items())
+
+        server = None
+        if options['local']:
+            server = LocalServer(options['upstream_latency']).start()
+        try:
+            if server is not None:
+                base_url = server.url
+                if requests is not None:
+                    # one local tileset per tileset of the log, named like its layer
+                    tilesets = {}
+                    for pk, path_info, query in requests:
+                        if pk not in tilesets and _layer_name(path_info, query):
+                            tilesets[pk] = server.create_tileset(
+                                _layer_name(path_info, query), layer_zoom_start=0, layer_zoom_stop=20).pk
+                    requests = [(tilesets[pk], path_info, query)
+                                for pk, path_info, query in requests if pk in tilesets]
+                else:
+                    tileset = server.create_tileset(
+                        'replay', layer_zoom_start=4, layer_zoom_stop=14,
+                        bbox_x0=0, bbox_y0=40, bbox_x1=10, bbox_y1=50)
+                    requests = [(tileset.pk, path, '') for path in generate_sessions(
+                        tileset, options['sessions'], options['steps'], seed=options['seed'])]
+            else:
+                base_url = options['url']
+                if requests is None:
+                    tileset = Tileset.objects.get(pk=options['tileset'])
+                    requests = [(tileset.pk, path, '') for path in generate_sessions(
+                        tileset, options['sessions'], options['steps'], seed=options['seed'])]
+
+            if options['limit']:
+                requests = requests[:options['limit']]
+            paths = [request_path(*request) for request in requests]
+            report = replay(paths, http_sender(base_url, headers), options['concurrency'], options['rate'])
+            if server is not None:
+                report['upstream_requests'] = server.upstream.requests
+        finally:
+            if server is not None:
+                server.stop()
+
+        self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from djmp.batchseed import batch_seed
+from djmp.models import CACHE_TYPES, SOURCE_TYPES, Tileset
+from djmp.settings import DJMP_BATCH_SEED_CONCURRENCY
+
+
+class Command(BaseCommand):
+    help = 'Seeds many tilesets from this process instead of a web worker.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tileset_ids', nargs='*', type=int,
+                            help='tilesets to seed, all matching the filters if omitted')
+        parser.add_argument('--name', help='only tilesets whose name contains this text')
+        parser.add_argument('--source-type', choices=[c[0] for c in SOURCE_TYPES])
+        parser.add_argument('--cache-type', choices=[c[0] for c in CACHE_TYPES])
+        parser.add_argument('--zoom-start', type=int, help='first zoom level to seed instead of the tileset one')
+        parser.add_argument('--zoom-stop', type=int, help='last zoom level to seed instead of the tileset one')
+        parser.add_argument('--concurrency', type=int, default=DJMP_BATCH_SEED_CONCURRENCY,
+                            help='number of tilesets seeded at once')
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help='seconds between progress lines')
+
+    def handle(self, *args, **options):
+        tilesets = Tileset.objects.order_by('pk')
+        if options['tileset_ids']:
+            tilesets = tilesets.filter(pk__in=options['tileset_ids'])
+            missing = set(options['tileset_ids']) - set(t.pk for t in tilesets)
+            if missing:
+                raise CommandError('unknown tilesets: {}'.format(', '.join(str(pk) for pk in sorted(missing))))
+        if options['name']:
+            tilesets = tilesets.filter(name__icontains=options['name'])
+        if options['source_type']:
+            tilesets = tilesets.filter(source_type=options['source_type'])
+        if options['cache_type']:
+            tilesets = tilesets.filter(cache_type=options['cache_type'])
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency must be at least 1')
+        tilesets = list(tilesets)
+        if not tilesets:
+            raise CommandError('no tilesets to seed')
+
+        def progress(status):
+            self.stdout.write('{done}/{total} done, {tiles} tiles, {tiles_per_second:.1f} tiles/s, seeding: {}'.format(
+                ', '.join(status['seeding']) or '-', **status))
+
+        results, summary = batch_seed(
+            tilesets, options['concurrency'], options['zoom_start'], options['zoom_stop'], progress, options['interval'])
+        for tileset in tilesets:
+            result = results[tileset.pk]
+            line = '{}: {status}, {tiles} tiles in {duration:.1f}s'.format(tileset.name, **result)
+            if result['error']:
+                line += ': {}'.format(result['error'])
+            self.stdout.write(line)
+        self.stdout.write('{seeded} seeded, {failed} failed, {skipped} already seeding, '
+                          '{tiles} tiles in {duration:.1f}s ({tiles_per_second:.1f} tiles/s)'.format(**summary))
+        if summary['failed']:
+            raise CommandError('{} tilesets could not be seeded'.format(summary['failed']))
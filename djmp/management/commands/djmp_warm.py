@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from djmp.heatmap import clear_heat_map, warm_tileset
+from djmp.models import Tileset
+from djmp.settings import DJMP_WARM_LEVELS, DJMP_WARM_TILES
+
+
+class Command(BaseCommand):
+    help = 'Seeds the most requested tiles of tilesets and the zoom levels below them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tileset_ids', nargs='*', type=int,
+                            help='tilesets to warm, all if omitted')
+        parser.add_argument('--tiles', type=int, default=DJMP_WARM_TILES,
+                            help='number of most requested tiles to warm')
+        parser.add_argument('--levels', type=int, default=DJMP_WARM_LEVELS,
+                            help='zoom levels to seed below each hot tile')
+        parser.add_argument('--refresh', action='store_true',
+                            help='render the tiles again even if they are cached')
+        parser.add_argument('--clear', action='store_true',
+                            help='start a new heat map once the tileset is warm')
+
+    def handle(self, *args, **options):
+        tilesets = Tileset.objects.all()
+        if options['tileset_ids']:
+            tilesets = tilesets.filter(pk__in=options['tileset_ids'])
+            missing = set(options['tileset_ids']) - set(t.pk for t in tilesets)
+            if missing:
+                raise CommandError('unknown tilesets: {}'.format(', '.join(str(pk) for pk in sorted(missing))))
+
+        for tileset in tilesets:
+            res = warm_tileset(tileset, options['tiles'], options['levels'], refresh=options['refresh'])
+            if options['clear']:
+                clear_heat_map(tileset)
+            self.stdout.write('{}: {hot_tiles} hot tiles, {tiles} tiles, {rendered_meta_tiles} meta tiles rendered'.format(
+                tileset.name, **res))
@@ -1,3 +1,4 @@
+import copy
 import json
 import os
 import base64
@@ -41,11 +42,56 @@ def tile_source(tileset):
     }
 
 def file_cache(tileset):
-    return {
+    cache = {
         "type": "file",
-        "directory": os.path.join(tileset.directory, str(tileset.id)),
         "directory_layout": tileset.directory_layout
     }
+    if len(cache_grids(tileset)) > 1:
+        # one directory per grid below the cache_dir of tileset_cache
+        cache["use_grid_names"] = True
+    else:
+        cache["directory"] = get_file_cache_directory(tileset)
+    return cache
+
+def get_file_cache_directory(tileset):
+    return os.path.join(tileset.directory, str(tileset.id))
+
+def compact_cache(tileset):
+    cache = {
+        "type": "compact",
+        "version": tileset.compact_version
+    }
+    if len(cache_grids(tileset)) == 1:
+        cache["directory"] = get_compact_directory(tileset)
+    return cache
+
+def get_compact_directory(tileset):
+    return os.path.join(tileset.directory, str(tileset.id))
+
+def cache_grids(tileset):
+    return tileset.cache_grids.split(',')
+
+def get_grid_cache_directory(tileset, grid='EPSG3857'):
+    """
+    Returns the directory of the file or compact cache of `grid`. Caches with
+    several grids keep one directory per grid, named the way MapProxy does.
+    """
+    directory = get_file_cache_directory(tileset)
+    if len(cache_grids(tileset)) > 1:
+        directory = os.path.join(directory, 'tileset_cache', grid)
+    return directory
+
+def mbtiles_cache(tileset):
+    return {
+        "type": "mbtiles",
+        "filename": os.path.abspath(get_mbtiles_filename(tileset)),
+        "sqlite_wal": True
+    }
+
+def get_mbtiles_filename(tileset):
+    if tileset.filename:
+        return tileset.filename
+    return os.path.join(tileset.directory, tileset.name, '{}.mbtiles'.format(tileset.name))
 
 def gpkg_cache(tileset):
     return {
@@ -62,6 +108,7 @@ def get_coverage(tileset):
 
 def seed_seeds(tileset):
     if tileset.layer_zoom_start > tileset.layer_zoom_stop:
+        from mapproxy.config.loader import ConfigurationError
         raise ConfigurationError('invalid configuration - zoom start is greater than zoom stop')
     return {
         "refresh_before": {
@@ -86,7 +133,7 @@ services_conf = {
     'wmts': {
           'restful': True,
           'restful_template':
-          '/{Layer}/{TileMatrixSet}/{TileMatrix}/{TileCol}/{TileRow}.png',
+          '/{Layer}/{TileMatrixSet}/{TileMatrix}/{TileCol}/{TileRow}.{Format}',
           },
     'tms': {
           'origin': 'nw',
@@ -94,6 +141,60 @@ services_conf = {
     'demo': None
 }
 
+def get_services_conf(tileset):
+    services = copy.deepcopy(services_conf)
+    if tileset.image_format in ('jpeg', 'mixed'):
+        services['wms']['image_formats'].append('image/jpeg')
+    return services
+
+def image_conf(tileset):
+    """
+    Returns the format, request_format and image options of the tileset cache.
+    """
+    if tileset.image_format == 'png8':
+        return 'image/png', None, {
+            "colors": tileset.image_colors,
+            "transparent": True,
+            "encoding_options": {"quantizer": u_to_str(tileset.image_quantizer)}
+        }
+    elif tileset.image_format == 'jpeg':
+        return 'image/jpeg', None, {
+            "encoding_options": {"jpeg_quality": tileset.jpeg_quality}
+        }
+    elif tileset.image_format == 'mixed':
+        # transparent tiles are stored as png, all others as jpeg
+        return 'mixed', 'image/png', {
+            "encoding_options": {"jpeg_quality": tileset.jpeg_quality}
+        }
+    return 'image/png', None, {}
+
+def tile_extension(tileset):
+    # mixed caches are requested as png
+    return 'jpeg' if tileset.image_format == 'jpeg' else 'png'
+
+def tileset_cache(tileset):
+    cache_format, request_format, image = image_conf(tileset)
+    grids = cache_grids(tileset)
+    if len(grids) > 1 and tileset.cache_type not in ('file', 'compact'):
+        from mapproxy.config.loader import ConfigurationError
+        raise ConfigurationError('{} caches only support a single grid'.format(tileset.cache_type))
+    cache = {
+        "grids": grids,
+        "sources":[
+            "tileset_source"
+        ],
+        "format": cache_format,
+        "image": image,
+        "cache": cache_conf.get(tileset.cache_type)(tileset)
+    }
+    if request_format:
+        cache["request_format"] = request_format
+    if len(grids) > 1 and tileset.cache_type in ('file', 'compact'):
+        cache["cache_dir"] = get_file_cache_directory(tileset)
+    if tileset.cache_type == 'file' and tileset.tile_dedup == 'symlink':
+        cache["link_single_color_images"] = True
+    return cache
+
 def grids_conf():
     return {
         "EPSG3857": {
@@ -116,13 +217,15 @@ sources_conf = {
 
 cache_conf = {
     "file": file_cache,
-    "gpkg": gpkg_cache
+    "mbtiles": mbtiles_cache,
+    "gpkg": gpkg_cache,
+    "compact": compact_cache
 }
 
 
 def get_mapproxy_conf(tileset):
     return json.dumps({
-        'services': services_conf,
+        'services': get_services_conf(tileset),
         'layers':  [{
             "name": u_to_str(tileset.name),
             "title": u_to_str(tileset.name),
@@ -131,15 +234,7 @@ def get_mapproxy_conf(tileset):
             ]
         }],
         'caches': {
-            "tileset_cache":{
-                "grids":[
-                    "EPSG3857"
-                ],
-                "sources":[
-                    "tileset_source"
-                ],
-                "cache": cache_conf.get(tileset.cache_type)(tileset)
-            }
+            "tileset_cache": tileset_cache(tileset)
         },
         'sources': {
             'tileset_source': sources_conf.get(tileset.source_type)(tileset)
@@ -153,6 +248,50 @@ def get_mapproxy_conf(tileset):
         }
     })
 
+def multi_tileset_layer_name(pk):
+    return 'tileset_{}'.format(pk)
+
+def cache_paths_use_cache_name(tileset):
+    # MapProxy names the grid directories of these caches after tileset_cache
+    return len(cache_grids(tileset)) > 1 and tileset.cache_type in ('file', 'compact')
+
+def get_multi_tileset_conf(confs):
+    """
+    Merges the configurations of get_mapproxy_conf ({pk: conf}) into one with
+    a layer, cache and source per tileset, named after its pk. The services,
+    grids and globals are shared.
+    """
+    conf = {
+        'services': get_services_conf_of(confs),
+        'layers': [],
+        'caches': {},
+        'sources': {},
+        'grids': grids_conf(),
+        'globals': {}
+    }
+    for pk, tileset_conf in sorted(confs.items()):
+        name = multi_tileset_layer_name(pk)
+        cache = copy.deepcopy(tileset_conf['caches']['tileset_cache'])
+        cache['sources'] = [name + '_source']
+        conf['caches'][name + '_cache'] = cache
+        conf['sources'][name + '_source'] = tileset_conf['sources']['tileset_source']
+        conf['layers'].append({
+            "name": name,
+            "title": tileset_conf['layers'][0]['title'],
+            "sources": [name + '_cache']
+        })
+        conf['globals'] = tileset_conf['globals']
+    return conf
+
+def get_services_conf_of(confs):
+    services = copy.deepcopy(services_conf)
+    image_formats = services['wms']['image_formats']
+    for tileset_conf in confs.values():
+        for image_format in tileset_conf['services']['wms']['image_formats']:
+            if image_format not in image_formats:
+                image_formats.append(image_format)
+    return services
+
 def get_seed_conf(tileset):
 
     seed_conf = {
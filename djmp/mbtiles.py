@@ -0,0 +1,135 @@
+import multiprocessing
+import os
+import signal
+import sqlite3
+import threading
+import time
+import logging
+from multiprocessing.util import Finalize
+
+from mapproxy.cache.mbtiles import MBTilesCache
+from mapproxy.compat import PY2
+
+from .settings import DJMP_MBTILES_SEED_BATCH_SIZE, DJMP_MBTILES_SEED_FLUSH_INTERVAL
+
+log = logging.getLogger('djmapproxy')
+
+
+def _exit_on_sigterm(signum, frame):
+    # unwinds the worker, so its finalizers commit the pending tiles
+    raise SystemExit(1)
+
+
+class BatchedMBTilesCache(MBTilesCache):
+    """
+    MBTiles cache for seed workers. MapProxy commits one transaction for each
+    meta tile and reopens the database after every meta tile; this cache keeps
+    the connection of the worker process open and writes the encoded tiles of
+    many meta tiles with a single executemany/commit.
+
+    Pending tiles are flushed when `batch_size` tiles are buffered,
+    `flush_interval` seconds passed since the last commit, or the worker
+    process exits or is terminated. Tiles are only marked stored once they
+    are committed, `on_commit(coords)` is called with the committed tiles.
+    """
+    def __init__(self, mbtile_file, batch_size, flush_interval, timeout=30, wal=True):
+        MBTilesCache.__init__(self, mbtile_file, timeout=timeout, wal=wal)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_commit = None
+        self._pending = []
+        self._pending_pid = None
+        self._last_flush = time.time()
+
+    def cleanup(self):
+        # called by the seed workers after each meta tile, keep the connection
+        pass
+
+    def store_tiles(self, tiles):
+        """
+        Returns True if the tiles are committed, False while they are pending.
+        """
+        if os.getpid() != self._pending_pid:
+            # first write in this (forked) worker
+            self._pending = []
+            self._pending_pid = os.getpid()
+            # before the tile index writer, which records the flushed tiles
+            Finalize(None, self.flush, exitpriority=20)
+            if multiprocessing.current_process().name != 'MainProcess' and \
+                    threading.current_thread().name == 'MainThread':
+                # seed workers are stopped with SIGTERM (see Tileset.stop)
+                signal.signal(signal.SIGTERM, _exit_on_sigterm)
+
+        tiles = [t for t in tiles if not t.stored]
+        for tile in tiles:
+            # encodes like tile_buffer without marking the tile stored
+            data = tile.source.as_buffer(seekable=True)
+            data.seek(0)
+            content = data.read()
+            x, y, level = tile.coord
+            self._pending.append((level, x, y, buffer(content) if PY2 else content))
+
+        if (len(self._pending) >= self.batch_size or
+                self._last_flush + self.flush_interval < time.time()):
+            if self.flush():
+                for tile in tiles:
+                    tile.stored = True
+                return True
+        return not tiles
+
+    def store_tile(self, tile):
+        return self.store_tiles([tile])
+
+    def flush(self):
+        if not self._pending:
+            return True
+        records = list(self._pending)
+        self._last_flush = time.time()
+        try:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?,?,?,?)",
+                records
+            )
+            self.db.commit()
+        except sqlite3.OperationalError as ex:
+            # kept for the next flush
+            log.warn('unable to store {} tiles: {}'.format(len(records), ex))
+            return False
+        # a flush interrupted by SIGTERM is repeated by the finalizer
+        del self._pending[:len(records)]
+        if self.on_commit is not None:
+            self.on_commit([(x, y, level) for level, x, y, content in records])
+        return True
+
+
+def prepare_mbtiles(filename):
+    """
+    Creates the MBTiles file in WAL mode. The journal mode is persistent, so
+    MapProxy and the seed workers open it in WAL mode from now on and readers
+    are not blocked by seed commits.
+    """
+    MBTilesCache(filename, wal=True)
+    db = sqlite3.connect(filename)
+    try:
+        db.execute('PRAGMA journal_mode=wal')
+    finally:
+        db.close()
+
+
+def use_batched_writes(tasks):
+    """
+    Swaps the MBTiles caches of seed tasks for BatchedMBTilesCache. Has to
+    be called before seeding starts, so the forked workers inherit it.
+    """
+    for task in tasks:
+        tile_manager = task.tile_manager
+        if type(tile_manager.cache) is MBTilesCache:
+            cache = tile_manager.cache
+            tile_manager.cache = BatchedMBTilesCache(
+                cache.mbtile_file,
+                DJMP_MBTILES_SEED_BATCH_SIZE,
+                DJMP_MBTILES_SEED_FLUSH_INTERVAL,
+                timeout=cache.timeout,
+                wal=True
+            )
+    return tasks
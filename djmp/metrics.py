@@ -0,0 +1,221 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+
+from .fileutils import makedirs, read_json, write_json
+from .settings import DJMP_METRICS_DIR, DJMP_METRICS_FLUSH_INTERVAL
+from .timing import latency_histograms
+
+log = logging.getLogger('djmapproxy')
+
+ARCHIVE_FILENAME = 'archive.json'
+LOCK_FILENAME = '.lock'
+
+
+class ProcessMetrics(object):
+    """
+    Counters and gauges of this process. They are written together with the
+    request latency histograms to `<directory>/<pid>.json` at most every
+    `flush_interval` seconds, so the metrics view can add up all worker and
+    seed processes.
+
+    Forked processes start with empty metrics, the parent keeps reporting
+    its own values.
+    """
+    def __init__(self, directory, flush_interval):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._counters = {}
+        self._gauges = {}
+        self._last_flush = 0
+
+    def _check_pid(self):
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._counters = {}
+            self._gauges = {}
+            self._last_flush = 0
+            latency_histograms.clear()
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._check_pid()
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._check_pid()
+            self._gauges[key] = value
+
+    def snapshot(self):
+        with self._lock:
+            self._check_pid()
+            return {
+                'counters': [[name, dict(labels), value] for (name, labels), value in self._counters.items()],
+                'gauges': [[name, dict(labels), value] for (name, labels), value in self._gauges.items()],
+                'histograms': latency_histograms.snapshot(),
+            }
+
+    def filename(self):
+        return os.path.join(self.directory, '{}.json'.format(os.getpid()))
+
+    def maybe_flush(self):
+        if self._last_flush + self.flush_interval < time.time():
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.time()
+        try:
+            makedirs(self.directory)
+            write_json(self.filename(), self.snapshot())
+        except (IOError, OSError) as ex:
+            log.warn('unable to write metrics to {}: {}'.format(self.directory, ex))
+
+
+process_metrics = ProcessMetrics(DJMP_METRICS_DIR, DJMP_METRICS_FLUSH_INTERVAL)
+
+
+def record_tile_request(tileset_pk, response):
+    labels = {'tileset': str(tileset_pk), 'status': str(response.status_code)}
+    process_metrics.inc('djmp_tile_requests_total', labels)
+    if response.has_header('X-Djmp-Cache'):
+        labels = {'tileset': str(tileset_pk), 'result': response['X-Djmp-Cache']}
+        process_metrics.inc('djmp_tile_cache_requests_total', labels)
+    process_metrics.maybe_flush()
+
+
+def _pid_alive(pid):
+    import psutil
+
+    try:
+        return psutil.pid_exists(pid)
+    except Exception:
+        return False
+
+
+def _merge(target, data):
+    counters = dict(((c[0], tuple(sorted(c[1].items()))), c[2]) for c in target['counters'])
+    for name, labels, value in data['counters']:
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + value
+    target['counters'] = [[name, dict(labels), value] for (name, labels), value in counters.items()]
+
+    for tileset_pk, stages in data['histograms'].items():
+        target_stages = target['histograms'].setdefault(tileset_pk, {})
+        for stage, hist in stages.items():
+            target_hist = target_stages.get(stage)
+            if target_hist is None:
+                target_stages[stage] = {
+                    'count': hist['count'], 'sum_ms': hist['sum_ms'], 'counts': list(hist['counts'])
+                }
+                continue
+            target_hist['count'] += hist['count']
+            target_hist['sum_ms'] += hist['sum_ms']
+            target_hist['counts'] = [a + b for a, b in zip(target_hist['counts'], hist['counts'])]
+
+
+def collect(directory=None):
+    """
+    Adds up the metrics files of all processes. Files of processes that
+    exited are folded into an archive file, so their counters are kept while
+    their gauges are dropped.
+    """
+    directory = directory or process_metrics.directory
+    process_metrics.flush()
+    total = {'counters': [], 'gauges': [], 'histograms': {}}
+    with open(os.path.join(directory, LOCK_FILENAME), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            archive_filename = os.path.join(directory, ARCHIVE_FILENAME)
+            archive = read_json(archive_filename) or {'counters': [], 'gauges': [], 'histograms': {}}
+            archived = False
+            for name in sorted(os.listdir(directory)):
+                pid, ext = os.path.splitext(name)
+                if ext != '.json' or not pid.isdigit():
+                    continue
+                filename = os.path.join(directory, name)
+                data = read_json(filename)
+                if data is None:
+                    continue
+                if _pid_alive(int(pid)):
+                    _merge(total, data)
+                    total['gauges'].extend(data['gauges'])
+                else:
+                    _merge(archive, data)
+                    os.remove(filename)
+                    archived = True
+            if archived:
+                write_json(archive_filename, archive)
+            _merge(total, archive)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return total
+
+
+def _labels(labels):
+    return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in sorted(labels.items()))
+
+
+def render_metrics(metrics, buckets_ms):
+    """
+    Renders collected metrics in the Prometheus text exposition format.
+    """
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for sample_name, labels, value in samples:
+            lines.append('{}{{{}}} {}'.format(sample_name, _labels(labels), repr(float(value))))
+
+    def samples(items, name):
+        return sorted([(n, labels, v) for n, labels, v in items if n == name],
+                      key=lambda s: sorted(s[1].items()))
+
+    family('djmp_tile_requests_total', 'counter', 'Tile requests by tileset and response status.',
+           samples(metrics['counters'], 'djmp_tile_requests_total'))
+    family('djmp_tile_cache_requests_total', 'counter', 'Tile requests by tileset and tile cache result.',
+           samples(metrics['counters'], 'djmp_tile_cache_requests_total'))
+    family('djmp_miss_pool_queued', 'gauge', 'Tile cache misses waiting for a miss pool thread by process.',
+           samples(metrics['gauges'], 'djmp_miss_pool_queued'))
+    family('djmp_miss_pool_running', 'gauge', 'Tile cache misses rendered by miss pool threads by process.',
+           samples(metrics['gauges'], 'djmp_miss_pool_running'))
+    family('djmp_miss_pool_rejected_total', 'counter',
+           'Tile requests answered with 503 by tileset, reason="full" or "timeout".',
+           samples(metrics['counters'], 'djmp_miss_pool_rejected_total'))
+
+    histogram = []
+    for tileset_pk in sorted(metrics['histograms']):
+        for stage, hist in sorted(metrics['histograms'][tileset_pk].items()):
+            labels = {'tileset': tileset_pk, 'stage': stage}
+            cumulative = 0
+            for bound, count in zip(list(buckets_ms) + [None], hist['counts']):
+                cumulative += count
+                le = '+Inf' if bound is None else repr(bound / 1000.0)
+                histogram.append(('djmp_request_stage_seconds_bucket', dict(labels, le=le), cumulative))
+            histogram.append(('djmp_request_stage_seconds_sum', labels, hist['sum_ms'] / 1000.0))
+            histogram.append(('djmp_request_stage_seconds_count', labels, hist['count']))
+    family('djmp_request_stage_seconds', 'histogram',
+           'Duration of the tile request stages, stage="upstream" is the upstream fetch.', histogram)
+
+    family('djmp_seed_tiles_total', 'counter', 'Tiles seeded by tileset.',
+           samples(metrics['counters'], 'djmp_seed_tiles_total'))
+    family('djmp_seed_tiles_per_second', 'gauge', 'Current seed rate of running seed jobs.',
+           samples(metrics['gauges'], 'djmp_seed_tiles_per_second'))
+    family('djmp_seed_level', 'gauge', 'Zoom level running seed jobs are working on.',
+           samples(metrics['gauges'], 'djmp_seed_level'))
+    running = samples(metrics['gauges'], 'djmp_seed_running')
+    family('djmp_seed_running', 'gauge', 'Whether a seed job of the tileset is running.', running)
+    queued = samples(metrics['gauges'], 'djmp_seed_queued')
+    family('djmp_seed_jobs', 'gauge', 'Seed jobs by state, state="queued" are waiting in djmp_seed.', [
+        ('djmp_seed_jobs', {'state': 'queued'}, sum(v for n, labels, v in queued)),
+        ('djmp_seed_jobs', {'state': 'running'}, sum(1 for n, labels, v in running if v)),
+    ])
+    return '\n'.join(lines) + '\n'
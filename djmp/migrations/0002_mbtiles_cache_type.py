@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djmp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='tileset',
+            name='cache_type',
+            field=models.CharField(max_length=10, choices=[[b'file', b'file'], [b'mbtiles', b'mbtiles'], [b'geopackage', b'geopackage']]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djmp', '0002_mbtiles_cache_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tileset',
+            name='compact_version',
+            field=models.IntegerField(default=2, choices=[[1, b'ArcGIS bundle v1'], [2, b'ArcGIS bundle v2']]),
+        ),
+        migrations.AlterField(
+            model_name='tileset',
+            name='cache_type',
+            field=models.CharField(max_length=10, choices=[[b'file', b'file'], [b'mbtiles', b'mbtiles'], [b'geopackage', b'geopackage'], [b'compact', b'compact']]),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.core.validators
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djmp', '0003_compact_cache_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tileset',
+            name='image_colors',
+            field=models.IntegerField(default=256, validators=[django.core.validators.MinValueValidator(2), django.core.validators.MaxValueValidator(256)]),
+        ),
+        migrations.AddField(
+            model_name='tileset',
+            name='image_format',
+            field=models.CharField(default=b'png', max_length=10, choices=[[b'png', b'PNG (RGBA)'], [b'png8', b'PNG (paletted)'], [b'jpeg', b'JPEG'], [b'mixed', b'PNG where transparent, JPEG elsewhere']]),
+        ),
+        migrations.AddField(
+            model_name='tileset',
+            name='image_quantizer',
+            field=models.CharField(default=b'fastoctree', max_length=10, choices=[[b'fastoctree', b'fastoctree'], [b'mediancut', b'mediancut']]),
+        ),
+        migrations.AddField(
+            model_name='tileset',
+            name='jpeg_quality',
+            field=models.IntegerField(default=90, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(100)]),
+        ),
+    ]
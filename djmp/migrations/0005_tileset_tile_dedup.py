@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djmp', '0004_tileset_image_encoding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tileset',
+            name='tile_dedup',
+            field=models.CharField(default=b'none', max_length=10, choices=[[b'none', b'none'], [b'symlink', b'symlink (while seeding)'], [b'hardlink', b'hardlink (after seeding)']]),
+        ),
+    ]
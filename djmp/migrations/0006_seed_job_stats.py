@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djmp', '0005_tileset_tile_dedup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SeedJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('started_at', models.DateTimeField()),
+                ('finished_at', models.DateTimeField()),
+                ('workers', models.IntegerField(default=0)),
+                ('tiles', models.BigIntegerField(default=0)),
+                ('skipped', models.BigIntegerField(default=0)),
+                ('bytes', models.BigIntegerField(default=0)),
+                ('duration', models.FloatField(default=0)),
+                ('tiles_per_second', models.FloatField(default=0)),
+            ],
+            options={
+                'ordering': ['-started_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='SeedLevel',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('level', models.IntegerField()),
+                ('tiles', models.BigIntegerField(default=0)),
+                ('skipped', models.BigIntegerField(default=0)),
+                ('bytes', models.BigIntegerField(default=0)),
+                ('duration', models.FloatField(default=0)),
+                ('tiles_per_second', models.FloatField(default=0)),
+                ('upstream_requests', models.BigIntegerField(default=0)),
+                ('upstream_p50_ms', models.FloatField(null=True, blank=True)),
+                ('upstream_p95_ms', models.FloatField(null=True, blank=True)),
+                ('job', models.ForeignKey(related_name='levels', to='djmp.SeedJob')),
+            ],
+            options={
+                'ordering': ['level'],
+            },
+        ),
+        migrations.AddField(
+            model_name='seedjob',
+            name='tileset',
+            field=models.ForeignKey(related_name='seed_jobs', to='djmp.Tileset'),
+        ),
+    ]
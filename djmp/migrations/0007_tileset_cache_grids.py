@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djmp', '0006_seed_job_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tileset',
+            name='cache_grids',
+            field=models.CharField(default=b'EPSG3857', max_length=30, choices=[[b'EPSG3857', b'EPSG:3857'], [b'EPSG3857,EPSG4326', b'EPSG:3857 and EPSG:4326']]),
+        ),
+    ]
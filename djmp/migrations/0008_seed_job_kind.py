@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djmp', '0007_tileset_cache_grids'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='seedjob',
+            name='kind',
+            field=models.CharField(default=b'seed', max_length=10, choices=[[b'seed', b'seed'], [b'cleanup', b'cleanup']]),
+        ),
+    ]
@@ -0,0 +1,133 @@
+import logging
+import os
+import sys
+import threading
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from django.utils import six
+
+from .metrics import process_metrics
+from .settings import DJMP_MISS_POOL_TILESET_LIMIT, DJMP_MISS_POOL_TIMEOUT, DJMP_MISS_POOL_WORKERS
+
+log = logging.getLogger('djmapproxy')
+
+
+class MissPoolBusy(Exception):
+    pass
+
+
+class MissPoolFull(MissPoolBusy):
+    """The tileset has too many misses queued or running."""
+
+
+class MissPoolTimeout(MissPoolBusy):
+    """The miss was not answered in time, it keeps running in the pool."""
+
+
+class _Job(object):
+    def __init__(self, tileset_pk, func):
+        self.tileset_pk = tileset_pk
+        self.func = func
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class MissPool(object):
+    """
+    Renders tile cache misses on `workers` threads, so a slow upstream ties
+    up these threads instead of the request workers that also serve cache
+    hits. Each tileset may have `tileset_limit` misses queued or running, a
+    request waits at most `timeout` seconds for its miss. The threads are
+    started on first use in every process.
+    """
+    def __init__(self, workers, tileset_limit, timeout):
+        self.workers = workers
+        self.tileset_limit = tileset_limit
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._pending = {}
+        self._running = 0
+
+    @property
+    def enabled(self):
+        return self.workers > 0
+
+    def _start(self):
+        # threads do not survive a fork, every worker process starts its own
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._queue = Queue()
+        self._pending = {}
+        self._running = 0
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, args=(self._queue,), name='djmp-miss-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+
+    def _work(self, queue):
+        while True:
+            job = queue.get()
+            with self._lock:
+                self._running += 1
+                self._update_gauges()
+            try:
+                job.result = job.func()
+            except Exception:
+                job.exc_info = sys.exc_info()
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._pending[job.tileset_pk] -= 1
+                    if not self._pending[job.tileset_pk]:
+                        del self._pending[job.tileset_pk]
+                    self._update_gauges()
+                job.done.set()
+
+    def _update_gauges(self):
+        labels = {'pid': str(os.getpid())}
+        pending = sum(self._pending.values())
+        process_metrics.set_gauge('djmp_miss_pool_queued', labels, pending - self._running)
+        process_metrics.set_gauge('djmp_miss_pool_running', labels, self._running)
+
+    def run(self, tileset_pk, func):
+        """
+        Runs `func` on the pool and returns its result. Raises MissPoolFull
+        without running it if the tileset has too many misses pending, and
+        MissPoolTimeout if it did not return within the timeout.
+        """
+        with self._lock:
+            self._start()
+            if self._pending.get(tileset_pk, 0) >= self.tileset_limit:
+                process_metrics.inc('djmp_miss_pool_rejected_total', {'tileset': str(tileset_pk), 'reason': 'full'})
+                raise MissPoolFull('tileset {} has {} misses pending'.format(tileset_pk, self.tileset_limit))
+            self._pending[tileset_pk] = self._pending.get(tileset_pk, 0) + 1
+            job = _Job(tileset_pk, func)
+            self._queue.put(job)
+            self._update_gauges()
+
+        if not job.done.wait(self.timeout):
+            process_metrics.inc('djmp_miss_pool_rejected_total', {'tileset': str(tileset_pk), 'reason': 'timeout'})
+            raise MissPoolTimeout('miss of tileset {} took longer than {}s'.format(tileset_pk, self.timeout))
+        if job.exc_info is not None:
+            six.reraise(*job.exc_info)
+        return job.result
+
+    def depth(self):
+        """
+        Returns the misses queued and running in this process and the misses
+        pending by tileset.
+        """
+        with self._lock:
+            pending = sum(self._pending.values())
+            return {'queued': pending - self._running, 'running': self._running, 'tilesets': dict(self._pending)}
+
+
+miss_pool = MissPool(DJMP_MISS_POOL_WORKERS, DJMP_MISS_POOL_TILESET_LIMIT, DJMP_MISS_POOL_TIMEOUT)
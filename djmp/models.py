@@ -1,11 +1,9 @@
 import logging
 import helpers
-from pyproj import Proj, transform
 
 from django.db import models
 from django.core.validators import MaxValueValidator, MinValueValidator
 from guardian.shortcuts import assign_perm
-from mapproxy.seed.config import SeedConfigurationError, ConfigurationError
 
 from .settings import TILESET_CACHE_DIRECTORY
 
@@ -13,9 +11,20 @@ log = logging.getLogger('djmapproxy')
 
 CACHE_TYPES = [
     ['file', 'file'],
-    #['mbtiles','mbtiles'],
+    ['mbtiles', 'mbtiles'],
     #['sqllite', 'sqllite'],
-    ['geopackage', 'geopackage']
+    ['geopackage', 'geopackage'],
+    ['compact', 'compact']
+]
+
+JOB_KINDS = [
+    ['seed', 'seed'],
+    ['cleanup', 'cleanup']
+]
+
+COMPACT_VERSIONS = [
+    [1, 'ArcGIS bundle v1'],
+    [2, 'ArcGIS bundle v2']
 ]
 
 DIR_LAYOUTS = [
@@ -23,6 +32,31 @@ DIR_LAYOUTS = [
     ['tc', 'TileCache']
 ]
 
+IMAGE_FORMATS = [
+    ['png', 'PNG (RGBA)'],
+    ['png8', 'PNG (paletted)'],
+    ['jpeg', 'JPEG'],
+    ['mixed', 'PNG where transparent, JPEG elsewhere']
+]
+
+TILE_DEDUP = [
+    ['none', 'none'],
+    ['symlink', 'symlink (while seeding)'],
+    ['hardlink', 'hardlink (after seeding)']
+]
+
+# EPSG:3857 is always cached, tiles of the other grids are rendered natively
+# instead of being reprojected from mercator tiles at request time
+CACHE_GRIDS = [
+    ['EPSG3857', 'EPSG:3857'],
+    ['EPSG3857,EPSG4326', 'EPSG:3857 and EPSG:4326']
+]
+
+QUANTIZERS = [
+    ['fastoctree', 'fastoctree'],
+    ['mediancut', 'mediancut']
+]
+
 SOURCE_TYPES = [
     ['wms','wms'],
     ['tile', 'tile'],
@@ -58,10 +92,24 @@ class Tileset(models.Model):
     # file cache params
     directory_layout = models.CharField(max_length=20, choices=DIR_LAYOUTS, blank=True, null=True)
     directory = models.CharField(max_length=256, default=TILESET_CACHE_DIRECTORY, blank=True, null=True)
+    cache_grids = models.CharField(max_length=30, choices=CACHE_GRIDS, default='EPSG3857')
+    # uniform-colour tiles are stored once
+    tile_dedup = models.CharField(max_length=10, choices=TILE_DEDUP, default='none')
     # gpkg cache params
     filename = models.CharField(max_length=256, blank=True, null=True)
     table_name = models.CharField(max_length=128, blank=True, null=True)
 
+    # compact cache params
+    compact_version = models.IntegerField(default=2, choices=COMPACT_VERSIONS)
+
+    # image encoding
+    image_format = models.CharField(max_length=10, choices=IMAGE_FORMATS, default='png')
+    # png8 params
+    image_colors = models.IntegerField(default=256, validators = [MinValueValidator(2), MaxValueValidator(256)])
+    image_quantizer = models.CharField(max_length=10, choices=QUANTIZERS, default='fastoctree')
+    # jpeg and mixed params
+    jpeg_quality = models.IntegerField(default=90, validators = [MinValueValidator(1), MaxValueValidator(100)])
+
     # mapnik params
     mapfile = models.FileField(blank=True, null=True, upload_to='mapfiles')
 
@@ -98,8 +146,21 @@ class Tileset(models.Model):
         helpers.remove_lock_file(self.id)
         return res
 
-    def seed(self):
-        
+    def seed(self, force=False):
+        """
+        Starts seeding the tileset unless it is seeding already or, without
+        `force`, its seed estimate exceeds the seed budget.
+        """
+        from mapproxy.seed.config import SeedConfigurationError, ConfigurationError
+        from .seedestimate import budget_enabled, estimate_seed, over_budget
+
+        if not force and budget_enabled():
+            estimate = estimate_seed(self)
+            error = over_budget(estimate)
+            if error:
+                log.debug('tileset.seed, will NOT generate. {}'.format(error))
+                return {'status': 'unable to start', 'error': error, 'estimate': estimate}
+
         lock_file = helpers.get_lock_file(self)
         if lock_file:
             log.debug('generating tileset')
@@ -109,19 +170,52 @@ class Tileset(models.Model):
                 res = {'status': 'started'}
             except (SeedConfigurationError, ConfigurationError) as e:
                 log.error('Something went wrong when generating.. removing lock file')
+                helpers.remove_lock_file(self)
                 res = {'status': 'unable to start',
                        'error': e.message}
             finally:
+                # the seed process removes the lock file once it is done
                 lock_file.flush()
                 lock_file.close()
-                helpers.remove_lock_file(self)
         else:
             log.debug('tileset.generate, will NOT generate. already running, pid: {}'.format(helpers.get_pid_from_lock_file(self)))
             res = {'status': 'already started'}
 
         return res
 
+    def cleanup(self, remove_before=None):
+        """
+        Starts a job that removes the cached tiles outside the zoom range and
+        bbox of the tileset or written before the `remove_before` timestamp.
+        It shares the lock file of seeding, which the seed and cleanup
+        processes hold until they are done, so both never run at once.
+        """
+        from mapproxy.seed.config import SeedConfigurationError, ConfigurationError
+
+        lock_file = helpers.get_lock_file(self)
+        if lock_file:
+            log.debug('cleaning up tileset')
+            try:
+                pid = helpers.cleanup_process_spawn(self, remove_before)
+                lock_file.write("{}\n".format(pid))
+                res = {'status': 'started'}
+            except (SeedConfigurationError, ConfigurationError) as e:
+                log.error('Something went wrong when cleaning up.. removing lock file')
+                helpers.remove_lock_file(self)
+                res = {'status': 'unable to start',
+                       'error': e.message}
+            finally:
+                lock_file.flush()
+                lock_file.close()
+        else:
+            log.debug('tileset.cleanup, will NOT clean up. already running, pid: {}'.format(helpers.get_pid_from_lock_file(self)))
+            res = {'status': 'already started'}
+
+        return res
+
     def bbox_3857(self):
+        from pyproj import Proj, transform
+
         inProj = Proj(init='epsg:4326')
         outProj = Proj(init='epsg:3857')
 
@@ -146,3 +240,53 @@ class Tileset(models.Model):
         permissions = (
             ('view_tileset', 'View Tileset'),
         )
+
+
+class SeedJob(models.Model):
+    """
+    Statistics of a finished seed or cleanup run of a tileset. For cleanups
+    `tiles` and `bytes` are the removed tiles and the reclaimed bytes.
+    """
+    tileset = models.ForeignKey(Tileset, related_name='seed_jobs')
+    kind = models.CharField(max_length=10, choices=JOB_KINDS, default='seed')
+    started_at = models.DateTimeField()
+    finished_at = models.DateTimeField()
+    workers = models.IntegerField(default=0)
+    tiles = models.BigIntegerField(default=0)
+    skipped = models.BigIntegerField(default=0)
+    bytes = models.BigIntegerField(default=0)
+    # seconds
+    duration = models.FloatField(default=0)
+    tiles_per_second = models.FloatField(default=0)
+
+    def __unicode__(self):
+        return u'{} {}'.format(self.tileset, self.started_at)
+
+    class Meta:
+        ordering = ['-started_at']
+
+
+class SeedLevel(models.Model):
+    """
+    Statistics of one zoom level of a seed job. `duration` is the time the
+    workers spent rendering the level divided by the number of workers, as
+    the seeder works on all levels at once. `skipped` tiles were already
+    cached and are counted in whole meta tiles.
+    """
+    job = models.ForeignKey(SeedJob, related_name='levels')
+    level = models.IntegerField()
+    tiles = models.BigIntegerField(default=0)
+    skipped = models.BigIntegerField(default=0)
+    bytes = models.BigIntegerField(default=0)
+    # seconds
+    duration = models.FloatField(default=0)
+    tiles_per_second = models.FloatField(default=0)
+    upstream_requests = models.BigIntegerField(default=0)
+    upstream_p50_ms = models.FloatField(blank=True, null=True)
+    upstream_p95_ms = models.FloatField(blank=True, null=True)
+
+    def __unicode__(self):
+        return u'{} level {}'.format(self.job, self.level)
+
+    class Meta:
+        ordering = ['level']
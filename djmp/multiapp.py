@@ -0,0 +1,131 @@
+import logging
+import threading
+
+from .helpers import load_proxy_configuration
+from .mapproxy_config import (
+    cache_paths_use_cache_name, get_mapproxy_conf, get_multi_tileset_conf, multi_tileset_layer_name, u_to_str
+)
+from .settings import DJMP_MULTI_TILESET_APP, DJMP_MULTI_TILESET_APP_SHARDS
+from .tilecache import TILE_PATH_RE
+from .timing import time_upstream_requests
+
+log = logging.getLogger('djmapproxy')
+
+
+class _Shard(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.confs = {}
+        self.app = None
+        self.mapproxy_cf = None
+        self.failed = False
+        self.builds = 0
+
+
+class MultiTilesetApps(object):
+    """
+    Serves the tile requests of many tilesets from a few MapProxy apps that
+    share their services, grids and memory. Tilesets are spread over
+    `shards` apps by pk. An app is built with all tilesets of its shard and
+    only rebuilt when a requested tileset is new or its configuration
+    changed.
+    """
+    def __init__(self, shards, enabled=True):
+        self.enabled = enabled
+        self.shards = max(1, shards)
+        self._lock = threading.Lock()
+        self._shards = {}
+
+    def serves(self, tileset):
+        return self.enabled and not cache_paths_use_cache_name(tileset)
+
+    def _shard(self, pk):
+        with self._lock:
+            return self._shards.setdefault(pk % self.shards, _Shard())
+
+    def app(self, tileset):
+        """
+        Returns the MapProxy app (wrapped like views.get_mapproxy) serving
+        the tileset as layer multi_tileset_layer_name(pk), or None if the app
+        of its shard cannot be built.
+        """
+        # the YAML of get_mapproxy_conf is only parsed when the app is built
+        conf = get_mapproxy_conf(tileset)
+        shard = self._shard(tileset.pk)
+        with shard.lock:
+            if shard.confs.get(tileset.pk) != conf:
+                shard.app = None
+                shard.failed = False
+            if shard.app is None and not shard.failed:
+                try:
+                    shard.confs, shard.app, shard.mapproxy_cf = self._build(tileset.pk % self.shards, tileset, conf)
+                except Exception:
+                    # requests fall back to an app of their own tileset until
+                    # a tileset of the shard changes
+                    log.exception('unable to build the MapProxy app of shard {}'.format(tileset.pk % self.shards))
+                    shard.confs[tileset.pk] = conf
+                    shard.failed = True
+                shard.builds += 1
+            return shard.app
+
+    def tileset_cache(self, tileset):
+        """
+        Returns the cache configuration of the tileset in the app of its
+        shard, like mapproxy_cf.caches['tileset_cache'] of its own app, or
+        None without app.
+        """
+        shard = self._shard(tileset.pk)
+        with shard.lock:
+            if shard.app is None:
+                return None
+            return shard.mapproxy_cf.caches.get(multi_tileset_layer_name(tileset.pk) + '_cache')
+
+    def _build(self, shard_id, tileset, conf):
+        import yaml
+        from mapproxy.wsgiapp import MapProxyApp
+        from .models import Tileset
+        from .testapp import TestApp
+
+        confs = {tileset.pk: conf}
+        parsed = {tileset.pk: yaml.safe_load(conf)}
+        for other in Tileset.objects.exclude(pk=tileset.pk):
+            if other.pk % self.shards != shard_id or not self.serves(other):
+                continue
+            try:
+                confs[other.pk] = get_mapproxy_conf(other)
+                parsed[other.pk] = yaml.safe_load(confs[other.pk])
+            except Exception as e:
+                confs.pop(other.pk, None)
+                log.warn('tileset {} is not served by the multi tileset app: {}'.format(other.pk, e))
+
+        mapproxy_cf = load_proxy_configuration(get_multi_tileset_conf(parsed))
+        app = MapProxyApp(mapproxy_cf.configured_services(), mapproxy_cf.base_config)
+        time_upstream_requests(mapproxy_cf)
+        log.debug('built MapProxy app for tilesets {}'.format(sorted(confs)))
+        return confs, TestApp(app), mapproxy_cf
+
+    def clear(self):
+        with self._lock:
+            self._shards = {}
+
+    def stats(self):
+        with self._lock:
+            shards = dict(self._shards)
+        return dict(
+            (shard_id, {'tilesets': len(shard.confs), 'builds': shard.builds, 'failed': shard.failed})
+            for shard_id, shard in shards.items()
+        )
+
+
+def multi_tileset_path(tileset, path_info):
+    """
+    Returns the tms/wmts `path_info` of a tileset with the layer name of the
+    tileset in the multi tileset app, or None if it asks for another layer.
+    """
+    match = TILE_PATH_RE.match(path_info)
+    if match is None or match.group('layer') != u_to_str(tileset.name):
+        return None
+    return path_info[:match.start('layer')] + multi_tileset_layer_name(tileset.pk) + path_info[match.end('layer'):]
+
+
+multi_tileset_apps = MultiTilesetApps(DJMP_MULTI_TILESET_APP_SHARDS, enabled=DJMP_MULTI_TILESET_APP)
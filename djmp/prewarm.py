@@ -0,0 +1,84 @@
+import logging
+import time
+
+from .settings import DJMP_PREWARM_TILESETS
+
+log = logging.getLogger('djmapproxy')
+
+
+def most_requested_tilesets(limit=None):
+    """
+    Returns up to `limit` tilesets (all if None) ordered by their tile
+    requests in the collected metrics, tilesets without requests by pk.
+    """
+    from .metrics import collect
+    from .models import Tileset
+
+    requests = {}
+    try:
+        for name, labels, value in collect()['counters']:
+            if name == 'djmp_tile_requests_total':
+                requests[labels['tileset']] = requests.get(labels['tileset'], 0) + value
+    except (IOError, OSError) as ex:
+        log.warn('unable to read the request metrics: {}'.format(ex))
+
+    tilesets = sorted(Tileset.objects.order_by('pk'), key=lambda t: -requests.get(str(t.pk), 0))
+    return tilesets if limit is None else tilesets[:limit]
+
+
+def prewarm_tileset(tileset):
+    """
+    Builds and keeps the MapProxy app serving the tiles of a tileset in this
+    process, the multi tileset app of its shard if it is enabled.
+    """
+    from .multiapp import multi_tileset_apps
+    from .views import get_mapproxy
+
+    if multi_tileset_apps.serves(tileset) and multi_tileset_apps.app(tileset) is not None:
+        return
+    get_mapproxy(tileset)
+
+
+def prewarm(tilesets, progress=None):
+    """
+    Builds the apps of `tilesets`, calling `progress(tileset, result)` after
+    each one. Returns the number of apps built, failed and the total seconds.
+    """
+    summary = {'tilesets': 0, 'errors': 0, 'duration': 0.0}
+    start = time.time()
+    for tileset in tilesets:
+        tileset_start = time.time()
+        result = {'error': None}
+        try:
+            prewarm_tileset(tileset)
+        except Exception as e:
+            log.exception('unable to pre-warm tileset {}'.format(tileset.pk))
+            result['error'] = str(e)
+            summary['errors'] += 1
+        result['duration'] = time.time() - tileset_start
+        summary['tilesets'] += 1
+        if progress is not None:
+            progress(tileset, result)
+    summary['duration'] = time.time() - start
+    return summary
+
+
+def post_fork(server=None, worker=None):
+    """
+    Pre-warms the DJMP_PREWARM_TILESETS most requested tilesets in a freshly
+    forked worker, e.g. from gunicorn:
+
+        from djmp.prewarm import post_fork
+
+    or with uwsgidecorators.postfork(post_fork) in the uWSGI app module.
+    """
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        django.setup()
+    from .helpers import close_db_connections
+    close_db_connections()
+
+    summary = prewarm(most_requested_tilesets(DJMP_PREWARM_TILESETS))
+    log.info('pre-warmed {tilesets} tilesets in {duration:.3f}s, {errors} errors'.format(**summary))
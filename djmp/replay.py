@@ -0,0 +1,183 @@
+import random
+import re
+import threading
+import time
+
+try:
+    from urllib2 import HTTPError, Request, urlopen
+except ImportError:
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+
+from django.core.urlresolvers import reverse
+
+from .helpers import generate_confs
+from .seedstats import percentile
+from .tileranges import tile_ranges
+
+# the request path of common/combined log format lines, or a bare path per line
+LOG_PATH_RE = re.compile(r'"(?:GET|HEAD) (?P<path>\S+) HTTP/[0-9.]+"|^(?P<bare>/\S*)$')
+TILESET_PATH_RE = re.compile(r'/(?P<pk>\d+)/map(?P<path_info>/[^?]*)(?:\?(?P<query>.*))?$')
+
+
+def parse_log(lines):
+    """
+    Returns (tileset pk, path_info, query string) of the tileset_mapproxy
+    requests in an access log, in log order. The query string of WMS and
+    KVP requests is kept as logged, it is empty for tile paths.
+    """
+    requests = []
+    for line in lines:
+        match = LOG_PATH_RE.search(line.strip())
+        if match is None:
+            continue
+        tileset_match = TILESET_PATH_RE.search(match.group('path') or match.group('bare'))
+        if tileset_match is not None:
+            requests.append((
+                int(tileset_match.group('pk')), tileset_match.group('path_info'), tileset_match.group('query') or ''
+            ))
+    return requests
+
+
+def request_path(pk, path_info, query=''):
+    """
+    Returns the tileset_mapproxy path of a request returned by `parse_log`.
+    """
+    path = reverse('tileset_mapproxy', args=(pk, path_info))
+    return path + '?' + query if query else path
+
+
+def generate_sessions(tileset, sessions, steps, seed=0, viewport=(4, 3), ext='png'):
+    """
+    Returns the WMTS path_infos of `sessions` simulated users that each pan
+    or zoom `steps` times within the tileset bbox and request all tiles of
+    their viewport after every step. The sessions are interleaved step by
+    step.
+    """
+    rnd = random.Random(seed)
+    mapproxy_cf, seed_cf = generate_confs(tileset)
+    grid = mapproxy_cf.caches['tileset_cache'].caches()[0][0]
+    ranges = tile_ranges(tileset, grid)
+
+    def clamp(x, y, level):
+        x0, y0, x1, y1 = ranges[level]
+        return min(max(x, x0), x1), min(max(y, y0), y1)
+
+    def viewport_paths(x, y, level):
+        x0, y0, x1, y1 = ranges[level]
+        paths = []
+        for dy in range(-(viewport[1] // 2), viewport[1] - viewport[1] // 2):
+            for dx in range(-(viewport[0] // 2), viewport[0] - viewport[0] // 2):
+                tx, ty = x + dx, y + dy
+                if x0 <= tx <= x1 and y0 <= ty <= y1:
+                    paths.append('/wmts/{}/EPSG3857/{}/{}/{}.{}'.format(tileset.name, level, tx, ty, ext))
+        return paths
+
+    users = []
+    for i in range(sessions):
+        level = rnd.randint(tileset.layer_zoom_start, min(tileset.layer_zoom_start + 2, tileset.layer_zoom_stop))
+        x0, y0, x1, y1 = ranges[level]
+        users.append([rnd.randint(x0, x1), rnd.randint(y0, y1), level])
+
+    paths = []
+    for step in range(steps):
+        for user in users:
+            x, y, level = user
+            action = rnd.random()
+            if action < 0.25 and level < tileset.layer_zoom_stop:
+                x, y, level = x * 2 + rnd.randint(0, 1), y * 2 + rnd.randint(0, 1), level + 1
+            elif action < 0.4 and level > tileset.layer_zoom_start:
+                x, y, level = x // 2, y // 2, level - 1
+            else:
+                x, y = x + rnd.randint(-1, 1), y + rnd.randint(-1, 1)
+            x, y = clamp(x, y, level)
+            user[:] = [x, y, level]
+            paths.extend(viewport_paths(x, y, level))
+    return paths
+
+
+def http_sender(base_url, headers=None):
+    """
+    Returns a function that GETs a path from `base_url` and returns the
+    status code and the X-Djmp-Cache header.
+    """
+    base_url = base_url.rstrip('/')
+
+    def send(path):
+        request = Request(base_url + path, headers=headers or {})
+        try:
+            response = urlopen(request)
+        except HTTPError as ex:
+            response = ex
+        try:
+            response.read()
+            return response.getcode(), response.info().get('X-Djmp-Cache')
+        finally:
+            response.close()
+    return send
+
+
+def replay(paths, send, concurrency=8, rate=0):
+    """
+    Sends `paths` with `concurrency` threads, at most `rate` requests per
+    second if given, and reports throughput, latency and cache results.
+    """
+    lock = threading.Lock()
+    queue = list(reversed(paths))
+    latencies = []
+    statuses = {}
+    cache = {}
+    interval = 1.0 / rate if rate else 0
+    schedule = [time.time()]
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                path = queue.pop()
+                start_at = schedule[0]
+                schedule[0] = max(start_at, time.time()) + interval
+            wait = start_at - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            start = time.time()
+            try:
+                status, cache_status = send(path)
+            except Exception:
+                status, cache_status = 'error', None
+            ms = (time.time() - start) * 1000.0
+            with lock:
+                latencies.append(ms)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+                cache_status = cache_status or 'none'
+                cache[cache_status] = cache.get(cache_status, 0) + 1
+
+    started = time.time()
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - started
+
+    latencies.sort()
+    hits = sum(count for name, count in cache.items() if name.startswith('hit'))
+    tiles = sum(count for name, count in cache.items() if name != 'none')
+    return {
+        'requests': len(latencies),
+        'concurrency': concurrency,
+        'rate': rate,
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(len(latencies) / duration, 2) if duration else None,
+        'status': statuses,
+        'latency_ms': dict(
+            [(name, round(percentile(latencies, p), 3) if latencies else None)
+             for name, p in (('p50', 0.5), ('p90', 0.9), ('p95', 0.95), ('p99', 0.99))] +
+            [('max', round(latencies[-1], 3) if latencies else None),
+             ('mean', round(sum(latencies) / len(latencies), 3) if latencies else None)]
+        ),
+        'cache': cache,
+        'hit_ratio': round(float(hits) / tiles, 4) if tiles else None,
+    }
@@ -0,0 +1,104 @@
+from django.db.models import Sum
+
+from .mapproxy_config import cache_grids
+from .models import SeedJob, SeedLevel
+from .settings import (
+    DJMP_SEED_BUDGET_BYTES, DJMP_SEED_BUDGET_SECONDS, DJMP_SEED_BUDGET_TILES, DJMP_SEED_ESTIMATE_JOBS,
+    DJMP_SEED_ESTIMATE_TILE_BYTES, DJMP_SEED_ESTIMATE_TILES_PER_SECOND
+)
+from .tileranges import grid_bbox, level_tile_range, named_grid
+
+
+def level_tile_counts(tileset, zoom_start=None, zoom_stop=None):
+    """
+    Returns the number of tiles a seed renders per zoom level, over all
+    grids of the tileset. Every level is counted from the corners of its
+    tile range, so even a billion tiles take as long as a thousand.
+    """
+    zoom_start = tileset.layer_zoom_start if zoom_start is None else zoom_start
+    zoom_stop = tileset.layer_zoom_stop if zoom_stop is None else zoom_stop
+    counts = dict((level, 0) for level in range(zoom_start, zoom_stop + 1))
+    for name in cache_grids(tileset):
+        grid = named_grid(name)
+        bbox = grid_bbox(tileset, grid)
+        for level in counts:
+            x0, y0, x1, y1 = level_tile_range(grid, bbox, level)
+            counts[level] += (x1 - x0 + 1) * (y1 - y0 + 1)
+    return counts
+
+
+def seed_history(tileset, jobs=DJMP_SEED_ESTIMATE_JOBS):
+    """
+    Returns the tiles per second and bytes per tile of the last `jobs` seed
+    jobs of the tileset, of all tilesets if it was never seeded, overall and
+    per level.
+    """
+    history = {
+        'source': 'tileset',
+        'tiles_per_second': DJMP_SEED_ESTIMATE_TILES_PER_SECOND,
+        'bytes_per_tile': DJMP_SEED_ESTIMATE_TILE_BYTES,
+        'levels': {},
+    }
+    seed_jobs = SeedJob.objects.filter(kind='seed', tiles__gt=0)
+    recent = list(seed_jobs.filter(tileset=tileset)[:jobs])
+    if not recent:
+        history['source'] = 'all tilesets'
+        recent = list(seed_jobs[:jobs])
+    if not recent:
+        history['source'] = 'defaults'
+        return history
+
+    tiles = sum(job.tiles for job in recent)
+    duration = sum(job.duration for job in recent)
+    if duration:
+        history['tiles_per_second'] = tiles / duration
+    history['bytes_per_tile'] = sum(job.bytes for job in recent) / float(tiles)
+
+    levels = SeedLevel.objects.filter(job__in=recent, tiles__gt=0).values('level').annotate(
+        tiles=Sum('tiles'), bytes=Sum('bytes'), duration=Sum('duration'))
+    for level in levels:
+        history['levels'][level['level']] = {
+            'tiles_per_second': level['tiles'] / level['duration'] if level['duration'] else None,
+            'bytes_per_tile': level['bytes'] / float(level['tiles']),
+        }
+    return history
+
+
+def estimate_seed(tileset, zoom_start=None, zoom_stop=None):
+    """
+    Estimates the tiles, bytes and seconds of seeding the tileset, per zoom
+    level and in total, from the seed history of its levels or of whole jobs.
+    """
+    history = seed_history(tileset)
+    estimate = {'tiles': 0, 'bytes': 0, 'duration': 0.0, 'levels': {}, 'history': history['source']}
+    for level, tiles in sorted(level_tile_counts(tileset, zoom_start, zoom_stop).items()):
+        level_history = history['levels'].get(level, {})
+        tiles_per_second = level_history.get('tiles_per_second') or history['tiles_per_second']
+        bytes_per_tile = level_history.get('bytes_per_tile', history['bytes_per_tile'])
+        level_estimate = {
+            'tiles': tiles,
+            'bytes': int(tiles * bytes_per_tile),
+            'duration': round(tiles / tiles_per_second, 3),
+        }
+        estimate['levels'][level] = level_estimate
+        for key, value in level_estimate.items():
+            estimate[key] += value
+    estimate['duration'] = round(estimate['duration'], 3)
+    return estimate
+
+
+def over_budget(estimate):
+    """
+    Returns why a seed estimate exceeds the seed budget, or None.
+    """
+    for key, budget, unit in (('tiles', DJMP_SEED_BUDGET_TILES, 'tiles'),
+                              ('bytes', DJMP_SEED_BUDGET_BYTES, 'bytes'),
+                              ('duration', DJMP_SEED_BUDGET_SECONDS, 'seconds')):
+        if budget is not None and estimate[key] > budget:
+            return 'estimated {} {} exceed the seed budget of {} {}'.format(estimate[key], unit, budget, unit)
+    return None
+
+
+def budget_enabled():
+    return any(budget is not None for budget in (
+        DJMP_SEED_BUDGET_TILES, DJMP_SEED_BUDGET_BYTES, DJMP_SEED_BUDGET_SECONDS))
@@ -0,0 +1,37 @@
+import time
+
+from mapproxy.seed import util
+
+from .metrics import process_metrics
+
+
+class SeedProgressLog(util.ProgressLog):
+    """
+    Progress log of the seed process that also reports the seeded tiles
+    and the current seed rate to the metrics, and to `on_tiles(count)`.
+    """
+    def __init__(self, tileset_pk, *args, **kwargs):
+        self.on_tiles = kwargs.pop('on_tiles', None)
+        util.ProgressLog.__init__(self, *args, **kwargs)
+        self.labels = {'tileset': str(tileset_pk)}
+        self._last_tiles = 0
+        self._last_time = time.time()
+
+    def log_progress(self, progress, level, bbox, tiles):
+        util.ProgressLog.log_progress(self, progress, level, bbox, tiles)
+        if tiles < self._last_tiles:
+            # the tile count starts again for each seed task
+            self._last_tiles = 0
+        now = time.time()
+        new_tiles = tiles - self._last_tiles
+        if new_tiles:
+            process_metrics.inc('djmp_seed_tiles_total', self.labels, new_tiles)
+            if self.on_tiles is not None:
+                self.on_tiles(new_tiles)
+        if now > self._last_time:
+            process_metrics.set_gauge('djmp_seed_tiles_per_second', self.labels,
+                                      new_tiles / (now - self._last_time))
+        process_metrics.set_gauge('djmp_seed_level', self.labels, level)
+        self._last_tiles = tiles
+        self._last_time = now
+        process_metrics.maybe_flush()
@@ -0,0 +1,176 @@
+import logging
+import os
+import random
+import shutil
+import time
+from multiprocessing.util import Finalize
+
+from .fileutils import makedirs, read_json, write_json
+
+log = logging.getLogger('djmapproxy')
+
+
+def _empty_level():
+    return {'tiles': 0, 'skipped': 0, 'bytes': 0, 'seconds': 0.0, 'upstream_requests': 0, 'upstream_ms': []}
+
+
+class SeedStats(object):
+    """
+    Per zoom level counts of one seed job. The seed process counts the tiles
+    it skips because they are cached, each forked worker counts the tiles it
+    rendered, their size, the time it spent on them and the upstream response
+    times, and writes them to `<directory>/<pid>.json` when it exits.
+    """
+    def __init__(self, directory, max_samples):
+        self.directory = directory
+        self.max_samples = max_samples
+        self.levels = {}
+        self.current_level = None
+        self._pid = os.getpid()
+
+    def _check_pid(self):
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self.levels = {}
+            Finalize(None, self.flush, exitpriority=10)
+
+    def level(self, level):
+        self._check_pid()
+        stats = self.levels.get(level)
+        if stats is None:
+            stats = self.levels[level] = _empty_level()
+        return stats
+
+    def add_upstream(self, level, ms):
+        stats = self.level(level)
+        stats['upstream_requests'] += 1
+        samples = stats['upstream_ms']
+        if len(samples) < self.max_samples:
+            samples.append(ms)
+        else:
+            # keep a uniform sample of all requests
+            i = random.randint(0, stats['upstream_requests'] - 1)
+            if i < self.max_samples:
+                samples[i] = ms
+
+    def flush(self):
+        if not self.levels:
+            return
+        try:
+            makedirs(self.directory)
+            write_json(os.path.join(self.directory, '{}.json'.format(os.getpid())), self.levels)
+        except (IOError, OSError) as ex:
+            log.warn('unable to write seed statistics to {}: {}'.format(self.directory, ex))
+
+    def collect(self):
+        """
+        Adds up the statistics of this process and of all workers that
+        wrote theirs. Returns the levels and the number of workers.
+        """
+        levels = {}
+        workers = 0
+        parts = [self.levels]
+        if os.path.isdir(self.directory):
+            for name in sorted(os.listdir(self.directory)):
+                data = read_json(os.path.join(self.directory, name)) if name.endswith('.json') else None
+                if data is not None:
+                    parts.append(data)
+                    workers += 1
+        for part in parts:
+            for level, stats in part.items():
+                total = levels.setdefault(int(level), _empty_level())
+                for key, value in stats.items():
+                    total[key] += value
+        return levels, workers
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def record_seed_stats(tasks, stats):
+    """
+    Instruments the tile managers of the seed tasks to count into `stats`.
+    Has to be called in the seed process before seeding starts, so the forked
+    workers inherit it.
+    """
+    seed_pid = os.getpid()
+    for task in tasks:
+        tile_manager = task.tile_manager
+        if 'load_tile_coords' in vars(tile_manager):
+            continue
+        meta_size = tile_manager.meta_grid.meta_size if tile_manager.meta_grid else (1, 1)
+        tile_manager.load_tile_coords = _timed_load(tile_manager.load_tile_coords, stats)
+        tile_manager.is_cached = _counted_is_cached(
+            tile_manager.is_cached, stats, seed_pid, meta_size[0] * meta_size[1])
+        cache = tile_manager.cache
+        cache.store_tiles = _counted_store(cache.store_tiles, stats)
+        cache.store_tile = _counted_store(cache.store_tile, stats, single=True)
+        for source in tile_manager.sources:
+            http_client = getattr(getattr(source, 'client', None), 'http_client', None)
+            if http_client is not None:
+                http_client.open = _timed_open(http_client.open, stats)
+    return tasks
+
+
+def _timed_load(load_func, stats):
+    def load_tile_coords(tile_coords, *args, **kwargs):
+        level = stats.current_level = tile_coords[0][2]
+        start = time.time()
+        try:
+            return load_func(tile_coords, *args, **kwargs)
+        finally:
+            stats.level(level)['seconds'] += time.time() - start
+            stats.current_level = None
+    return load_tile_coords
+
+
+def _counted_is_cached(is_cached_func, stats, seed_pid, tiles_per_metatile):
+    def is_cached(tile, *args, **kwargs):
+        cached = is_cached_func(tile, *args, **kwargs)
+        # only the tile walker of the seed process, the workers check again
+        # before rendering
+        if cached and os.getpid() == seed_pid:
+            coord = tile if isinstance(tile, tuple) else tile.coord
+            if coord is not None:
+                stats.level(coord[2])['skipped'] += tiles_per_metatile
+        return cached
+    return is_cached
+
+
+def _counted_store(store_func, stats, single=False):
+    def store(tiles):
+        if getattr(stats, '_storing', False):
+            # store_tiles of some caches calls store_tile
+            return store_func(tiles)
+        new_tiles = [t for t in ([tiles] if single else tiles) if not t.stored]
+        stats._storing = True
+        try:
+            return store_func(tiles)
+        finally:
+            stats._storing = False
+            for tile in new_tiles:
+                if tile.stored and tile.coord is not None:
+                    level = stats.level(tile.coord[2])
+                    level['tiles'] += 1
+                    level['bytes'] += tile.size or 0
+    return store
+
+
+def _timed_open(open_func, stats):
+    def open(*args, **kwargs):
+        level = stats.current_level
+        if level is None:
+            return open_func(*args, **kwargs)
+        start = time.time()
+        try:
+            return open_func(*args, **kwargs)
+        finally:
+            stats.add_upstream(level, (time.time() - start) * 1000.0)
+    return open
@@ -87,3 +87,117 @@ ENABLE_GUARDIAN_PERMISSIONS = getattr(settings, 'ENABLE_GUARDIAN_PERMISSIONS', F
 
 DJMP_AUTHORIZATION_CLASS =  'djmp.guardian_auth.GuardianAuthorization' if ENABLE_GUARDIAN_PERMISSIONS else getattr(
     settings, 'DJMP_AUTHORIZATION_CLASS', 'tastypie.authorization.DjangoAuthorization')
+
+# Per-process LRU of encoded tile bodies checked before MapProxy dispatch. Set the
+# size to 0 to disable it.
+DJMP_HOT_TILE_CACHE_BYTES = getattr(settings, 'DJMP_HOT_TILE_CACHE_BYTES', 32 * 1024 * 1024)
+DJMP_HOT_TILE_CACHE_MAX_TILE_BYTES = getattr(settings, 'DJMP_HOT_TILE_CACHE_MAX_TILE_BYTES', 256 * 1024)
+
+# Optional tile cache shared by all worker processes, backed by one of the
+# configured Django CACHES aliases. Tiles are stored for TIMEOUT seconds and at
+# most MAX_TILESET_BYTES are written per tileset and seed generation. Workers
+# asking for a tile another worker is rendering wait up to LOCK_WAIT seconds.
+DJMP_SHARED_TILE_CACHE = getattr(settings, 'DJMP_SHARED_TILE_CACHE', None)
+DJMP_SHARED_TILE_CACHE_TIMEOUT = getattr(settings, 'DJMP_SHARED_TILE_CACHE_TIMEOUT', 24 * 60 * 60)
+DJMP_SHARED_TILE_CACHE_MAX_TILESET_BYTES = getattr(settings, 'DJMP_SHARED_TILE_CACHE_MAX_TILESET_BYTES', 256 * 1024 * 1024)
+DJMP_SHARED_TILE_CACHE_LOCK_TIMEOUT = getattr(settings, 'DJMP_SHARED_TILE_CACHE_LOCK_TIMEOUT', 30)
+DJMP_SHARED_TILE_CACHE_LOCK_WAIT = getattr(settings, 'DJMP_SHARED_TILE_CACHE_LOCK_WAIT', 2.0)
+
+# Seed workers writing to MBTiles caches commit after this many tiles or seconds.
+DJMP_MBTILES_SEED_BATCH_SIZE = getattr(settings, 'DJMP_MBTILES_SEED_BATCH_SIZE', 512)
+DJMP_MBTILES_SEED_FLUSH_INTERVAL = getattr(settings, 'DJMP_MBTILES_SEED_FLUSH_INTERVAL', 5)
+
+# Tiles larger than this are never considered by the hardlink dedup pass that
+# runs after seeding; uniform tiles encode to a few hundred bytes.
+DJMP_TILE_DEDUP_MAX_TILE_BYTES = getattr(settings, 'DJMP_TILE_DEDUP_MAX_TILE_BYTES', 8192)
+
+# Add a Server-Timing header with the duration of each stage (permission check,
+# tileset query, config build, MapProxy, upstream fetch, ...) to tile responses.
+DJMP_SERVER_TIMING = getattr(settings, 'DJMP_SERVER_TIMING', False)
+
+# Every process writes its tile and seed metrics to this directory at most every
+# FLUSH_INTERVAL seconds; the metrics view adds them up.
+DJMP_METRICS_DIR = getattr(settings, 'DJMP_METRICS_DIR', os.path.join(BASE_DIR, 'cache/metrics'))
+DJMP_METRICS_FLUSH_INTERVAL = getattr(settings, 'DJMP_METRICS_FLUSH_INTERVAL', 5)
+
+# Seed jobs keep at most this many upstream response times per zoom level and
+# worker to compute the p50/p95 stored with the job statistics.
+DJMP_SEED_STATS_MAX_SAMPLES = getattr(settings, 'DJMP_SEED_STATS_MAX_SAMPLES', 1000)
+
+# Tile requests are counted per tile in a heat map file next to each tileset,
+# written at most every FLUSH_INTERVAL seconds. The warming job (djmp_warm, admin
+# action) seeds the WARM_TILES most requested tiles and WARM_LEVELS zoom levels
+# below them.
+DJMP_HEAT_MAP = getattr(settings, 'DJMP_HEAT_MAP', True)
+DJMP_HEAT_MAP_FLUSH_INTERVAL = getattr(settings, 'DJMP_HEAT_MAP_FLUSH_INTERVAL', 10)
+DJMP_WARM_TILES = getattr(settings, 'DJMP_WARM_TILES', 100)
+DJMP_WARM_LEVELS = getattr(settings, 'DJMP_WARM_LEVELS', 1)
+
+# Cleanup jobs walk the directories of file caches with this many threads.
+DJMP_CLEANUP_CONCURRENCY = getattr(settings, 'DJMP_CLEANUP_CONCURRENCY', 4)
+
+# Serve the tile requests of all tilesets from one MapProxy app per shard that
+# keeps its services, grids, sources and caches between requests, instead of
+# an app per tileset. Tilesets are assigned to SHARDS apps by pk.
+DJMP_MULTI_TILESET_APP = getattr(settings, 'DJMP_MULTI_TILESET_APP', False)
+DJMP_MULTI_TILESET_APP_SHARDS = getattr(settings, 'DJMP_MULTI_TILESET_APP_SHARDS', 1)
+
+# Every process keeps the MapProxy apps of this many recently requested tilesets
+# and builds them again when the tileset configuration changes. 0 builds an app
+# for every request. djmp_prewarm and djmp.prewarm.post_fork build the apps of the
+# PREWARM_TILESETS most requested tilesets (all if None) before a worker serves.
+DJMP_TILESET_APP_CACHE_SIZE = getattr(settings, 'DJMP_TILESET_APP_CACHE_SIZE', 64)
+DJMP_PREWARM_TILESETS = getattr(settings, 'DJMP_PREWARM_TILESETS', 64)
+
+# Number of tilesets djmp_seed seeds at once, each in a process of its own.
+DJMP_BATCH_SEED_CONCURRENCY = getattr(settings, 'DJMP_BATCH_SEED_CONCURRENCY', 2)
+
+# Render tile cache misses on a pool of this many threads per process, so slow
+# upstream responses do not hold the request workers that serve cache hits. 0
+# renders them in the request thread. A tileset may have TILESET_LIMIT misses
+# queued or running, further misses and misses that take longer than TIMEOUT
+# seconds are answered with 503 (the tile is still cached once rendered).
+DJMP_MISS_POOL_WORKERS = getattr(settings, 'DJMP_MISS_POOL_WORKERS', 0)
+DJMP_MISS_POOL_TILESET_LIMIT = getattr(settings, 'DJMP_MISS_POOL_TILESET_LIMIT', 8)
+DJMP_MISS_POOL_TIMEOUT = getattr(settings, 'DJMP_MISS_POOL_TIMEOUT', 10.0)
+
+# Most tiles one request to the batch tile endpoint (/<id>/tiles) may ask for.
+DJMP_BATCH_TILES_MAX = getattr(settings, 'DJMP_BATCH_TILES_MAX', 1024)
+
+# Exports (/<id>/export, djmp_export) read and write this many tiles at a time
+# and refuse to export more than MAX_TILES tiles per request. Missing tiles are
+# rendered by RENDER_CONCURRENCY threads when asked for.
+DJMP_EXPORT_BATCH_SIZE = getattr(settings, 'DJMP_EXPORT_BATCH_SIZE', 256)
+DJMP_EXPORT_MAX_TILES = getattr(settings, 'DJMP_EXPORT_MAX_TILES', 100000)
+DJMP_EXPORT_RENDER_CONCURRENCY = getattr(settings, 'DJMP_EXPORT_RENDER_CONCURRENCY', 4)
+
+# Processes and tiles per write of djmp_import.
+DJMP_IMPORT_CONCURRENCY = getattr(settings, 'DJMP_IMPORT_CONCURRENCY', 4)
+DJMP_IMPORT_BATCH_SIZE = getattr(settings, 'DJMP_IMPORT_BATCH_SIZE', 256)
+
+# Every tileset keeps an index of the tiles in its EPSG:3857 cache next to it,
+# built on its next seed, import or djmp_index and kept up to date by them and
+# by the tiles rendered on request (added at most every FLUSH_INTERVAL seconds).
+# Tile requests read it through a per process LRU of CACHED_BLOCKS blocks of
+# 256x256 tiles. With EMPTY_TILES tiles missing from the index of a tileset
+# are answered with 404 instead of being rendered.
+DJMP_TILE_INDEX = getattr(settings, 'DJMP_TILE_INDEX', True)
+DJMP_TILE_INDEX_FLUSH_INTERVAL = getattr(settings, 'DJMP_TILE_INDEX_FLUSH_INTERVAL', 10)
+DJMP_TILE_INDEX_CACHED_BLOCKS = getattr(settings, 'DJMP_TILE_INDEX_CACHED_BLOCKS', 256)
+DJMP_TILE_INDEX_EMPTY_TILES = getattr(settings, 'DJMP_TILE_INDEX_EMPTY_TILES', False)
+
+# Answer tile requests outside the bbox or zoom range of a tileset without
+# MapProxy: 'transparent' sends a transparent png (a 404 for jpeg tiles), '404'
+# a 404. None passes them on to MapProxy, which renders them from the source.
+DJMP_OUT_OF_BOUNDS_TILES = getattr(settings, 'DJMP_OUT_OF_BOUNDS_TILES', None)
+
+# Seed estimates (/<id>/estimate, admin action) use the throughput and tile sizes
+# of the last ESTIMATE_JOBS seed jobs of a tileset, or of all tilesets if it was
+# never seeded, and these defaults before the first seed job. Tileset.seed()
+# refuses seeds estimated above one of the BUDGET_* limits (None for no limit).
+DJMP_SEED_ESTIMATE_JOBS = getattr(settings, 'DJMP_SEED_ESTIMATE_JOBS', 5)
+DJMP_SEED_ESTIMATE_TILES_PER_SECOND = getattr(settings, 'DJMP_SEED_ESTIMATE_TILES_PER_SECOND', 20.0)
+DJMP_SEED_ESTIMATE_TILE_BYTES = getattr(settings, 'DJMP_SEED_ESTIMATE_TILE_BYTES', 15000)
+DJMP_SEED_BUDGET_TILES = getattr(settings, 'DJMP_SEED_BUDGET_TILES', None)
+DJMP_SEED_BUDGET_BYTES = getattr(settings, 'DJMP_SEED_BUDGET_BYTES', None)
+DJMP_SEED_BUDGET_SECONDS = getattr(settings, 'DJMP_SEED_BUDGET_SECONDS', None)
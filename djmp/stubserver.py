@@ -0,0 +1,110 @@
+import threading
+import time
+import zlib
+from io import BytesIO
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qsl
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qsl
+
+from PIL import Image
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _encoded_image(width, height, image_format, color=(70, 130, 180)):
+    img = Image.new('RGBA', (width, height), color + (255,))
+    # a diagonal so the tiles are not single coloured
+    for i in range(min(width, height)):
+        img.putpixel((i, i), (255, 255, 255, 255))
+    buf = BytesIO()
+    if image_format == 'jpeg':
+        img.convert('RGB').save(buf, 'jpeg')
+    else:
+        img.save(buf, 'png')
+    return buf.getvalue()
+
+
+class StubUpstream(object):
+    """
+    Local stand-in for the WMS or tile server of a tileset. Answers every
+    request with the same image after `latency` seconds, so tile serving and
+    seeding can be measured without network noise. With `bbox_colors` the
+    colour of the image is derived from the requested BBOX instead.
+
+        upstream = StubUpstream(latency=0.02).start()
+        tileset.server_url = upstream.url
+        ...
+        upstream.stop()
+    """
+    def __init__(self, latency=0.0, host='127.0.0.1', port=0, bbox_colors=False):
+        self.latency = latency
+        self.bbox_colors = bbox_colors
+        self.requests = 0
+        self._images = {}
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    def image(self, width, height, image_format, bbox=None):
+        key = (width, height, image_format, bbox if self.bbox_colors else None)
+        if key not in self._images:
+            if key[3] is None:
+                self._images[key] = _encoded_image(width, height, image_format)
+            else:
+                crc = zlib.crc32(key[3].encode('utf-8')) & 0xffffff
+                color = (crc >> 16, (crc >> 8) & 0xff, crc & 0xff)
+                self._images[key] = _encoded_image(width, height, image_format, color)
+        return self._images[key]
+
+    def _handler_class(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with upstream._lock:
+                    upstream.requests += 1
+                params = dict((k.lower(), v) for k, v in parse_qsl(urlparse(self.path).query))
+                try:
+                    width = int(params.get('width', 256))
+                    height = int(params.get('height', 256))
+                except ValueError:
+                    width = height = 256
+                image_format = 'jpeg' if 'jpeg' in params.get('format', '') else 'png'
+                body = upstream.image(width, height, image_format, params.get('bbox'))
+                if upstream.latency:
+                    time.sleep(upstream.latency)
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/' + image_format)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
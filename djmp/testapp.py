@@ -0,0 +1,11 @@
+from webtest import TestApp as TestApp_
+
+
+class TestApp(TestApp_):
+    """
+    Wraps webtest.TestApp and explicitly converts URLs to strings.
+    Behavior changed with webtest from 1.2->1.3.
+    """
+    def get(self, url, *args, **kw):
+        kw['expect_errors'] = True
+        return TestApp_.get(self, str(url), *args, **kw)
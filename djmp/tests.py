@@ -1,13 +1,69 @@
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+import yaml
+from PIL import Image
+from mapproxy.cache.tile import Tile
+from mapproxy.config.loader import ConfigurationError
+from mapproxy.image import ImageSource
+from mapproxy.seed.seeder import SeedProgress
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase
 from django.test.client import Client
 from django.test.utils import override_settings
 from django.core.urlresolvers import reverse
+from django.utils import timezone
+from django.utils.six import StringIO
 from django.contrib.auth.models import User
 from guardian.management import create_anonymous_user
 from guardian.shortcuts import remove_perm
 
-from .views import tileset_status, seed
-from .models import Tileset
+from .appcache import TilesetAppCache, tileset_apps
+from .batchseed import batch_seed, seed_tileset
+from .cleanup import cleanup_mbtiles
+from .compact import read_bundle_tile
+from .heatmap import (
+    TileHits, get_heat_map_filename, hot_tiles, internal_tile_coord, tile_hits, warm_process_spawn, warm_tileset
+)
+from .helpers import (
+    cleanup_tiles, dedup_tiles, estimate_encoding_savings, generate_confs, get_dedup_stats, get_encoding_savings,
+    get_lock_file, get_lock_filename, get_seed_generation, get_status, get_tileset_location, get_tileset_stats,
+    record_encoding_savings, remove_lock_file, seed_process_target
+)
+from .mapproxy_config import get_grid_cache_directory, get_mapproxy_conf
+from .mbtiles import BatchedMBTilesCache, prepare_mbtiles
+from .metrics import ProcessMetrics, collect, process_metrics, render_metrics
+from .misspool import MissPool
+from .replay import generate_sessions, parse_log, replay, request_path
+from . import helpers, seedestimate
+from .seedestimate import estimate_seed, level_tile_counts
+from .seedprogress import SeedProgressLog
+from .settings import DJMP_SEED_ESTIMATE_TILE_BYTES
+from .stubserver import StubUpstream
+from . import timing, views
+from .timing import LATENCY_BUCKETS_MS, RequestTiming, latency_histograms
+from .views import get_mapproxy, tileset_status, seed
+from .models import SeedJob, Tileset
+from .multiapp import MultiTilesetApps, multi_tileset_apps
+from .prewarm import most_requested_tilesets, prewarm
+from . import tilecache
+from .tileimport import import_tiles, tile_source
+from .tileranges import tile_ranges, tileset_ranges
+from .tileindex import (
+    add_tiles, build_tile_index, ensure_tile_index, get_tile_index_filename, index_levels, tile_index_writer,
+    tile_indexes
+)
+from .tilecache import TileLRUCache, SharedTileCache, hot_tile_cache, parse_tile_path
 
 
 class DjmpTestBase(TestCase):
@@ -16,6 +72,7 @@ class DjmpTestBase(TestCase):
     def setUp(self):
         super(DjmpTestBase, self).setUp()
         create_anonymous_user(None)
+        tileset_apps.clear()
 
         self.user = 'admin'
         self.passwd = 'admin'
@@ -47,6 +104,1607 @@ class DjmpTest(DjmpTestBase):
         self.assertEqual(res.status_code, 404)
 
 
+class HotTileCacheTest(DjmpTestBase):
+    def setUp(self):
+        super(HotTileCacheTest, self).setUp()
+        hot_tile_cache.clear()
+
+    def test_parse_tile_path(self):
+        self.assertEqual(
+            parse_tile_path('/tms/1.0.0/streams/EPSG3857/1/0/0.png'),
+            ('tms', 'EPSG3857', 1, 0, 0, 'png')
+        )
+        self.assertEqual(
+            parse_tile_path('/wmts/streams/EPSG3857/3/2/1.png'),
+            ('wmts', 'EPSG3857', 3, 2, 1, 'png')
+        )
+        self.assertEqual(parse_tile_path('/service'), None)
+        self.assertEqual(parse_tile_path('/tms/1.0.0/'), None)
+
+    def test_lru_eviction_by_bytes(self):
+        cache = TileLRUCache(max_bytes=3 * (100 + 256), max_tile_bytes=1000)
+        for y in range(3):
+            cache.set(1, ('wmts', 'EPSG3857', 1, 0, y, 'png'), 'x' * 100, [])
+        # touch the oldest entry, so the second one gets evicted next
+        cache.get(1, ('wmts', 'EPSG3857', 1, 0, 0, 'png'))
+        cache.set(1, ('wmts', 'EPSG3857', 1, 0, 3, 'png'), 'x' * 100, [])
+
+        self.assertNotEqual(cache.get(1, ('wmts', 'EPSG3857', 1, 0, 0, 'png')), None)
+        self.assertEqual(cache.get(1, ('wmts', 'EPSG3857', 1, 0, 1, 'png')), None)
+        self.assertEqual(cache.stats()['entries'], 3)
+        self.assertTrue(cache.stats()['bytes'] <= cache.max_bytes)
+        self.assertFalse(cache.set(1, ('wmts', 'EPSG3857', 1, 0, 4, 'png'), 'x' * 1001, []))
+
+    def test_generation_change_invalidates(self):
+        cache = TileLRUCache(max_bytes=10000, max_tile_bytes=1000)
+        cache.check_generation(1, None)
+        cache.set(1, ('wmts', 'EPSG3857', 1, 0, 0, 'png'), 'a', [])
+        cache.set(2, ('wmts', 'EPSG3857', 1, 0, 0, 'png'), 'b', [])
+        cache.check_generation(1, 1466495104.0)
+
+        self.assertEqual(cache.get(1, ('wmts', 'EPSG3857', 1, 0, 0, 'png')), None)
+        self.assertEqual(cache.get(2, ('wmts', 'EPSG3857', 1, 0, 0, 'png'))[0], 'b')
+        self.assertEqual(cache.stats(1)['bytes'], 0)
+
+    def test_tile_view_served_from_cache(self):
+        uri = reverse(
+            'tileset_mapproxy',
+            args=(1, u'/tms/1.0.0/streams/EPSG3857/1/0/0.png')
+        )
+        self.client.login(username='admin', password='admin')
+        res = self.client.get(uri, **self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['X-Djmp-Cache'], 'miss')
+
+        cached = self.client.get(uri, **self.headers)
+        self.assertEqual(cached['X-Djmp-Cache'], 'hit')
+        self.assertEqual(cached.content, res.content)
+        self.assertEqual(cached['Content-Type'], 'image/png')
+        self.assertEqual(hot_tile_cache.stats(1)['hits'], 1)
+
+    def test_tms_and_wmts_tiles_are_cached_apart(self):
+        upstream = StubUpstream(bbox_colors=True).start()
+        self.addCleanup(upstream.stop)
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        tileset = Tileset.objects.get(pk=1)
+        tileset.server_url = upstream.url
+        tileset.directory = tmp_dir
+        tileset.save()
+        self.client.login(username='admin', password='admin')
+
+        # the same tile, tms counts rows from the south and levels from 0
+        wmts = self.client.get(
+            reverse('tileset_mapproxy', args=(1, u'/wmts/streams/EPSG3857/6/49/32.png')), **self.headers)
+        tms = self.client.get(
+            reverse('tileset_mapproxy', args=(1, u'/tms/1.0.0/streams/EPSG3857/5/49/31.png')), **self.headers)
+        self.assertEqual(wmts.status_code, 200)
+        self.assertEqual(tms.status_code, 200)
+        self.assertEqual(tms['X-Djmp-Cache'], 'miss')
+        self.assertEqual(tms.content, wmts.content)
+        self.assertEqual(upstream.requests, 1)
+        mapproxy_cf, seed_cf = generate_confs(tileset)
+        tile_manager = mapproxy_cf.caches['tileset_cache'].caches()[0][2]
+        with open(tile_manager.cache.tile_location(Tile((49, 32, 6))), 'rb') as f:
+            self.assertEqual(wmts.content, f.read())
+
+        # a tms request for the wmts coordinates is another tile
+        other = self.client.get(
+            reverse('tileset_mapproxy', args=(1, u'/tms/1.0.0/streams/EPSG3857/6/49/32.png')), **self.headers)
+        self.assertEqual(other['X-Djmp-Cache'], 'miss')
+        self.assertNotEqual(other.content, wmts.content)
+        self.assertEqual(hot_tile_cache.stats(1)['entries'], 3)
+
+        # the cached tiles are not served for another layer
+        bogus = self.client.get(
+            reverse('tileset_mapproxy', args=(1, u'/wmts/rivers/EPSG3857/6/49/32.png')), **self.headers)
+        self.assertNotEqual(bogus.status_code, 200)
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'tiles': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'djmp-tiles'},
+})
+class SharedTileCacheTest(DjmpTestBase):
+    def setUp(self):
+        super(SharedTileCacheTest, self).setUp()
+        self.cache = SharedTileCache('tiles', 60, 1000, 500, 5, 0.2)
+        self.cache.cache.clear()
+        self.tile = ('wmts', 'EPSG3857', 1, 0, 0, 'png')
+
+    def test_set_get_and_generation(self):
+        self.assertTrue(self.cache.set(1, None, self.tile, 'png-data', [('Content-type', 'image/png')]))
+        self.assertEqual(self.cache.get(1, None, self.tile), ('png-data', [('Content-type', 'image/png')]))
+        # a finished seed changes the generation and hides older entries
+        self.assertEqual(self.cache.get(1, 1466495104.0, self.tile), None)
+
+    def test_tileset_byte_budget(self):
+        for y in range(3):
+            self.assertTrue(self.cache.set(1, None, ('wmts', 'EPSG3857', 1, 0, y, 'png'), 'x' * 300, []))
+        self.assertFalse(self.cache.set(1, None, ('wmts', 'EPSG3857', 1, 0, 3, 'png'), 'x' * 300, []))
+        self.assertFalse(self.cache.set(1, None, ('wmts', 'EPSG3857', 1, 0, 4, 'png'), 'x' * 501, []))
+        # other tilesets have their own budget
+        self.assertTrue(self.cache.set(2, None, self.tile, 'x' * 300, []))
+        self.assertEqual(self.cache.stats(1, None)['bytes'], 1200)
+
+    def test_render_lock(self):
+        self.assertTrue(self.cache.acquire(1, None, self.tile))
+        self.assertFalse(self.cache.acquire(1, None, self.tile))
+        self.assertEqual(self.cache.wait(1, None, self.tile), None)
+
+        self.cache.set(1, None, self.tile, 'png-data', [])
+        self.assertEqual(self.cache.wait(1, None, self.tile)[0], 'png-data')
+        self.cache.release(1, None, self.tile)
+        self.assertTrue(self.cache.acquire(1, None, self.tile))
+
+    def test_filebased_backend(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        with self.settings(CACHES={'tiles': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': cache_dir}}):
+            self.assertTrue(self.cache.set(1, None, self.tile, 'png-data', []))
+            self.assertEqual(self.cache.get(1, None, self.tile), ('png-data', []))
+            self.assertTrue(self.cache.acquire(1, None, self.tile))
+            self.assertFalse(self.cache.acquire(1, None, self.tile))
+
+    def test_tile_view_served_from_shared_cache(self):
+        hot_tile_cache.clear()
+        self.addCleanup(setattr, tilecache.shared_tile_cache, 'alias', tilecache.shared_tile_cache.alias)
+        tilecache.shared_tile_cache.alias = 'tiles'
+        uri = reverse(
+            'tileset_mapproxy',
+            args=(1, u'/tms/1.0.0/streams/EPSG3857/1/0/0.png')
+        )
+        self.client.login(username='admin', password='admin')
+        res = self.client.get(uri, **self.headers)
+        self.assertEqual(res['X-Djmp-Cache'], 'miss')
+
+        # another worker process only sees the shared cache
+        hot_tile_cache.clear()
+        res = self.client.get(uri, **self.headers)
+        self.assertEqual(res['X-Djmp-Cache'], 'hit-shared')
+        self.assertEqual(res['Content-Type'], 'image/png')
+
+    def test_tile_view_keeps_the_lock_of_another_worker(self):
+        hot_tile_cache.clear()
+        shared = tilecache.shared_tile_cache
+        self.addCleanup(setattr, shared, 'alias', shared.alias)
+        self.addCleanup(setattr, shared, 'lock_wait', shared.lock_wait)
+        shared.alias = 'tiles'
+        shared.lock_wait = 0.2
+        path = u'/tms/1.0.0/streams/EPSG3857/1/0/0.png'
+        generation = get_seed_generation(Tileset.objects.get(pk=1))
+        tile = parse_tile_path(path)
+        self.assertTrue(shared.acquire(1, generation, tile))
+
+        self.client.login(username='admin', password='admin')
+        res = self.client.get(reverse('tileset_mapproxy', args=(1, path)), **self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['X-Djmp-Cache'], 'miss')
+        # the tile is left to the worker holding the lock
+        self.assertFalse(shared.acquire(1, generation, tile))
+        self.assertEqual(shared.get(1, generation, tile), None)
+
+
+class MBTilesCacheTest(DjmpTestBase):
+    def setUp(self):
+        super(MBTilesCacheTest, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.tileset = Tileset.objects.get(pk=1)
+        self.tileset.cache_type = 'mbtiles'
+        self.tileset.directory = self.tmp_dir
+
+    def test_mbtiles_config(self):
+        mapproxy_cf, seed_cf = generate_confs(self.tileset)
+        cache = mapproxy_cf.caches['tileset_cache'].caches()[0][2].cache
+        self.assertEqual(cache.mbtile_file, get_tileset_location(self.tileset))
+        self.assertEqual(cache.mbtile_file, os.path.join(self.tmp_dir, 'streams', 'streams.mbtiles'))
+        self.assertTrue(cache.wal)
+
+    def test_batched_writes(self):
+        filename = get_tileset_location(self.tileset)
+        prepare_mbtiles(filename)
+        db = sqlite3.connect(filename)
+        self.assertEqual(db.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+        cache = BatchedMBTilesCache(filename, batch_size=3, flush_interval=60)
+        committed = []
+        cache.on_commit = committed.extend
+        pending = Tile((0, 0, 1), source=ImageSource(BytesIO(b'png')))
+        self.assertFalse(cache.store_tiles([pending]))
+        self.assertFalse(cache.store_tiles([Tile((1, 0, 1), source=ImageSource(BytesIO(b'png')))]))
+        self.assertEqual(db.execute('SELECT count(*) FROM tiles').fetchone()[0], 0)
+        # not stored before the commit
+        self.assertFalse(pending.stored)
+
+        last = Tile((0, 1, 1), source=ImageSource(BytesIO(b'png')))
+        self.assertTrue(cache.store_tiles([last]))
+        self.assertTrue(last.stored)
+        self.assertEqual(db.execute('SELECT count(*) FROM tiles').fetchone()[0], 3)
+        self.assertEqual(sorted(committed), [(0, 0, 1), (0, 1, 1), (1, 0, 1)])
+        db.close()
+
+    def test_terminated_worker_commits_pending_tiles(self):
+        filename = get_tileset_location(self.tileset)
+        prepare_mbtiles(filename)
+        queue = multiprocessing.Queue()
+
+        def worker():
+            cache = BatchedMBTilesCache(filename, batch_size=100, flush_interval=60)
+            cache.store_tiles([Tile((0, 0, 1), source=ImageSource(BytesIO(b'png')))])
+            queue.put('pending')
+            time.sleep(60)
+
+        process = multiprocessing.Process(target=worker)
+        process.start()
+        self.assertEqual(queue.get(timeout=30), 'pending')
+        process.terminate()
+        process.join()
+        db = sqlite3.connect(filename)
+        self.assertEqual(db.execute('SELECT count(*) FROM tiles').fetchone()[0], 1)
+        db.close()
+
+
+class CompactCacheTest(DjmpTestBase):
+    def setUp(self):
+        super(CompactCacheTest, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.tileset = Tileset.objects.get(pk=1)
+        self.tileset.cache_type = 'compact'
+        self.tileset.directory = self.tmp_dir
+
+    def seed_tiles(self, coords):
+        mapproxy_cf, seed_cf = generate_confs(self.tileset)
+        cache = mapproxy_cf.caches['tileset_cache'].caches()[0][2].cache
+        cache.store_tiles([
+            Tile(coord, source=ImageSource(BytesIO(b'tile-%d-%d-%d' % coord)))
+            for coord in coords
+        ])
+        return cache
+
+    def test_read_bundle_tiles(self):
+        coords = [(0, 0, 5), (3, 17, 5), (130, 255, 8), (127, 127, 7)]
+        for version in (1, 2):
+            self.tileset.compact_version = version
+            self.tileset.directory = os.path.join(self.tmp_dir, 'v%d' % version)
+            cache = self.seed_tiles(coords)
+            self.assertEqual(cache.__class__.__name__, 'CompactCacheV%d' % version)
+            for x, y, z in coords:
+                self.assertEqual(
+                    read_bundle_tile(cache.cache_dir, version, x, y, z),
+                    b'tile-%d-%d-%d' % (x, y, z)
+                )
+            self.assertEqual(read_bundle_tile(cache.cache_dir, version, 1, 0, 5), None)
+            self.assertEqual(read_bundle_tile(cache.cache_dir, version, 0, 0, 9), None)
+
+    def test_v1_bundle_without_data_file(self):
+        self.tileset.compact_version = 1
+        cache = self.seed_tiles([(0, 0, 5)])
+        os.remove(os.path.join(cache.cache_dir, 'L05', 'R0000C0000.bundle'))
+        self.assertEqual(read_bundle_tile(cache.cache_dir, 1, 0, 0, 5), None)
+
+    def test_location_and_stats(self):
+        self.seed_tiles([(0, 0, 5)])
+        location = get_tileset_location(self.tileset)
+        self.assertEqual(location, os.path.join(self.tmp_dir, '1'))
+        self.assertTrue(os.path.isfile(os.path.join(location, 'L05', 'R0000C0000.bundle')))
+        size, updated = get_tileset_stats(self.tileset)
+        self.assertNotEqual(size, '0')
+
+    def test_tile_view_reads_bundle(self):
+        self.tileset.save()
+        self.seed_tiles([(3, 17, 5)])
+        uri = reverse(
+            'tileset_mapproxy',
+            args=(1, u'/wmts/streams/EPSG3857/5/3/17.png')
+        )
+        self.client.login(username='admin', password='admin')
+        res = self.client.get(uri, **self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['X-Djmp-Cache'], 'hit-bundle')
+        self.assertEqual(res.content, b'tile-3-17-5')
+
+
+class ImageEncodingTest(DjmpTestBase):
+    def setUp(self):
+        super(ImageEncodingTest, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.tileset = Tileset.objects.get(pk=1)
+        self.tileset.directory = self.tmp_dir
+
+    def cache_conf(self):
+        return json.loads(get_mapproxy_conf(self.tileset))['caches']['tileset_cache']
+
+    def test_cache_config(self):
+        self.assertEqual(self.cache_conf()['format'], 'image/png')
+
+        self.tileset.image_format = 'png8'
+        self.tileset.image_colors = 64
+        self.tileset.image_quantizer = 'mediancut'
+        conf = self.cache_conf()
+        self.assertEqual(conf['image']['colors'], 64)
+        self.assertEqual(conf['image']['encoding_options'], {'quantizer': 'mediancut'})
+
+        self.tileset.image_format = 'mixed'
+        self.tileset.jpeg_quality = 75
+        conf = self.cache_conf()
+        self.assertEqual(conf['format'], 'mixed')
+        self.assertEqual(conf['request_format'], 'image/png')
+        self.assertEqual(conf['image']['encoding_options'], {'jpeg_quality': 75})
+        generate_confs(self.tileset)
+
+    def test_services_config(self):
+        self.tileset.image_format = 'jpeg'
+        services = json.loads(get_mapproxy_conf(self.tileset))['services']
+        self.assertIn('image/jpeg', services['wms']['image_formats'])
+        self.assertTrue(services['wmts']['restful_template'].endswith('.{Format}'))
+        mapproxy_cf, seed_cf = generate_confs(self.tileset)
+        tile_manager = mapproxy_cf.caches['tileset_cache'].caches()[0][2]
+        self.assertEqual(tile_manager.format, 'jpeg')
+
+    def test_encoding_savings(self):
+        self.tileset.image_format = 'jpeg'
+        mapproxy_cf, seed_cf = generate_confs(self.tileset)
+        grid, extent, tile_manager = mapproxy_cf.caches['tileset_cache'].caches()[0]
+        _, _, coords = grid.get_affected_level_tiles(self.tileset.bbox_3857(), 14)
+        tiles = []
+        for coord in [c for c in coords if c is not None][:4]:
+            img = Image.frombytes('RGB', (256, 256), os.urandom(256 * 256 * 3))
+            buf = BytesIO()
+            img.save(buf, 'jpeg', quality=self.tileset.jpeg_quality)
+            tiles.append(Tile(coord, source=ImageSource(BytesIO(buf.getvalue()))))
+        tile_manager.cache.store_tiles(tiles)
+
+        savings = estimate_encoding_savings(self.tileset)
+        self.assertEqual(savings['format'], 'jpeg')
+        self.assertEqual(savings['sampled_tiles'], 4)
+        self.assertTrue(0 < savings['sampled_bytes'] < savings['rgba_png_bytes'])
+        self.assertTrue(savings['saved_percent'] > 0)
+
+        # the status only reads the savings recorded by the last seed
+        self.assertEqual(get_encoding_savings(self.tileset), None)
+        self.assertEqual(record_encoding_savings(self.tileset), savings)
+        self.assertEqual(get_encoding_savings(self.tileset), savings)
+        self.tileset.image_format = 'png8'
+        self.assertEqual(get_encoding_savings(self.tileset), None)
+
+
+class TileDedupTest(DjmpTestBase):
+    def setUp(self):
+        super(TileDedupTest, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.tileset = Tileset.objects.get(pk=1)
+        self.tileset.directory = self.tmp_dir
+
+    def seed_tiles(self):
+        mapproxy_cf, seed_cf = generate_confs(self.tileset)
+        cache = mapproxy_cf.caches['tileset_cache'].caches()[0][2].cache
+        tiles = []
+        for x in range(4):
+            # three identical ocean tiles and one with detail
+            img = Image.new('RGBA', (256, 256), (0, 0, 255, 255))
+            if x == 3:
+                img.putpixel((0, 0), (255, 0, 0, 255))
+            buf = BytesIO()
+            img.save(buf, 'png')
+            tiles.append(Tile((x, 0, 6), source=ImageSource(BytesIO(buf.getvalue()))))
+        cache.store_tiles(tiles)
+        return cache
+
+    def test_symlink(self):
+        self.tileset.tile_dedup = 'symlink'
+        cache = self.seed_tiles()
+        self.assertTrue(cache.link_single_color_images)
+        stats = dedup_tiles(self.tileset)
+        self.assertEqual(stats['mode'], 'symlink')
+        self.assertEqual(stats['linked_tiles'], 3)
+        self.assertEqual(stats['symlinks'], 3)
+        self.assertTrue(stats['bytes_saved'] > 0)
+        self.assertEqual(get_dedup_stats(self.tileset), stats)
+
+    def test_hardlink(self):
+        self.tileset.tile_dedup = 'hardlink'
+        cache = self.seed_tiles()
+        self.assertFalse(cache.link_single_color_images)
+        stats = dedup_tiles(self.tileset)
+        self.assertEqual(stats['linked_tiles'], 3)
+        self.assertEqual(stats['unique_tiles'], 1)
+        self.assertEqual(stats['symlinks'], 0)
+        self.assertEqual(stats['inodes_saved'], 2)
+        self.assertTrue(stats['bytes_saved'] > 0)
+        tile_path = cache.tile_location(Tile((0, 0, 6)))
+        self.assertEqual(os.stat(tile_path).st_nlink, 3)
+        self.assertEqual(os.stat(cache.tile_location(Tile((3, 0, 6)))).st_nlink, 1)
+
+        # a second pass does not link again
+        self.assertEqual(dedup_tiles(self.tileset)['linked_tiles'], 3)
+
+    def test_disabled(self):
+        self.seed_tiles()
+        self.assertEqual(dedup_tiles(self.tileset), None)
+        self.assertEqual(get_dedup_stats(self.tileset), None)
+
+
+class StubUpstreamTest(DjmpTestBase):
+    def test_tileset_served_from_stub(self):
+        upstream = StubUpstream().start()
+        self.addCleanup(upstream.stop)
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        tileset = Tileset.objects.get(pk=1)
+        tileset.server_url = upstream.url
+        tileset.directory = tmp_dir
+
+        mapproxy_cf, seed_cf = generate_confs(tileset)
+        grid, extent, tile_manager = mapproxy_cf.caches['tileset_cache'].caches()[0]
+        _, _, coords = grid.get_affected_level_tiles(tileset.bbox_3857(), 6)
+        tile = tile_manager.load_tile_coord(next(coords))
+        self.assertEqual(tile.source.as_image().size, (256, 256))
+        self.assertEqual(upstream.requests, 1)
+
+
+class ServerTimingTest(DjmpTestBase):
+    def setUp(self):
+        super(ServerTimingTest, self).setUp()
+        hot_tile_cache.clear()
+        latency_histograms.clear()
+        self.addCleanup(setattr, timing, 'DJMP_SERVER_TIMING', timing.DJMP_SERVER_TIMING)
+        timing.DJMP_SERVER_TIMING = True
+
+    def stages(self, res):
+        return [s.split(';')[0] for s in res['Server-Timing'].split(', ')]
+
+    def test_request_timing(self):
+        t = RequestTiming()
+        t.add('db', 0.002)
+        with t.stage('cache'):
+            pass
+        t.add('db', 0.001)
+        self.assertEqual([s[0] for s in t.stages], ['db', 'cache'])
+        self.assertEqual(t.header_value(0.01).split(', ')[0], 'db;dur=3.00')
+        self.assertEqual(t.header_value(0.01).split(', ')[-1], 'total;dur=10.00')
+
+    def test_tile_view_header_and_histograms(self):
+        upstream = StubUpstream().start()
+        self.addCleanup(upstream.stop)
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        tileset = Tileset.objects.get(pk=1)
+        tileset.server_url = upstream.url
+        tileset.directory = tmp_dir
+        tileset.save()
+
+        uri = reverse('tileset_mapproxy', args=(1, u'/wmts/streams/EPSG3857/6/49/32.png'))
+        self.client.login(username='admin', password='admin')
+        res = self.client.get(uri, **self.headers)
+        self.assertEqual(res['X-Djmp-Cache'], 'miss')
+        self.assertEqual(upstream.requests, 1)
+        self.assertEqual(
+            self.stages(res),
+            ['db', 'cache', 'config', 'app', 'mapproxy', 'upstream', 'response', 'total']
+        )
+
+        res = self.client.get(uri, **self.headers)
+        self.assertEqual(res['X-Djmp-Cache'], 'hit')
+        self.assertEqual(self.stages(res), ['db', 'cache', 'total'])
+
+        latency = get_status(tileset)['latency']
+        self.assertEqual(latency['stages']['total']['count'], 2)
+        self.assertEqual(latency['stages']['upstream']['count'], 1)
+        self.assertEqual(sum(latency['stages']['total']['counts']), 2)
+
+    def test_header_disabled(self):
+        timing.DJMP_SERVER_TIMING = False
+        uri = reverse('tileset_mapproxy', args=(1, u'/config'))
+        self.client.login(username='admin', password='admin')
+        res = self.client.get(uri, **self.headers)
+        self.assertFalse(res.has_header('Server-Timing'))
+        self.assertEqual(latency_histograms.stats(1)['stages']['total']['count'], 1)
+
+
+class MetricsTest(DjmpTestBase):
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.addCleanup(setattr, process_metrics, 'directory', process_metrics.directory)
+        process_metrics.directory = self.tmp_dir
+        latency_histograms.clear()
+
+    def exited_pid(self):
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        return proc.pid
+
+    def test_collect_adds_up_processes(self):
+        labels = {'tileset': '1', 'status': '200'}
+        other = ProcessMetrics(self.tmp_dir, 0)
+        other.inc('djmp_tile_requests_total', labels, 2)
+        other.set_gauge('djmp_seed_level', {'tileset': '1'}, 7)
+        data = other.snapshot()
+        # a worker process that already exited
+        with open(os.path.join(self.tmp_dir, '{}.json'.format(self.exited_pid())), 'w') as f:
+            json.dump(data, f)
+        process_metrics.inc('djmp_tile_requests_total', labels, 3)
+
+        total = collect(self.tmp_dir)
+        requests = [c for c in total['counters'] if c[0] == 'djmp_tile_requests_total' and c[1] == labels]
+        self.assertTrue(requests[0][2] >= 5)
+        self.assertEqual([g for g in total['gauges'] if g[0] == 'djmp_seed_level'], [])
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir, 'archive.json')))
+        # archived counters are only counted once
+        self.assertEqual(
+            [c for c in collect(self.tmp_dir)['counters'] if c[1] == labels][0][2],
+            requests[0][2]
+        )
+
+    def test_seed_progress_log(self):
+        progress_log = SeedProgressLog(1, out=BytesIO(), verbose=True)
+        progress_log.log_progress(SeedProgress(), 6, (0, 0, 1, 1), 16)
+        progress_log.log_progress(SeedProgress(), 7, (0, 0, 1, 1), 48)
+        total = collect(self.tmp_dir)
+        seeded = [c for c in total['counters'] if c[0] == 'djmp_seed_tiles_total']
+        self.assertEqual(seeded, [['djmp_seed_tiles_total', {'tileset': '1'}, 48]])
+        self.assertIn(['djmp_seed_level', {'tileset': '1'}, 7], total['gauges'])
+
+    def test_running_seed_jobs(self):
+        self.addCleanup(process_metrics.set_gauge, 'djmp_seed_running', {'tileset': '1'}, 0)
+        process_metrics.set_gauge('djmp_seed_running', {'tileset': '1'}, 1)
+        # a seed process that exited without finishing
+        crashed = ProcessMetrics(self.tmp_dir, 0)
+        crashed.set_gauge('djmp_seed_running', {'tileset': '2'}, 1)
+        with open(os.path.join(self.tmp_dir, '{}.json'.format(self.exited_pid())), 'w') as f:
+            json.dump(crashed.snapshot(), f)
+
+        text = render_metrics(collect(self.tmp_dir), LATENCY_BUCKETS_MS)
+        self.assertIn('djmp_seed_running{tileset="1"} 1.0', text)
+        self.assertNotIn('djmp_seed_running{tileset="2"}', text)
+        self.assertIn('djmp_seed_jobs{state="running"} 1.0', text)
+        self.assertIn('djmp_seed_jobs{state="queued"} 0.0', text)
+
+        process_metrics.set_gauge('djmp_seed_running', {'tileset': '1'}, 0)
+        self.addCleanup(process_metrics._gauges.clear)
+        process_metrics.set_gauge('djmp_seed_queued', {}, 3)
+        text = render_metrics(collect(self.tmp_dir), LATENCY_BUCKETS_MS)
+        self.assertIn('djmp_seed_jobs{state="running"} 0.0', text)
+        self.assertIn('djmp_seed_jobs{state="queued"} 3.0', text)
+
+    def test_metrics_view(self):
+        tileset = Tileset.objects.get(pk=1)
+        tileset.directory = os.path.join(self.tmp_dir, 'tilesets')
+        tileset.save()
+        self.client.login(username='admin', password='admin')
+        self.client.get(reverse('tileset_mapproxy', args=(1, u'/config')), **self.headers)
+        res = self.client.get(reverse('djmp_metrics'))
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('djmp_tile_requests_total{status="200",tileset="1"}', res.content)
+        self.assertIn('djmp_request_stage_seconds_bucket{le="+Inf",stage="total",tileset="1"}', res.content)
+        self.assertIn('djmp_seed_jobs{state="running"} 0.0', res.content)
+        # scrapes do not create tileset directories
+        self.assertFalse(os.path.exists(tileset.directory))
+
+
+class SeedJobStatsTest(DjmpTestBase):
+    def setUp(self):
+        super(SeedJobStatsTest, self).setUp()
+        self.upstream = StubUpstream().start()
+        self.addCleanup(self.upstream.stop)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.addCleanup(setattr, process_metrics, 'directory', process_metrics.directory)
+        process_metrics.directory = self.tmp_dir
+        self.tileset = Tileset.objects.get(pk=1)
+        self.tileset.server_url = self.upstream.url
+        self.tileset.directory = self.tmp_dir
+        self.tileset.layer_zoom_stop = 7
+        self.tileset.save()
+
+    def seed(self):
+        mapproxy_cf, seed_cf = generate_confs(self.tileset)
+        seed_process_target(self.tileset, seed_cf.seeds(['tileset_seed']), SeedProgressLog(1, out=BytesIO()))
+        return SeedJob.objects.filter(tileset=self.tileset).first()
+
+    def test_seed_job_levels(self):
+        job = self.seed()
+        levels = list(job.levels.all())
+        self.assertEqual([l.level for l in levels], [6, 7])
+        self.assertTrue(all(l.tiles > 0 and l.bytes > 0 for l in levels))
+        self.assertEqual(job.tiles, sum(l.tiles for l in levels))
+        self.assertEqual(sum(l.upstream_requests for l in levels), self.upstream.requests)
+        self.assertTrue(levels[0].upstream_p50_ms <= levels[0].upstream_p95_ms)
+        self.assertEqual(job.skipped, 0)
+        self.assertIn(['djmp_seed_running', {'tileset': '1'}, 0], process_metrics.snapshot()['gauges'])
+
+        # every seed is recorded as a job of its own
+        self.seed()
+        self.assertEqual(self.tileset.seed_jobs.count(), 2)
+
+    def test_failing_bookkeeping(self):
+        def fail(tileset):
+            raise IOError('disk full')
+        self.addCleanup(setattr, helpers, 'dedup_tiles', helpers.dedup_tiles)
+        helpers.dedup_tiles = fail
+        get_lock_file(self.tileset).close()
+        # the job is still recorded and the lock removed
+        self.assertIsNotNone(self.seed())
+        self.assertFalse(os.path.exists(get_lock_filename(self.tileset)))
+        self.assertIsNotNone(get_seed_generation(self.tileset))
+
+    def test_failing_seed_removes_the_lock(self):
+        get_lock_file(self.tileset).close()
+        with self.assertRaises(TypeError):
+            seed_process_target(self.tileset, None, SeedProgressLog(1, out=BytesIO()))
+        self.assertFalse(os.path.exists(get_lock_filename(self.tileset)))
+        self.assertIsNotNone(get_seed_generation(self.tileset))
+
+    def test_seed_jobs_api(self):
+        job = self.tileset.seed_jobs.create(
+            started_at=timezone.now(), finished_at=timezone.now(), tiles=10, duration=2, tiles_per_second=5)
+        job.levels.create(level=6, tiles=10, upstream_requests=1, upstream_p50_ms=12.5, upstream_p95_ms=20)
+        self.client.login(username='admin', password='admin')
+        res = self.client.get('/api/seed_jobs/?tileset=1', **self.headers)
+        self.assertEqual(res.status_code, 200)
+        objects = json.loads(res.content)['objects']
+        self.assertEqual(len(objects), 1)
+        self.assertEqual(objects[0]['tileset'], '/api/tilesets/1/')
+        self.assertEqual(objects[0]['levels'][0]['upstream_p95_ms'], 20)
+
+
+class BatchSeedTest(DjmpTestBase):
+    def setUp(self):
+        super(BatchSeedTest, self).setUp()
+        self.upstream = StubUpstream().start()
+        self.addCleanup(self.upstream.stop)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.addCleanup(setattr, process_metrics, 'directory', process_metrics.directory)
+        process_metrics.directory = self.tmp_dir
+        # seeding in this process counts seeded tiles and the seed level
+        self.addCleanup(process_metrics._counters.clear)
+        self.addCleanup(process_metrics._gauges.clear)
+        self.tileset = Tileset.objects.get(pk=1)
+        self.tileset.server_url = self.upstream.url
+        self.tileset.directory = self.tmp_dir
+        self.tileset.layer_zoom_stop = 7
+        self.tileset.save()
+
+    def test_seed_tileset(self):
+        tiles = []
+        result = seed_tileset(self.tileset, zoom_stop=6, on_tiles=tiles.append)
+        self.assertEqual(result, {'status': 'seeded', 'error': None})
+        job = SeedJob.objects.get(tileset=self.tileset)
+        self.assertEqual([l.level for l in job.levels.all()], [6])
+        self.assertTrue(sum(tiles) > 0)
+        self.assertFalse(os.path.exists(get_lock_filename(self.tileset)))
+        # the override is not saved
+        self.assertEqual(Tileset.objects.get(pk=1).layer_zoom_stop, 7)
+
+        lock_file = get_lock_file(self.tileset)
+        self.addCleanup(remove_lock_file, self.tileset)
+        lock_file.close()
+        self.assertEqual(seed_tileset(self.tileset)['status'], 'already started')
+
+    def test_command(self):
+        other = Tileset.objects.get(pk=1)
+        other.pk = None
+        other.name = 'rivers'
+        other.save()
+        out = StringIO()
+        call_command('djmp_seed', '--zoom-stop', '6', '--concurrency', '2', '--interval', '0.1', stdout=out)
+        self.assertIn('2 seeded, 0 failed', out.getvalue())
+        self.assertIn('tiles/s, seeding:', out.getvalue())
+        for tileset in (self.tileset, other):
+            self.assertTrue(os.path.isdir(os.path.join(get_grid_cache_directory(tileset), '6')))
+            self.assertFalse(os.path.exists(os.path.join(get_grid_cache_directory(tileset), '7')))
+        with self.assertRaises(CommandError):
+            call_command('djmp_seed', '--name', 'lakes', stdout=out)
+
+    def test_queued_seeds(self):
+        other = Tileset.objects.get(pk=1)
+        other.pk = None
+        other.name = 'rivers'
+        other.save()
+        queued = []
+
+        def progress(status):
+            gauges = collect(self.tmp_dir)['gauges']
+            queued.append([v for n, labels, v in gauges if n == 'djmp_seed_queued'])
+
+        batch_seed([self.tileset, other], concurrency=1, zoom_stop=6, progress=progress, interval=60)
+        # rivers waits until streams is seeded
+        self.assertEqual(queued[0], [1])
+        self.assertEqual(queued[-1], [0])
+
+
+class MissPoolTest(DjmpTestBase):
+    def setUp(self):
+        super(MissPoolTest, self).setUp()
+        hot_tile_cache.clear()
+        self.upstream = StubUpstream(latency=1.0).start()
+        self.addCleanup(self.upstream.stop)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.addCleanup(setattr, process_metrics, 'directory', process_metrics.directory)
+        process_metrics.directory = self.tmp_dir
+        self.pool = MissPool(2, 1, 0.2)
+        self.addCleanup(setattr, views, 'miss_pool', views.miss_pool)
+        views.miss_pool = self.pool
+        self.addCleanup(self.wait_for_pool)
+        self.tileset = Tileset.objects.get(pk=1)
+        self.tileset.server_url = self.upstream.url
+        self.tileset.directory = os.path.join(self.tmp_dir, 'tiles')
+        self.tileset.save()
+        self.client.login(username='admin', password='admin')
+
+    def wait_for_pool(self):
+        for i in range(100):
+            if not self.pool.depth()['tilesets']:
+                return
+            time.sleep(0.05)
+        self.fail('misses still pending: {}'.format(self.pool.depth()))
+
+    def get(self, path):
+        return self.client.get(reverse('tileset_mapproxy', args=(1, path)), **self.headers)
+
+    def test_slow_misses_do_not_block_hits(self):
+        res = self.get('/wmts/streams/EPSG3857/6/49/32.png')
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res['X-Djmp-Cache'], 'busy')
+        # the timed out miss still counts against the tileset
+        res = self.get('/wmts/streams/EPSG3857/7/98/65.png')
+        self.assertEqual(res.status_code, 503)
+        self.assertIn('misses pending', res.content)
+
+        # the miss cached its tile once it was rendered
+        self.wait_for_pool()
+        res = self.get('/wmts/streams/EPSG3857/6/49/32.png')
+        self.assertEqual(res['X-Djmp-Cache'], 'hit')
+
+        # tiles MapProxy has cached are served while a slow miss is pending
+        hot_tile_cache.clear()
+        self.assertEqual(self.get('/wmts/streams/EPSG3857/7/98/65.png').status_code, 503)
+        self.assertEqual(self.pool.depth()['tilesets'], {1: 1})
+        res = self.get('/wmts/streams/EPSG3857/6/49/32.png')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['X-Djmp-Cache'], 'miss')
+
+        rejected = dict(
+            (c[1]['reason'], c[2]) for c in collect(self.tmp_dir)['counters'] if c[0] == 'djmp_miss_pool_rejected_total'
+        )
+        self.assertEqual(rejected, {'timeout': 2, 'full': 1})
+
+    def test_errors_are_raised_in_the_request(self):
+        pool = MissPool(1, 1, 1.0)
+        self.assertEqual(pool.run(1, lambda: 42), 42)
+        with self.assertRaises(ZeroDivisionError):
+            pool.run(1, lambda: 1 / 0)
+        self.assertEqual(pool.depth(), {'queued': 0, 'running': 0, 'tilesets': {}})
+
+
+class BatchTilesTest(DjmpTestBase):
+    def setUp(self):
+        super(BatchTilesTest, self).setUp()
+        self.upstream = StubUpstream().start()
+        self.addCleanup(self.upstream.stop)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.tileset = Tileset.objects.get(pk=1)
+        self.tileset.server_url = self.upstream.url
+        self.tileset.directory = self.tmp_dir
+        self.tileset.save()
+        self.client.login(username='admin', password='admin')
+
+    def get(self, query):
+        return self.client.get(reverse('tileset_tiles', args=(1,)) + '?' + query, **self.headers)
+
+    def parts(self, res):
+        boundary = res['Content-Type'].split('boundary=')[1]
+        body = b''.join(res.streaming_content)
+        self.assertTrue(body.endswith('--{}--\r\n'.format(boundary)))
+        parts = []
+        for part in body.split('--{}'.format(boundary))[1:-1]:
+            head, data = part.split('\r\n\r\n', 1)
+            headers = dict(line.split(': ', 1) for line in head.strip().split('\r\n'))
+            self.assertEqual(int(headers['Content-Length']), len(data) - 2)
+            parts.append((headers['Content-Location'], headers['Content-Type'], data[:-2]))
+        return parts
+
+    def test_tiles_in_coverage_order(self):
+        # only cached tiles without render=1
+        self.assertEqual(self.parts(self.get('tiles=7/98/65,6/49/32')), [])
+        self.assertEqual(self.upstream.requests, 0)
+
+        res = self.get('tiles=7/98/65,6/49/32,6/0/0&tiles=6/49/32&range=7/90/60/100/70&render=1')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res['Content-Type'].startswith('multipart/mixed; boundary='))
+        parts = self.parts(res)
+        self.assertEqual([p[0] for p in parts], ['6/49/32', '7/98/65'])
+        self.assertEqual(parts[0][1], 'image/png')
+        self.assertEqual(Image.open(BytesIO(parts[0][2])).size, (256, 256))
+        requests = self.upstream.requests
+        self.assertEqual(requests, 2)
+
+        # a second batch is read from the cache
+        self.assertEqual(len(self.parts(self.get('range=6/0/0/63/63'))), 1)
+        self.assertEqual(self.upstream.requests, requests)
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.get('tiles=6/49').status_code, 400)
+        self.assertEqual(self.get('range=7/100/60/90/70').status_code, 400)
+        self.addCleanup(setattr, views, 'DJMP_BATCH_TILES_MAX', views.DJMP_BATCH_TILES_MAX)
+        views.DJMP_BATCH_TILES_MAX = 1
+        res = self.get('tiles=6/49/32,7/98/65')
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(json.loads(res.content), {'error': 'more than 1 tiles requested'})
+
+
+class ExportTest(DjmpTestBase):
+    def setUp(self):
+        super(ExportTest, self).setUp()
+        hot_tile_cache.clear()
+        self.upstream = StubUpstream().start()
+        self.addCleanup(self.upstream.stop)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.tileset = Tileset.objects.get(pk=1)
+        self.tileset.server_url = self.upstream.url
+        self.tileset.directory = self.tmp_dir
+        self.tileset.save()
+        self.client.login(username='admin', password='admin')
+
+    def get(self, query):
+        return self.client.get(reverse('tileset_export', args=(1,)) + '?' + query, **self.headers)
+
+    def rows(self, filename, table):
+        db = sqlite3.connect(filename)
+        try:
+            return db.execute('SELECT zoom_level, tile_column, tile_row FROM [{}] ORDER BY zoom_level'.format(table)).fetchall()
+        finally:
+            db.close()
+
+    def test_export_view_sends_cached_tiles(self):
+        self.client.get(reverse('tileset_mapproxy', args=(1, '/wmts/streams/EPSG3857/6/49/32.png')), **self.headers)
+        requests = self.upstream.requests
+        # only the export command renders missing tiles
+        res = self.get('zoom_start=6&zoom_stop=7&render=1')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['Content-Disposition'], 'attachment; filename="streams.mbtiles"')
+        filename = os.path.join(self.tmp_dir, 'export.mbtiles')
+        with open(filename, 'wb') as f:
+            for chunk in res.streaming_content:
+                f.write(chunk)
+        self.assertEqual(os.path.getsize(filename), int(res['Content-Length']))
+        # mbtiles rows count from the south
+        self.assertEqual(self.rows(filename, 'tiles'), [(6, 49, 31)])
+        db = sqlite3.connect(filename)
+        metadata = dict(db.execute('SELECT name, value FROM metadata').fetchall())
+        db.close()
+        self.assertEqual((metadata['minzoom'], metadata['maxzoom'], metadata['format']), ('6', '7', 'png'))
+        self.assertEqual(self.upstream.requests, requests)
+        self.assertEqual(os.listdir(os.path.join(self.tmp_dir, 'streams', 'exports')), [])
+
+    def test_export_command_copies_cached_tiles(self):
+        self.client.get(reverse('tileset_mapproxy', args=(1, '/wmts/streams/EPSG3857/6/49/32.png')), **self.headers)
+        filename = os.path.join(self.tmp_dir, 'streams.gpkg')
+        out = StringIO()
+        call_command('djmp_export', '1', filename, '--zoom-stop', '7', '--bbox', '90,-10,100,0', stdout=out)
+        self.assertIn(': 1 tiles', out.getvalue())
+        self.assertEqual(self.rows(filename, 'streams'), [(6, 49, 32)])
+
+    def test_export_command_renders_missing_tiles(self):
+        filename = os.path.join(self.tmp_dir, 'streams.mbtiles')
+        call_command('djmp_export', '1', filename, '--zoom-start', '6', '--zoom-stop', '7', '--render', stdout=StringIO())
+        # mbtiles rows count from the south
+        self.assertEqual(self.rows(filename, 'tiles'), [(6, 49, 31), (7, 98, 62)])
+        self.assertTrue(self.upstream.requests > 0)
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.get('format=tiff').status_code, 400)
+        self.assertEqual(self.get('bbox=1,2').status_code, 400)
+        self.assertEqual(self.get('zoom_start=a').status_code, 400)
+        self.addCleanup(setattr, views, 'DJMP_EXPORT_MAX_TILES', views.DJMP_EXPORT_MAX_TILES)
+        views.DJMP_EXPORT_MAX_TILES = 1
+        self.assertEqual(json.loads(self.get('zoom_stop=7').content), {'error': 'more than 1 tiles requested'})
+
+
+class ImportTest(DjmpTestBase):
+    def setUp(self):
+        super(ImportTest, self).setUp()
+        hot_tile_cache.clear()
+        self.upstream = StubUpstream().start()
+        self.addCleanup(self.upstream.stop)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.tileset = Tileset.objects.get(pk=1)
+        self.tileset.server_url = self.upstream.url
+        self.tileset.directory = os.path.join(self.tmp_dir, 'tiles')
+        self.tileset.save()
+        self.client.login(username='admin', password='admin')
+        buf = BytesIO()
+        Image.new('RGBA', (256, 256), (10, 200, 30, 255)).save(buf, 'png')
+        self.png = buf.getvalue()
+
+    def get(self, path):
+        return self.client.get(reverse('tileset_mapproxy', args=(1, path)), **self.headers)
+
+    def test_import_mbtiles(self):
+        filename = os.path.join(self.tmp_dir, 'source.mbtiles')
+        db = sqlite3.connect(filename)
+        db.execute('CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)')
+        # rows from the south, 5/0/0 is outside the tileset
+        db.executemany('INSERT INTO tiles VALUES (?, ?, ?, ?)', [
+            (6, 49, 31, sqlite3.Binary(self.png)), (7, 98, 62, sqlite3.Binary(self.png)), (5, 0, 0, sqlite3.Binary(self.png))
+        ])
+        db.commit()
+        db.close()
+
+        out = StringIO()
+        call_command('djmp_import', '1', filename, '--concurrency', '2', '--interval', '0', stdout=out)
+        self.assertIn('2 tiles ({} bytes) imported, 1 outside the tileset skipped'.format(2 * len(self.png)),
+                      out.getvalue())
+        self.assertIn('3/3 jobs', out.getvalue())
+        res = self.get('/wmts/streams/EPSG3857/7/98/65.png')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.content, self.png)
+        self.assertEqual(self.upstream.requests, 0)
+        self.assertNotEqual(Tileset.objects.get(pk=1).size, '0')
+
+    def test_import_tms_directory_into_mbtiles(self):
+        self.tileset.cache_type = 'mbtiles'
+        self.tileset.save()
+        source = os.path.join(self.tmp_dir, 'source')
+        os.makedirs(os.path.join(source, '6', '49'))
+        with open(os.path.join(source, '6', '49', '31.png'), 'wb') as f:
+            f.write(self.png)
+
+        res = import_tiles(self.tileset, tile_source(source, tms=True), concurrency=1)
+        self.assertEqual((res['tiles'], res['skipped']), (1, 0))
+        self.assertEqual(self.get('/wmts/streams/EPSG3857/6/49/32.png').content, self.png)
+        self.assertEqual(self.upstream.requests, 0)
+
+        # not while the tileset is seeding
+        get_lock_file(self.tileset).close()
+        self.addCleanup(remove_lock_file, self.tileset)
+        self.assertIsNone(import_tiles(self.tileset, tile_source(source, tms=True)))
+
+    def test_tiles_in_another_format_are_encoded_again(self):
+        source = os.path.join(self.tmp_dir, 'source')
+        os.makedirs(os.path.join(source, '6', '49'))
+        buf = BytesIO()
+        Image.new('RGB', (256, 256), (10, 200, 30)).save(buf, 'jpeg')
+        with open(os.path.join(source, '6', '49', '32.jpg'), 'wb') as f:
+            f.write(buf.getvalue())
+        os.makedirs(os.path.join(source, '7', '98'))
+        with open(os.path.join(source, '7', '98', '65.png'), 'wb') as f:
+            f.write(b'not an image')
+
+        res = import_tiles(self.tileset, tile_source(source), concurrency=1)
+        self.assertEqual((res['tiles'], res['reencoded'], res['invalid']), (1, 1, 1))
+        body = self.get('/wmts/streams/EPSG3857/6/49/32.png').content
+        self.assertEqual(body[:8], b'\x89PNG\r\n\x1a\n')
+        self.assertEqual(self.upstream.requests, 0)
+
+
+class HeatMapTest(DjmpTestBase):
+    def setUp(self):
+        super(HeatMapTest, self).setUp()
+        hot_tile_cache.clear()
+        self.upstream = StubUpstream().start()
+        self.addCleanup(self.upstream.stop)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.tileset = Tileset.objects.get(pk=1)
+        self.tileset.server_url = self.upstream.url
+        self.tileset.directory = self.tmp_dir
+        self.tileset.save()
+        self.client.login(username='admin', password='admin')
+
+    def get(self, path):
+        res = self.client.get(reverse('tileset_mapproxy', args=(1, path)), **self.headers)
+        self.assertEqual(res.status_code, 200)
+        return res
+
+    def test_tms_and_wmts_hits_count_for_the_same_tile(self):
+        self.assertEqual(internal_tile_coord(('tms', 'EPSG3857', 5, 49, 31, 'png')), (49, 32, 6))
+        self.get('/wmts/streams/EPSG3857/6/49/32.png')
+        self.get('/tms/1.0.0/streams/EPSG3857/5/49/31.png')
+        self.get('/wmts/streams/EPSG3857/6/49/32.png')
+        self.get('/config')
+        # the tms request was answered from the tile MapProxy cached for wmts
+        self.assertEqual(self.upstream.requests, 1)
+        tile_hits.flush()
+        self.assertEqual(hot_tiles(self.tileset, 10), [(49, 32, 6, 3)])
+
+    def test_warm_hot_tiles(self):
+        self.get('/wmts/streams/EPSG3857/6/49/32.png')
+        tile_hits.flush()
+        res = warm_tileset(self.tileset, 10, 1)
+        self.assertEqual(res, {'hot_tiles': 1, 'tiles': 5, 'rendered_meta_tiles': 1})
+        mapproxy_cf, seed_cf = generate_confs(self.tileset)
+        tile_manager = mapproxy_cf.caches['tileset_cache'].caches()[0][2]
+        for x in (98, 99):
+            for y in (64, 65):
+                self.assertTrue(tile_manager.is_cached((x, y, 7)))
+
+        self.assertEqual(warm_tileset(self.tileset, 10, 1)['rendered_meta_tiles'], 0)
+        requests = self.upstream.requests
+        generation = get_seed_generation(self.tileset)
+        self.assertEqual(warm_tileset(self.tileset, 10, 1, refresh=True)['rendered_meta_tiles'], 2)
+        self.assertEqual(self.upstream.requests, requests + 2)
+        # cached copies of the refreshed tiles are dropped
+        self.assertNotEqual(get_seed_generation(self.tileset), generation)
+
+    def test_hits_are_flushed_after_the_interval(self):
+        hits = TileHits(3600)
+        hits.record(get_heat_map_filename(self.tileset), (49, 32, 6))
+        self.assertEqual(hot_tiles(self.tileset, 10), [])
+        hits.flush_interval = 0
+        hits.record(get_heat_map_filename(self.tileset), (49, 32, 6))
+        self.assertEqual(hot_tiles(self.tileset, 10), [(49, 32, 6, 2)])
+
+    def test_warm_in_background_process(self):
+        self.get('/wmts/streams/EPSG3857/6/49/32.png')
+        tile_hits.flush()
+        requests = self.upstream.requests
+        os.waitpid(warm_process_spawn(self.tileset, 10, 1), 0)
+        self.assertEqual(self.upstream.requests, requests + 1)
+
+
+class ReplayTest(DjmpTestBase):
+    def test_parse_log(self):
+        lines = [
+            '127.0.0.1 - - [10/Oct/2026:13:55:36 +0000] "GET /1/map/wmts/streams/EPSG3857/6/49/32.png HTTP/1.1" 200 10',
+            '127.0.0.1 - - [10/Oct/2026:13:55:37 +0000] "GET /api/tilesets/ HTTP/1.1" 200 10',
+            '/2/map/tms/1.0.0/roads/EPSG3857/5/49/31.png',
+        ]
+        self.assertEqual(parse_log(lines), [
+            (1, '/wmts/streams/EPSG3857/6/49/32.png', ''),
+            (2, '/tms/1.0.0/roads/EPSG3857/5/49/31.png', ''),
+        ])
+
+    def test_replay_wms_log_line(self):
+        upstream = StubUpstream().start()
+        self.addCleanup(upstream.stop)
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        tileset = Tileset.objects.get(pk=1)
+        tileset.server_url = upstream.url
+        tileset.directory = tmp_dir
+        tileset.save()
+        query = ('SERVICE=WMS&VERSION=1.1.1&REQUEST=GetMap&LAYERS=streams&STYLES=&SRS=EPSG%3A3857'
+                 '&BBOX=10793000,-614000,10812000,-595000&WIDTH=256&HEIGHT=256&FORMAT=image%2Fpng')
+        lines = ['127.0.0.1 - - [10/Oct/2026:13:55:36 +0000] "GET /1/map/service?{} HTTP/1.1" 200 10'.format(query)]
+        requests = parse_log(lines)
+        self.assertEqual(requests, [(1, '/service', query)])
+        self.assertEqual(request_path(*requests[0]), '/1/map/service?' + query)
+
+        # the replayed request is the logged GetMap, not the service metadata
+        self.client.login(username='admin', password='admin')
+        res = self.client.get(request_path(*requests[0]), **self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['Content-Type'], 'image/png')
+        self.assertTrue(upstream.requests > 0)
+
+    def test_generated_sessions(self):
+        tileset = Tileset.objects.get(pk=1)
+        paths = generate_sessions(tileset, 3, 5, seed=1)
+        self.assertEqual(paths, generate_sessions(tileset, 3, 5, seed=1))
+        tiles = [parse_tile_path(path) for path in paths]
+        self.assertTrue(tiles)
+        self.assertTrue(all(t[0] == 'wmts' and 6 <= t[2] <= 14 for t in tiles))
+
+    def test_replay_report(self):
+        results = {'/a': (200, 'hit'), '/b': (200, 'miss'), '/c': (404, None)}
+        report = replay(['/a', '/a', '/b', '/c'], lambda path: results[path], concurrency=2)
+        self.assertEqual(report['requests'], 4)
+        self.assertEqual(report['status'], {'200': 3, '404': 1})
+        self.assertEqual(report['cache'], {'hit': 2, 'miss': 1, 'none': 1})
+        self.assertEqual(report['hit_ratio'], round(2 / 3.0, 4))
+        self.assertTrue(report['latency_ms']['p50'] <= report['latency_ms']['p99'])
+
+
+class CleanupTest(DjmpTestBase):
+    def setUp(self):
+        super(CleanupTest, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.tileset = Tileset.objects.get(pk=1)
+        self.tileset.directory = self.tmp_dir
+        self.tileset.save()
+        mapproxy_cf, seed_cf = generate_confs(self.tileset)
+        self.tile_manager = mapproxy_cf.caches['tileset_cache'].caches()[0][2]
+
+    def store_tiles(self, coords):
+        tiles = []
+        for coord in coords:
+            buf = BytesIO()
+            # not single colored, tiles must not share a linked file
+            img = Image.new('RGBA', (256, 256), (0, 0, 255, 255))
+            img.putpixel((coord[0] % 256, 0), (255, 0, 0, 255))
+            img.save(buf, 'png')
+            tiles.append(Tile(coord, source=ImageSource(BytesIO(buf.getvalue()))))
+        self.tile_manager.cache.store_tiles(tiles)
+
+    def test_file_cache(self):
+        inside, outside, level_outside = (49, 32, 6), (0, 0, 6), (24, 16, 5)
+        self.store_tiles([inside, outside, level_outside])
+        report = cleanup_tiles(self.tileset)
+        self.assertEqual(report['tiles'], 2)
+        self.assertTrue(report['bytes'] > 0)
+        self.assertTrue(self.tile_manager.is_cached(inside))
+        self.assertFalse(self.tile_manager.is_cached(outside))
+        self.assertFalse(self.tile_manager.is_cached(level_outside))
+        self.assertEqual(get_status(self.tileset)['current']['cleanup']['tiles'], 2)
+        job = SeedJob.objects.get(tileset=self.tileset)
+        self.assertEqual((job.kind, job.tiles, job.bytes), ('cleanup', 2, report['bytes']))
+        # cleanups do not count for the seed estimate
+        self.assertEqual(seedestimate.seed_history(self.tileset)['source'], 'defaults')
+
+    def test_seed_holds_the_lock(self):
+        spawned = []
+        self.addCleanup(setattr, helpers, 'seed_process_spawn', helpers.seed_process_spawn)
+        self.addCleanup(setattr, helpers, 'cleanup_process_spawn', helpers.cleanup_process_spawn)
+        # the pid of a running process
+        helpers.seed_process_spawn = lambda tileset: spawned.append('seed') or os.getpid()
+        helpers.cleanup_process_spawn = lambda tileset, remove_before: spawned.append('cleanup') or os.getpid()
+        self.addCleanup(remove_lock_file, self.tileset)
+        self.assertEqual(self.tileset.seed(force=True)['status'], 'started')
+        self.assertTrue(os.path.exists(get_lock_filename(self.tileset)))
+        self.assertEqual(self.tileset.cleanup()['status'], 'already started')
+        self.assertEqual(spawned, ['seed'])
+
+        # the lock of a process that has exited is removed
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        with open(get_lock_filename(self.tileset), 'w') as f:
+            f.write('{}\n'.format(process.pid))
+        self.assertEqual(self.tileset.cleanup()['status'], 'started')
+        self.assertEqual(spawned, ['seed', 'cleanup'])
+
+    def test_remove_before(self):
+        old, new = (98, 65, 7), (49, 32, 6)
+        self.store_tiles([old, new])
+        filename = self.tile_manager.cache.tile_location(Tile(old))
+        os.utime(filename, (0, 0))
+        report = cleanup_tiles(self.tileset, remove_before=3600 * 24)
+        self.assertEqual(report['tiles'], 1)
+        self.assertFalse(self.tile_manager.is_cached(old))
+        self.assertTrue(self.tile_manager.is_cached(new))
+
+    def test_mbtiles(self):
+        filename = os.path.join(self.tmp_dir, 'tiles.mbtiles')
+        db = sqlite3.connect(filename)
+        db.execute('CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)')
+        # MapProxy stores the grid rows: WMTS 6/49/32 is row 32
+        rows = [(6, 49, 32, b'inside'), (6, 49, 31, b'north'), (5, 24, 15, b'level')]
+        db.executemany('INSERT INTO tiles VALUES (?, ?, ?, ?)', rows)
+        db.commit()
+        db.close()
+        removed = cleanup_mbtiles(filename, {6: (49, 32, 49, 32)})
+        self.assertEqual(removed, {'tiles': 2, 'bytes': len(b'north') + len(b'level')})
+        db = sqlite3.connect(filename)
+        self.assertEqual(db.execute('SELECT zoom_level, tile_column, tile_row FROM tiles').fetchall(), [(6, 49, 32)])
+        db.close()
+
+    def test_invalid_before(self):
+        self.client.login(username='admin', password='admin')
+        res = self.client.get(reverse('tileset_cleanup', args=(1,)), {'before': 'yesterday-ish'}, **self.headers)
+        self.assertEqual(res.status_code, 400)
+
+
+class TileIndexTest(DjmpTestBase):
+    def setUp(self):
+        super(TileIndexTest, self).setUp()
+        hot_tile_cache.clear()
+        tile_indexes.clear()
+        self.upstream = StubUpstream().start()
+        self.addCleanup(self.upstream.stop)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.tileset = Tileset.objects.get(pk=1)
+        self.tileset.server_url = self.upstream.url
+        self.tileset.directory = self.tmp_dir
+        self.tileset.save()
+        self.filename = get_tile_index_filename(self.tileset)
+        self.client.login(username='admin', password='admin')
+
+    def get(self, path):
+        return self.client.get(reverse('tileset_mapproxy', args=(1, path)), **self.headers)
+
+    def test_blocks(self):
+        filename = os.path.join(self.tmp_dir, 'test.tileindex')
+        self.assertIsNone(tile_indexes.contains(filename, (49, 32, 6)))
+        self.assertEqual(add_tiles(filename, [(49, 32, 6), (300, 2, 9), (49, 32, 6)]), 2)
+        self.assertTrue(tile_indexes.contains(filename, (49, 32, 6)))
+        self.assertFalse(tile_indexes.contains(filename, (49, 33, 6)))
+        self.assertFalse(tile_indexes.contains(filename, (0, 0, 9)))
+        self.assertEqual(add_tiles(filename, [(49, 32, 6), (0, 0, 9)]), 1)
+        # the blocks are read again once the file changed
+        os.utime(filename, (0, 0))
+        self.assertTrue(tile_indexes.contains(filename, (0, 0, 9)))
+        self.assertEqual(index_levels(filename), {6: 1, 9: 2})
+        self.assertEqual(add_tiles(os.path.join(self.tmp_dir, 'other.tileindex'), [(0, 0, 1)], create=False), 0)
+
+    def test_seeding_maintains_the_index(self):
+        self.addCleanup(process_metrics._counters.clear)
+        self.addCleanup(process_metrics._gauges.clear)
+        self.assertEqual(seed_tileset(self.tileset, zoom_stop=6)['status'], 'seeded')
+        # the index has the tiles the seed workers stored, of whole meta tiles
+        levels = index_levels(self.filename)
+        self.assertEqual(levels, {6: 16})
+        self.assertEqual(build_tile_index(self.tileset), 16)
+        self.assertEqual(index_levels(self.filename), levels)
+        level = get_status(self.tileset)['current']['tile_index']['levels'][6]
+        self.assertEqual((level['tiles'], level['coverage']), (16, 100.0))
+
+    def test_empty_tiles(self):
+        self.assertEqual(self.get('/wmts/streams/EPSG3857/6/49/32.png').status_code, 200)
+        out = StringIO()
+        call_command('djmp_index', '1', stdout=out)
+        self.assertIn('streams: 16 tiles indexed', out.getvalue())
+        self.addCleanup(setattr, views, 'DJMP_TILE_INDEX_EMPTY_TILES', False)
+        views.DJMP_TILE_INDEX_EMPTY_TILES = True
+        hot_tile_cache.clear()
+
+        res = self.get('/wmts/streams/EPSG3857/7/98/65.png')
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(res['X-Djmp-Cache'], 'empty')
+        self.assertEqual(self.get('/wmts/streams/EPSG3857/6/49/32.png').status_code, 200)
+        self.assertEqual(self.upstream.requests, 1)
+
+    def test_rendered_tiles_are_added(self):
+        add_tiles(self.filename, [(49, 32, 6)])
+        res = self.get('/wmts/streams/EPSG3857/7/98/65.png')
+        self.assertEqual(res['X-Djmp-Cache'], 'miss')
+        tile_index_writer.flush()
+        self.assertTrue(tile_indexes.contains(self.filename, (98, 65, 7)))
+        self.assertEqual(get_status(self.tileset)['current']['tile_index']['tiles'], 2)
+        # a cleanup builds the index again from the cache, with the whole meta tile
+        self.assertEqual(cleanup_tiles(self.tileset)['tiles'], 15)
+        self.assertEqual(index_levels(self.filename), {7: 1})
+
+    def test_tiles_stored_outside_tile_requests_are_added(self):
+        add_tiles(self.filename, [(0, 0, 6)])
+        res = self.client.get(reverse('tileset_tiles', args=(1,)) + '?tiles=6/49/32&render=1', **self.headers)
+        self.assertTrue(b''.join(res.streaming_content))
+        tile_index_writer.flush()
+        self.assertTrue(tile_indexes.contains(self.filename, (49, 32, 6)))
+
+        tile_hits.record(get_heat_map_filename(self.tileset), (49, 32, 6))
+        tile_hits.flush()
+        self.assertEqual(warm_tileset(self.tileset, 10, 1)['rendered_meta_tiles'], 1)
+        self.assertTrue(tile_indexes.contains(self.filename, (98, 65, 7)))
+
+    def test_compact_caches_are_not_indexed(self):
+        self.tileset.cache_type = 'compact'
+        self.assertIsNone(ensure_tile_index(self.tileset))
+        self.assertIsNone(build_tile_index(self.tileset))
+        self.assertFalse(os.path.exists(self.filename))
+
+
+class OutOfBoundsTest(DjmpTestBase):
+    def setUp(self):
+        super(OutOfBoundsTest, self).setUp()
+        hot_tile_cache.clear()
+        self.upstream = StubUpstream().start()
+        self.addCleanup(self.upstream.stop)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.tileset = Tileset.objects.get(pk=1)
+        self.tileset.server_url = self.upstream.url
+        self.tileset.directory = self.tmp_dir
+        self.tileset.save()
+        self.addCleanup(setattr, views, 'DJMP_OUT_OF_BOUNDS_TILES', views.DJMP_OUT_OF_BOUNDS_TILES)
+        views.DJMP_OUT_OF_BOUNDS_TILES = 'transparent'
+        self.client.login(username='admin', password='admin')
+
+    def get(self, path):
+        return self.client.get(reverse('tileset_mapproxy', args=(1, path)), **self.headers)
+
+    def test_ranges(self):
+        mapproxy_cf, seed_cf = generate_confs(self.tileset)
+        grid = mapproxy_cf.grids['EPSG3857'].tile_grid()
+        self.assertEqual(tileset_ranges.get(self.tileset, 'EPSG3857'), tile_ranges(self.tileset, grid))
+        self.assertIsNone(tileset_ranges.get(self.tileset, 'EPSG4326'))
+        self.tileset.layer_zoom_stop = 6
+        self.tileset.cache_grids = 'EPSG3857,EPSG4326'
+        self.assertEqual(sorted(tileset_ranges.get(self.tileset, 'EPSG3857')), [6])
+        self.assertEqual(sorted(tileset_ranges.get(self.tileset, 'EPSG4326')), [6])
+
+    def test_tiles_outside_the_tileset(self):
+        for path in ('/wmts/streams/EPSG3857/6/0/0.png', '/wmts/streams/EPSG3857/5/24/16.png',
+                     '/tms/1.0.0/streams/EPSG3857/4/0/0.png'):
+            res = self.get(path)
+            self.assertEqual(res.status_code, 200, path)
+            self.assertEqual(res['X-Djmp-Cache'], 'out-of-bounds')
+            self.assertEqual(Image.open(BytesIO(res.content)).getextrema()[3], (0, 0))
+        self.assertEqual(self.get('/wmts/streams/EPSG3857/6/0/0.jpeg').status_code, 404)
+        self.assertEqual(self.upstream.requests, 0)
+
+        # tms 5/49/31 is wmts 6/49/32
+        res = self.get('/tms/1.0.0/streams/EPSG3857/5/49/31.png')
+        self.assertEqual(res['X-Djmp-Cache'], 'miss')
+        # other layers are left to MapProxy
+        self.assertEqual(self.get('/wmts/rivers/EPSG3857/6/0/0.png').status_code, 400)
+
+        views.DJMP_OUT_OF_BOUNDS_TILES = '404'
+        self.assertEqual(self.get('/wmts/streams/EPSG3857/6/0/0.png').status_code, 404)
+        self.assertEqual(self.upstream.requests, 1)
+
+
+class SeedEstimateTest(DjmpTestBase):
+    def setUp(self):
+        super(SeedEstimateTest, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.tileset = Tileset.objects.get(pk=1)
+        self.tileset.directory = self.tmp_dir
+        self.tileset.save()
+
+    def add_job(self, tiles, size, duration, levels=()):
+        now = timezone.now()
+        job = self.tileset.seed_jobs.create(
+            started_at=now, finished_at=now, tiles=tiles, bytes=size, duration=duration)
+        for level, level_tiles, level_bytes, level_duration in levels:
+            job.levels.create(level=level, tiles=level_tiles, bytes=level_bytes, duration=level_duration)
+
+    def test_tile_counts(self):
+        mapproxy_cf, seed_cf = generate_confs(self.tileset)
+        grid = mapproxy_cf.grids['EPSG3857'].tile_grid()
+        ranges = tile_ranges(self.tileset, grid)
+        counts = level_tile_counts(self.tileset)
+        self.assertEqual(counts, dict(
+            (level, (x1 - x0 + 1) * (y1 - y0 + 1)) for level, (x0, y0, x1, y1) in ranges.items()))
+        self.assertEqual(level_tile_counts(self.tileset, 6, 7), {6: 1, 7: 1})
+        # a seed of the whole world to level 20 is counted without walking it
+        self.tileset.bbox_x0, self.tileset.bbox_y0, self.tileset.bbox_x1, self.tileset.bbox_y1 = -180, -85.06, 180, 85.06
+        self.assertEqual(level_tile_counts(self.tileset, 20, 20), {20: 4 ** 20})
+
+    def test_estimate_from_history(self):
+        estimate = estimate_seed(self.tileset, 6, 7)
+        self.assertEqual(estimate['history'], 'defaults')
+        self.assertEqual(estimate['levels'][6]['bytes'], DJMP_SEED_ESTIMATE_TILE_BYTES)
+
+        # level 6 has statistics of its own, level 7 uses those of the whole jobs
+        self.add_job(100, 1000000, 10.0, [(6, 10, 50000, 1.0)])
+        estimate = estimate_seed(self.tileset, 6, 7)
+        self.assertEqual(estimate['history'], 'tileset')
+        self.assertEqual(estimate['levels'][6], {'tiles': 1, 'bytes': 5000, 'duration': 0.1})
+        self.assertEqual(estimate['levels'][7], {'tiles': 1, 'bytes': 10000, 'duration': 0.1})
+        self.assertEqual((estimate['tiles'], estimate['bytes'], estimate['duration']), (2, 15000, 0.2))
+
+        other = Tileset.objects.get(pk=1)
+        other.pk = None
+        other.name = 'rivers'
+        other.save()
+        self.assertEqual(estimate_seed(other, 6, 6)['history'], 'all tilesets')
+
+    def test_budget(self):
+        self.addCleanup(setattr, seedestimate, 'DJMP_SEED_BUDGET_TILES', seedestimate.DJMP_SEED_BUDGET_TILES)
+        seedestimate.DJMP_SEED_BUDGET_TILES = 100
+        res = self.tileset.seed()
+        self.assertEqual(res['status'], 'unable to start')
+        self.assertIn('exceed the seed budget of 100 tiles', res['error'])
+        self.assertEqual(res['estimate']['tiles'], sum(level_tile_counts(self.tileset).values()))
+        self.assertFalse(os.path.exists(get_lock_filename(self.tileset)))
+
+        # only the budget check is tested, no seed process is started
+        spawned = []
+        self.addCleanup(setattr, helpers, 'seed_process_spawn', helpers.seed_process_spawn)
+        helpers.seed_process_spawn = lambda tileset: spawned.append(tileset.pk) or 42
+        self.client.login(username='admin', password='admin')
+        uri = reverse('tileset_seed', args=(1,))
+        res = json.loads(self.client.get(uri, **self.headers).content)
+        self.assertEqual(res['status'], 'unable to start')
+        self.assertEqual(spawned, [])
+        self.assertEqual(self.client.get(uri, {'force': '1'}, **self.headers).content, '{"status": "started"}')
+        self.assertEqual(spawned, [1])
+
+        uri = reverse('tileset_estimate', args=(1,))
+        res = json.loads(self.client.get(uri, **self.headers).content)
+        self.assertIn('exceed the seed budget', res['over_budget'])
+        res = json.loads(self.client.get(uri, {'zoom_start': 6, 'zoom_stop': 7}, **self.headers).content)
+        self.assertEqual((res['tiles'], res['over_budget']), (2, None))
+        self.assertEqual(self.client.get(uri, {'zoom_stop': 'x'}, **self.headers).status_code, 400)
+
+
+class CacheGridsTest(DjmpTestBase):
+    def setUp(self):
+        super(CacheGridsTest, self).setUp()
+        hot_tile_cache.clear()
+        self.upstream = StubUpstream().start()
+        self.addCleanup(self.upstream.stop)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.tileset = Tileset.objects.get(pk=1)
+        self.tileset.server_url = self.upstream.url
+        self.tileset.directory = self.tmp_dir
+        self.tileset.cache_grids = 'EPSG3857,EPSG4326'
+        self.tileset.save()
+        self.client.login(username='admin', password='admin')
+
+    def test_tiles_are_cached_per_grid(self):
+        mapproxy_cf, seed_cf = generate_confs(self.tileset)
+        caches = mapproxy_cf.caches['tileset_cache'].caches()
+        self.assertEqual([grid.name for grid, extent, tile_manager in caches], ['EPSG3857', 'EPSG4326'])
+        for grid, extent, tile_manager in caches:
+            self.assertEqual(tile_manager.cache.cache_dir, get_grid_cache_directory(self.tileset, grid.name))
+
+        for path in ('/wmts/streams/EPSG3857/6/49/32.png', '/wmts/streams/EPSG4326/6/49/16.png'):
+            res = self.client.get(reverse('tileset_mapproxy', args=(1, path)), **self.headers)
+            self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.upstream.requests, 2)
+        self.assertTrue(caches[0][2].is_cached((49, 32, 6)))
+        self.assertTrue(caches[1][2].is_cached((49, 16, 6)))
+
+        # the other tiles of both meta tiles are outside the bbox
+        self.assertTrue(cleanup_tiles(self.tileset)['tiles'] > 0)
+        self.assertTrue(caches[0][2].is_cached((49, 32, 6)))
+        self.assertTrue(caches[1][2].is_cached((49, 16, 6)))
+
+    def test_single_grid_caches(self):
+        self.tileset.cache_type = 'mbtiles'
+        with self.assertRaises(ConfigurationError):
+            generate_confs(self.tileset)
+
+
+class MultiTilesetAppTest(DjmpTestBase):
+    def setUp(self):
+        super(MultiTilesetAppTest, self).setUp()
+        hot_tile_cache.clear()
+        multi_tileset_apps.clear()
+        multi_tileset_apps.enabled = True
+        self.addCleanup(setattr, multi_tileset_apps, 'enabled', False)
+        self.addCleanup(multi_tileset_apps.clear)
+        self.upstream = StubUpstream().start()
+        self.addCleanup(self.upstream.stop)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.tileset = Tileset.objects.get(pk=1)
+        self.tileset.server_url = self.upstream.url
+        self.tileset.directory = self.tmp_dir
+        self.tileset.save()
+        self.client.login(username='admin', password='admin')
+
+    def get(self, pk, path):
+        return self.client.get(reverse('tileset_mapproxy', args=(pk, path)), **self.headers)
+
+    def test_cached_tiles_skip_the_miss_pool(self):
+        pool = MissPool(1, 1, 5.0)
+        runs = []
+        run = pool.run
+        pool.run = lambda tileset_pk, func: runs.append(tileset_pk) or run(tileset_pk, func)
+        self.addCleanup(setattr, views, 'miss_pool', views.miss_pool)
+        views.miss_pool = pool
+
+        self.assertEqual(self.get(1, '/wmts/streams/EPSG3857/6/49/32.png').status_code, 200)
+        self.assertEqual(runs, [1])
+        hot_tile_cache.clear()
+        self.assertEqual(self.get(1, '/wmts/streams/EPSG3857/6/49/32.png').status_code, 200)
+        self.assertEqual(runs, [1])
+        self.assertEqual(multi_tileset_apps.stats()[0]['builds'], 1)
+
+    def test_tilesets_share_an_app(self):
+        other = Tileset.objects.get(pk=1)
+        other.pk = None
+        other.name = 'rivers'
+        other.save()
+
+        res = self.get(1, '/wmts/streams/EPSG3857/6/49/32.png')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['X-Djmp-Cache'], 'miss')
+        self.assertEqual(self.get(1, '/tms/1.0.0/streams/EPSG3857/5/49/31.png').status_code, 200)
+        self.assertEqual(self.get(other.pk, '/wmts/rivers/EPSG3857/6/49/32.png').status_code, 200)
+        self.assertEqual(multi_tileset_apps.stats(), {0: {'tilesets': 2, 'builds': 1, 'failed': False}})
+        # the tms request was a cache hit, both layers use their own cache directory
+        self.assertEqual(self.upstream.requests, 2)
+
+        # a changed tileset rebuilds the app of its shard
+        self.tileset.layer_name = 'streams_v2'
+        self.tileset.save()
+        self.assertEqual(self.get(1, '/wmts/streams/EPSG3857/7/98/65.png').status_code, 200)
+        self.assertEqual(multi_tileset_apps.stats(), {0: {'tilesets': 2, 'builds': 2, 'failed': False}})
+
+        # layers of other tilesets are unknown to the app of the tileset
+        self.assertEqual(self.get(1, '/wmts/rivers/EPSG3857/7/98/64.png').status_code, 400)
+
+    def test_shards(self):
+        apps = MultiTilesetApps(2)
+        self.addCleanup(apps.clear)
+        other = Tileset.objects.get(pk=1)
+        other.pk = 2
+        other.name = 'rivers'
+        other.save()
+        self.assertIsNot(apps.app(self.tileset), apps.app(other))
+        self.assertEqual(apps.stats(), {
+            0: {'tilesets': 1, 'builds': 1, 'failed': False},
+            1: {'tilesets': 1, 'builds': 1, 'failed': False},
+        })
+
+    def test_unchanged_configuration_is_not_parsed(self):
+        apps = MultiTilesetApps(1)
+        self.addCleanup(apps.clear)
+        loads = []
+        self.addCleanup(setattr, yaml, 'safe_load', yaml.safe_load)
+        safe_load = yaml.safe_load
+        yaml.safe_load = lambda stream: loads.append(stream) or safe_load(stream)
+        app = apps.app(self.tileset)
+        self.assertEqual(len(loads), 1)
+        self.assertIs(apps.app(self.tileset), app)
+        self.assertEqual(len(loads), 1)
+
+
+class PrewarmTest(DjmpTestBase):
+    def setUp(self):
+        super(PrewarmTest, self).setUp()
+        self.addCleanup(tileset_apps.clear)
+        self.metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metrics_dir)
+        self.addCleanup(setattr, process_metrics, 'directory', process_metrics.directory)
+        process_metrics.directory = self.metrics_dir
+        self.tileset = Tileset.objects.get(pk=1)
+        self.other = Tileset.objects.get(pk=1)
+        self.other.pk = None
+        self.other.name = 'rivers'
+        self.other.save()
+
+    def test_apps_are_kept_until_the_tileset_changes(self):
+        mp, mapproxy_cf = get_mapproxy(self.tileset)
+        self.assertIs(get_mapproxy(self.tileset)[0], mp)
+        self.tileset.layer_name = 'streams_v2'
+        self.tileset.save()
+        self.assertIsNot(get_mapproxy(self.tileset)[0], mp)
+
+        apps = TilesetAppCache(1)
+        apps.set(1, 'a', 'app 1')
+        apps.set(2, 'a', 'app 2')
+        self.assertIsNone(apps.get(1, 'a'))
+        self.assertIsNone(apps.get(2, 'b'))
+        self.assertEqual(apps.stats(), {'apps': 0, 'size': 1, 'hits': 0, 'misses': 2})
+
+    def test_prewarm_most_requested(self):
+        process_metrics.inc('djmp_tile_requests_total', {'tileset': str(self.other.pk), 'status': '200'}, 10 ** 6)
+        process_metrics.inc('djmp_tile_requests_total', {'tileset': '1', 'status': '200'})
+        self.assertEqual([t.pk for t in most_requested_tilesets()], [self.other.pk, 1])
+        self.assertEqual([t.pk for t in most_requested_tilesets(1)], [self.other.pk])
+
+        results = []
+        summary = prewarm(most_requested_tilesets(1), lambda tileset, result: results.append((tileset.pk, result)))
+        self.assertEqual(summary['tilesets'], 1)
+        self.assertEqual(summary['errors'], 0)
+        self.assertEqual(results[0][0], self.other.pk)
+        self.assertIn(self.other.pk, tileset_apps)
+        self.assertNotIn(1, tileset_apps)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('djmp_prewarm', '--all', stdout=out)
+        self.assertIn('2 tilesets pre-warmed', out.getvalue())
+        self.assertIn(1, tileset_apps)
+        self.assertIn(self.other.pk, tileset_apps)
+        with self.assertRaises(CommandError):
+            call_command('djmp_prewarm', '999', stdout=out)
+
+
+class LazyImportTest(TestCase):
+    def test_startup_defers_heavy_imports(self):
+        # a fresh interpreter, this one has imported everything already
+        code = (
+            "import os, sys; os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'djmp.settings');"
+            "import django; django.setup(); import djmp.urls, djmp.admin;"
+            "print(' '.join(m for m in ('mapproxy', 'pyproj', 'webtest', 'psutil', 'PIL') if m in sys.modules))"
+        )
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+        self.assertEqual(out.strip(), '')
+
+
 class TilesetTestBase(DjmpTestBase):
     def setUp(self):
         super(TilesetTestBase, self).setUp()
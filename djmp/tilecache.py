@@ -0,0 +1,296 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+from .settings import (
+    DJMP_HOT_TILE_CACHE_BYTES, DJMP_HOT_TILE_CACHE_MAX_TILE_BYTES,
+    DJMP_SHARED_TILE_CACHE, DJMP_SHARED_TILE_CACHE_TIMEOUT,
+    DJMP_SHARED_TILE_CACHE_MAX_TILESET_BYTES, DJMP_SHARED_TILE_CACHE_LOCK_TIMEOUT,
+    DJMP_SHARED_TILE_CACHE_LOCK_WAIT
+)
+
+# tms: /tms/1.0.0/<layer>/<grid>/<z>/<x>/<y>.<ext>
+# wmts: /wmts/<layer>/<grid>/<z>/<x>/<y>.<ext> (see services_conf restful_template)
+# wmts coordinates are the internal ones of the north-west grid. MapProxy serves
+# tms with the global-mercator profile (south-west origin, first level skipped),
+# so the same coordinates address a different tile there.
+TILE_PATH_RE = re.compile(
+    r'^/(?P<service>tms|wmts)(?:/1\.0\.0)?/(?P<layer>[^/]+)/(?P<grid>[^/]+)/'
+    r'(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.(?P<ext>[a-z]+)$'
+)
+
+# rough per entry bookkeeping overhead (key tuple, headers, dict slot)
+ENTRY_OVERHEAD = 256
+
+
+def parse_tile_path(path_info):
+    """
+    Returns (service, grid, z, x, y, ext) for tms/wmts tile requests or None
+    for everything else (capabilities, wms, demo, ...).
+    """
+    match = TILE_PATH_RE.match(path_info)
+    if match is None:
+        return None
+    return (match.group('service'), match.group('grid'), int(match.group('z')),
+            int(match.group('x')), int(match.group('y')), match.group('ext'))
+
+
+class TileLRUCache(object):
+    """
+    Byte bounded LRU of encoded tile responses keyed by
+    (tileset pk, service, grid, z, x, y, ext).
+
+    Entries of a tileset are dropped as soon as a different seed generation is
+    seen for it (see helpers.get_seed_generation), so every worker process
+    notices finished seed jobs without any extra signalling.
+    """
+    def __init__(self, max_bytes, max_tile_bytes):
+        self.max_bytes = max_bytes
+        self.max_tile_bytes = max_tile_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generations = {}
+        self._tileset_bytes = {}
+        self._tileset_counts = {}
+        self.bytes = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, tileset_pk, tile):
+        key = (tileset_pk,) + tile
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            counts = self._tileset_counts.setdefault(tileset_pk, [0, 0])
+            if entry is None:
+                counts[1] += 1
+                return None
+            # re-insert to mark as most recently used
+            self._entries[key] = entry
+            counts[0] += 1
+            return entry[0], entry[1]
+
+    def set(self, tileset_pk, tile, body, headers):
+        size = len(body) + ENTRY_OVERHEAD
+        if not self.enabled or len(body) > self.max_tile_bytes:
+            return False
+        key = (tileset_pk,) + tile
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._account(tileset_pk, -old[2])
+            self._entries[key] = (body, headers, size)
+            self._account(tileset_pk, size)
+            while self.bytes > self.max_bytes and self._entries:
+                old_key, old = self._entries.popitem(last=False)
+                self._account(old_key[0], -old[2])
+                self.evictions += 1
+        return True
+
+    def _account(self, tileset_pk, size):
+        self.bytes += size
+        self._tileset_bytes[tileset_pk] = self._tileset_bytes.get(tileset_pk, 0) + size
+
+    def check_generation(self, tileset_pk, generation):
+        """
+        Drops all entries of a tileset when its seed generation changed.
+        """
+        if self._generations.get(tileset_pk, generation) != generation:
+            self.invalidate(tileset_pk)
+        self._generations[tileset_pk] = generation
+
+    def invalidate(self, tileset_pk):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == tileset_pk]:
+                self._account(tileset_pk, -self._entries.pop(key)[2])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+            self._tileset_bytes.clear()
+            self._tileset_counts.clear()
+            self.bytes = 0
+            self.evictions = 0
+
+    def stats(self, tileset_pk=None):
+        with self._lock:
+            if tileset_pk is None:
+                hits = sum(c[0] for c in self._tileset_counts.values())
+                misses = sum(c[1] for c in self._tileset_counts.values())
+                size = self.bytes
+                entries = len(self._entries)
+            else:
+                hits, misses = self._tileset_counts.get(tileset_pk, (0, 0))
+                size = self._tileset_bytes.get(tileset_pk, 0)
+                entries = len([k for k in self._entries if k[0] == tileset_pk])
+        requests = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(float(hits) / requests, 4) if requests else None,
+            'entries': entries,
+            'bytes': size,
+            'max_bytes': self.max_bytes,
+        }
+
+
+class SharedTileCache(object):
+    """
+    Second level tile cache shared between worker processes through a Django
+    cache backend (locmem, filebased, memcached, redis, ...).
+
+    The seed generation is part of every key, so a finished seed makes all
+    previous entries unreachable and they simply expire. Writes per tileset and
+    generation are capped by a byte counter kept in the same backend. Concurrent
+    misses for the same tile are collapsed with an add() based render lock.
+    """
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, alias, timeout, max_tileset_bytes, max_tile_bytes,
+                 lock_timeout, lock_wait):
+        self.alias = alias
+        self.timeout = timeout
+        self.max_tileset_bytes = max_tileset_bytes
+        self.max_tile_bytes = max_tile_bytes
+        self.lock_timeout = lock_timeout
+        self.lock_wait = lock_wait
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.over_budget = 0
+
+    @property
+    def enabled(self):
+        return self.alias is not None
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _key(self, tileset_pk, generation, tile):
+        return 'djmp:tile:{}:{}:{}:{}:{}:{}:{}.{}'.format(tileset_pk, generation, *tile)
+
+    def _bytes_key(self, tileset_pk, generation):
+        return 'djmp:tilebytes:{}:{}'.format(tileset_pk, generation)
+
+    def get(self, tileset_pk, generation, tile):
+        value = self.cache.get(self._key(tileset_pk, generation, tile))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, tileset_pk, generation, tile, body, headers):
+        if len(body) > self.max_tile_bytes:
+            return False
+        bytes_key = self._bytes_key(tileset_pk, generation)
+        self.cache.add(bytes_key, 0, self.timeout)
+        try:
+            used = self.cache.incr(bytes_key, len(body))
+        except ValueError:
+            # counter expired between add() and incr()
+            used = len(body)
+            self.cache.set(bytes_key, used, self.timeout)
+        if used > self.max_tileset_bytes:
+            self.over_budget += 1
+            return False
+        self.cache.set(self._key(tileset_pk, generation, tile), (body, headers), self.timeout)
+        return True
+
+    def acquire(self, tileset_pk, generation, tile):
+        """
+        Returns True if the caller should render the tile, False if another
+        worker already does.
+        """
+        return self.cache.add(self._key(tileset_pk, generation, tile) + ':lock', 1, self.lock_timeout)
+
+    def release(self, tileset_pk, generation, tile):
+        self.cache.delete(self._key(tileset_pk, generation, tile) + ':lock')
+
+    def wait(self, tileset_pk, generation, tile):
+        """
+        Polls for a tile rendered by another worker for at most `lock_wait`
+        seconds. Returns None if it did not show up in time.
+        """
+        self.waits += 1
+        key = self._key(tileset_pk, generation, tile)
+        deadline = time.time() + self.lock_wait
+        while time.time() < deadline:
+            time.sleep(self.POLL_INTERVAL)
+            value = self.cache.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+        return None
+
+    def stats(self, tileset_pk=None, generation=None):
+        res = {
+            'backend': self.alias,
+            'hits': self.hits,
+            'misses': self.misses,
+            'waits': self.waits,
+            'over_budget': self.over_budget,
+        }
+        if tileset_pk is not None:
+            res['bytes'] = self.cache.get(self._bytes_key(tileset_pk, generation), 0)
+            res['max_bytes'] = self.max_tileset_bytes
+        return res
+
+
+hot_tile_cache = TileLRUCache(DJMP_HOT_TILE_CACHE_BYTES, DJMP_HOT_TILE_CACHE_MAX_TILE_BYTES)
+
+shared_tile_cache = SharedTileCache(
+    DJMP_SHARED_TILE_CACHE,
+    DJMP_SHARED_TILE_CACHE_TIMEOUT,
+    DJMP_SHARED_TILE_CACHE_MAX_TILESET_BYTES,
+    DJMP_HOT_TILE_CACHE_MAX_TILE_BYTES,
+    DJMP_SHARED_TILE_CACHE_LOCK_TIMEOUT,
+    DJMP_SHARED_TILE_CACHE_LOCK_WAIT
+)
+
+
+def lookup_tile(tileset_pk, generation, tile):
+    """
+    Looks a tile up in the process local and the shared cache. Returns
+    ((body, headers, cache_status) or None, owns_lock).
+
+    On a miss `owns_lock` tells whether the caller holds the render lock for
+    the tile and has to call `store_tile` or `release_tile` once MapProxy
+    answered. A caller that gave up waiting for another worker renders the
+    tile as well, but leaves the lock and the cache to that worker.
+    """
+    hot_tile_cache.check_generation(tileset_pk, generation)
+    cached = hot_tile_cache.get(tileset_pk, tile)
+    if cached is not None:
+        return (cached[0], cached[1], 'hit'), False
+
+    if not shared_tile_cache.enabled:
+        return None, True
+    cached = shared_tile_cache.get(tileset_pk, generation, tile)
+    if cached is None:
+        if shared_tile_cache.acquire(tileset_pk, generation, tile):
+            return None, True
+        # another worker is rendering this tile right now
+        cached = shared_tile_cache.wait(tileset_pk, generation, tile)
+        if cached is None:
+            return None, False
+    hot_tile_cache.set(tileset_pk, tile, cached[0], cached[1])
+    return (cached[0], cached[1], 'hit-shared'), False
+
+
+def store_tile(tileset_pk, generation, tile, body, headers):
+    hot_tile_cache.set(tileset_pk, tile, body, headers)
+    if shared_tile_cache.enabled:
+        shared_tile_cache.set(tileset_pk, generation, tile, body, headers)
+
+
+def release_tile(tileset_pk, generation, tile):
+    if shared_tile_cache.enabled:
+        shared_tile_cache.release(tileset_pk, generation, tile)
@@ -0,0 +1,256 @@
+import logging
+import multiprocessing
+import os
+import re
+import sqlite3
+import time
+from io import BytesIO
+
+from .batchtiles import tile_manager_of
+from .helpers import (
+    close_db_connections, generate_confs, get_lock_file, get_tileset_location, remove_lock_file,
+    touch_seed_stamp, update_tileset_stats
+)
+from .mapproxy_config import image_conf
+from .tileindex import add_tiles, ensure_tile_index
+from .tileranges import in_tile_ranges, tile_ranges
+
+log = logging.getLogger('djmapproxy')
+
+TILE_FILE_RE = re.compile(r'^(\d+)\.(png|jpg|jpeg|webp)$')
+
+# encoded formats stored as they are, by image_conf format of the tileset
+CACHE_FORMATS = {
+    'image/png': ('png',),
+    'image/jpeg': ('jpeg',),
+    'mixed': ('png', 'jpeg'),
+}
+
+
+def encoded_format(data):
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if data[:2] == b'\xff\xd8':
+        return 'jpeg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+class MBTilesSource(object):
+    """
+    Tiles of an MBTiles file, whose rows count from the south. Every column
+    of a level is one import job.
+    """
+    flip_y = True
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.table = 'tiles'
+
+    def _connect(self):
+        return sqlite3.connect(self.filename, timeout=30)
+
+    def jobs(self):
+        db = self._connect()
+        try:
+            return db.execute(
+                'SELECT DISTINCT zoom_level, tile_column FROM [{}] ORDER BY zoom_level, tile_column'.format(self.table)
+            ).fetchall()
+        finally:
+            db.close()
+
+    def read(self, job):
+        """
+        Yields the (x, y, z) in grid coordinates (rows from the north) and
+        the encoded image of the tiles of a job.
+        """
+        z, x = job
+        db = self._connect()
+        try:
+            rows = db.execute(
+                'SELECT tile_row, tile_data FROM [{}] WHERE zoom_level = ? AND tile_column = ? ORDER BY tile_row'.format(
+                    self.table),
+                (z, x)
+            )
+            for row, data in rows:
+                yield (x, 2 ** z - 1 - row if self.flip_y else row, z), bytes(data)
+        finally:
+            db.close()
+
+
+class GeoPackageSource(MBTilesSource):
+    """
+    Tiles of a GeoPackage tile table (the first one if `table` is None),
+    whose rows count from the north.
+    """
+    flip_y = False
+
+    def __init__(self, filename, table=None):
+        MBTilesSource.__init__(self, filename)
+        if table is None:
+            db = self._connect()
+            try:
+                row = db.execute(
+                    "SELECT table_name FROM gpkg_contents WHERE data_type = 'tiles' ORDER BY table_name").fetchone()
+            finally:
+                db.close()
+            if row is None:
+                raise ValueError('{} has no tile table'.format(filename))
+            table = row[0]
+        self.table = table
+
+
+class DirectorySource(object):
+    """
+    Tiles of a z/x/y.ext directory pyramid, with rows from the north or, if
+    `tms`, from the south. Every x directory is one import job.
+    """
+    def __init__(self, directory, tms=False):
+        self.directory = directory
+        self.tms = tms
+
+    def jobs(self):
+        jobs = []
+        for z in sorted(os.listdir(self.directory), key=lambda n: (len(n), n)):
+            level_dir = os.path.join(self.directory, z)
+            if not z.isdigit() or not os.path.isdir(level_dir):
+                continue
+            jobs.extend((int(z), int(x)) for x in os.listdir(level_dir) if x.isdigit())
+        return sorted(jobs)
+
+    def read(self, job):
+        z, x = job
+        column_dir = os.path.join(self.directory, str(z), str(x))
+        for name in sorted(os.listdir(column_dir)):
+            match = TILE_FILE_RE.match(name)
+            if match is None:
+                continue
+            y = int(match.group(1))
+            with open(os.path.join(column_dir, name), 'rb') as f:
+                yield (x, 2 ** z - 1 - y if self.tms else y, z), f.read()
+
+
+def tile_source(location, source_format=None, table=None, tms=False):
+    """
+    Returns the tile source of an MBTiles or GeoPackage file or a directory,
+    guessing the format from the location if `source_format` is None.
+    """
+    if source_format is None:
+        if os.path.isdir(location):
+            source_format = 'dir'
+        else:
+            source_format = os.path.splitext(location)[1].lstrip('.')
+    if source_format == 'dir':
+        return DirectorySource(location, tms)
+    if source_format == 'mbtiles':
+        return MBTilesSource(location)
+    if source_format == 'gpkg':
+        return GeoPackageSource(location, table)
+    raise ValueError('unknown tile source format {}'.format(source_format))
+
+
+_worker = {}
+
+
+def _init_worker(tileset, batch_size, index_filename):
+    mapproxy_cf, seed_cf = generate_confs(tileset)
+    grid, tile_manager = tile_manager_of(mapproxy_cf)
+    _worker.update(tile_manager=tile_manager, ranges=tile_ranges(tileset, grid), batch_size=batch_size,
+                   index_filename=index_filename, formats=CACHE_FORMATS[image_conf(tileset)[0]])
+
+
+def _store(tile_manager, batch):
+    # the return values of the caches differ, they log failed writes themselves
+    if batch:
+        tile_manager.cache.store_tiles(batch)
+        if _worker['index_filename'] is not None:
+            add_tiles(_worker['index_filename'], [tile.coord for tile in batch], create=False)
+
+
+def import_job(args):
+    """
+    Stores the tiles of one job of a source inside the tile ranges of the
+    tileset in its cache, `batch_size` tiles at a time. Tiles in another
+    format than the cache are encoded again, tiles that cannot be decoded
+    are left out.
+    """
+    from mapproxy.cache.tile import Tile
+    from mapproxy.image import ImageSource
+
+    source, job = args
+    tile_manager, ranges, batch_size = _worker['tile_manager'], _worker['ranges'], _worker['batch_size']
+    counts = {'tiles': 0, 'skipped': 0, 'reencoded': 0, 'invalid': 0, 'bytes': 0}
+    batch = []
+    try:
+        for coord, data in source.read(job):
+            if not in_tile_ranges(ranges, *coord):
+                counts['skipped'] += 1
+                continue
+            tile_source = ImageSource(BytesIO(data))
+            if encoded_format(data) not in _worker['formats']:
+                try:
+                    tile_source = ImageSource(tile_source.as_image(), image_opts=tile_manager.image_opts)
+                except (IOError, ValueError) as ex:
+                    log.debug('not importing tile {} of {}: {}'.format(coord, job, ex))
+                    counts['invalid'] += 1
+                    continue
+                counts['reencoded'] += 1
+            batch.append(Tile(coord, tile_source))
+            counts['tiles'] += 1
+            counts['bytes'] += len(data)
+            if len(batch) >= batch_size:
+                _store(tile_manager, batch)
+                batch = []
+        _store(tile_manager, batch)
+    finally:
+        tile_manager.cleanup()
+    return counts
+
+
+def import_tiles(tileset, source, concurrency=2, batch_size=256, progress=None, interval=5.0):
+    """
+    Imports the tiles of `source` into the cache of a tileset with a pool of
+    `concurrency` processes while holding the tileset lock. Tiles outside the
+    bbox and zoom range of the tileset are skipped. `progress(status)` is
+    called every `interval` seconds with the jobs done and total and the tile
+    counts. Returns the counts, or None if the tileset is locked by a seed or
+    cleanup.
+    """
+    lock_file = get_lock_file(tileset)
+    if lock_file is None:
+        return None
+    lock_file.write('{}\n'.format(os.getpid()))
+    lock_file.close()
+    try:
+        if tileset.cache_type == 'mbtiles':
+            from .mbtiles import prepare_mbtiles
+            prepare_mbtiles(get_tileset_location(tileset))
+        index_filename = ensure_tile_index(tileset)
+        jobs = source.jobs()
+        start = last_report = time.time()
+        total = {'jobs': len(jobs), 'done': 0, 'tiles': 0, 'skipped': 0, 'reencoded': 0, 'invalid': 0, 'bytes': 0}
+        close_db_connections()
+        pool = multiprocessing.Pool(concurrency, _init_worker, (tileset, batch_size, index_filename))
+        try:
+            for counts in pool.imap_unordered(import_job, [(source, job) for job in jobs]):
+                total['done'] += 1
+                for key, value in counts.items():
+                    total[key] += value
+                if progress is not None and time.time() - last_report >= interval:
+                    last_report = time.time()
+                    progress(dict(total, tiles_per_second=total['tiles'] / (last_report - start)))
+        finally:
+            pool.close()
+            pool.join()
+        total['duration'] = time.time() - start
+        total['tiles_per_second'] = total['tiles'] / total['duration'] if total['duration'] else 0.0
+        if progress is not None:
+            progress(total)
+    finally:
+        remove_lock_file(tileset)
+
+    # tile caches of all worker processes drop their entries for this tileset
+    touch_seed_stamp(tileset)
+    update_tileset_stats(tileset)
+    return total
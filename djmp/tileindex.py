@@ -0,0 +1,377 @@
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from multiprocessing.util import Finalize
+
+from .batchtiles import tile_manager_of
+from .cleanup import _tile_coord
+from .fileutils import makedirs
+from .heatmap import internal_tile_coord
+from .helpers import generate_confs, get_tileset_base_folder, get_tileset_dir
+from .mapproxy_config import get_mbtiles_filename
+from .settings import DJMP_TILE_INDEX, DJMP_TILE_INDEX_CACHED_BLOCKS, DJMP_TILE_INDEX_FLUSH_INTERVAL
+from .tileranges import tile_ranges
+
+log = logging.getLogger('djmapproxy')
+
+# a block has one bit for each of BLOCK_SIZE x BLOCK_SIZE tiles of a level
+BLOCK_SHIFT = 8
+BLOCK_SIZE = 1 << BLOCK_SHIFT
+BLOCK_BYTES = BLOCK_SIZE * BLOCK_SIZE // 8
+
+# caches whose tiles are listed with a directory walk or one query, compact
+# caches would have to be asked for every tile of the coverage
+INDEXED_CACHE_TYPES = ('file', 'mbtiles', 'geopackage')
+
+
+def get_tile_index_filename(tileset):
+    return '{}/{}.tileindex'.format(get_tileset_base_folder(tileset), tileset.name)
+
+
+def _block_key(x, y, z):
+    return z, x >> BLOCK_SHIFT, y >> BLOCK_SHIFT
+
+
+def _bit(x, y):
+    i = (y & (BLOCK_SIZE - 1)) * BLOCK_SIZE + (x & (BLOCK_SIZE - 1))
+    return i >> 3, 1 << (i & 7)
+
+
+def _connect(filename):
+    db = sqlite3.connect(filename, timeout=30, isolation_level=None)
+    db.execute(
+        'CREATE TABLE IF NOT EXISTS blocks ('
+        'z INTEGER, x INTEGER, y INTEGER, tiles INTEGER, bits BLOB, PRIMARY KEY (z, x, y))'
+    )
+    return db
+
+
+def add_tiles(filename, coords, create=True):
+    """
+    Sets the bits of the (x, y, z) `coords` in an index file, in one
+    transaction so several processes can add tiles at once. Without `create`
+    tiles are only added to an existing index. Returns the number of new
+    tiles.
+    """
+    blocks = {}
+    for x, y, z in coords:
+        blocks.setdefault(_block_key(x, y, z), []).append((x, y))
+    if not blocks or not (create or os.path.isfile(filename)):
+        return 0
+    makedirs(os.path.dirname(filename))
+    added = 0
+    db = _connect(filename)
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        for key, tiles in blocks.items():
+            row = db.execute('SELECT tiles, bits FROM blocks WHERE z = ? AND x = ? AND y = ?', key).fetchone()
+            count, bits = (row[0], bytearray(zlib.decompress(bytes(row[1])))) if row else (0, bytearray(BLOCK_BYTES))
+            new = count
+            for x, y in tiles:
+                byte, mask = _bit(x, y)
+                if not bits[byte] & mask:
+                    bits[byte] |= mask
+                    count += 1
+            if count != new:
+                added += count - new
+                db.execute('INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?)',
+                           key + (count, sqlite3.Binary(zlib.compress(bytes(bits)))))
+        db.execute('COMMIT')
+    finally:
+        # an uncommitted transaction is rolled back
+        db.close()
+    return added
+
+
+def index_levels(filename):
+    """
+    Returns the number of indexed tiles per level, or None without index.
+    """
+    if not os.path.isfile(filename):
+        return None
+    db = _connect(filename)
+    try:
+        return dict(db.execute('SELECT z, SUM(tiles) FROM blocks GROUP BY z').fetchall())
+    finally:
+        db.close()
+
+
+class TileIndexCache(object):
+    """
+    Per process LRU of the `size` most recently read blocks of the index
+    files. The blocks of a file are read again once it changed.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._blocks = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def contains(self, filename, coord):
+        """
+        Returns whether the tile at the (x, y, z) `coord` is in the index
+        file, or None if there is no index.
+        """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        version = (st.st_mtime, st.st_size, st.st_ino)
+        key = (filename,) + _block_key(*coord)
+        with self._lock:
+            if self._versions.get(filename) != version:
+                for stale in [k for k in self._blocks if k[0] == filename]:
+                    del self._blocks[stale]
+                self._versions[filename] = version
+            bits = self._blocks.pop(key, None)
+        if bits is None:
+            bits = self._read_block(filename, key[1:])
+        with self._lock:
+            # re-insert to mark as most recently used
+            self._blocks[key] = bits
+            while len(self._blocks) > self.size:
+                self._blocks.popitem(last=False)
+        if not bits:
+            return False
+        byte, mask = _bit(coord[0], coord[1])
+        return bool(bits[byte] & mask)
+
+    def _read_block(self, filename, key):
+        db = sqlite3.connect(filename, timeout=30)
+        try:
+            row = db.execute('SELECT bits FROM blocks WHERE z = ? AND x = ? AND y = ?', key).fetchone()
+        except sqlite3.Error:
+            # created, but the table is not committed yet
+            row = None
+        finally:
+            db.close()
+        # empty blocks are cached as well
+        return bytearray(zlib.decompress(bytes(row[0]))) if row else bytearray()
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self._versions.clear()
+
+
+tile_indexes = TileIndexCache(DJMP_TILE_INDEX_CACHED_BLOCKS)
+
+
+class TileIndexWriter(object):
+    """
+    Collects the tiles stored by this process and adds them to the existing
+    index files at most every `flush_interval` seconds. Forked seed workers
+    flush when they exit.
+    """
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._pending = {}
+        self._last_flush = time.time()
+
+    def add(self, filename, coords):
+        with self._lock:
+            if os.getpid() != self._pid:
+                # tiles collected before the fork are flushed by the parent
+                self._pid = os.getpid()
+                self._pending = {}
+                Finalize(None, self.flush, exitpriority=10)
+            self._pending.setdefault(filename, set()).update(coords)
+        if self._last_flush + self.flush_interval < time.time():
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+        for filename, coords in pending.items():
+            try:
+                add_tiles(filename, coords, create=False)
+            except (sqlite3.Error, OSError) as ex:
+                log.warn('unable to add {} tiles to {}: {}'.format(len(coords), filename, ex))
+
+
+tile_index_writer = TileIndexWriter(DJMP_TILE_INDEX_FLUSH_INTERVAL)
+atexit.register(tile_index_writer.flush)
+
+
+def tile_in_index(tileset, tile):
+    """
+    Returns whether a parsed tile request is in the index of the tileset, or
+    None if the tileset or the grid of the request has no index.
+    """
+    coord = internal_tile_coord(tile) if DJMP_TILE_INDEX else None
+    if coord is None:
+        return None
+    return tile_indexes.contains(get_tile_index_filename(tileset), coord)
+
+
+def record_rendered_tile(tileset, tile):
+    coord = internal_tile_coord(tile)
+    if coord is not None:
+        tile_index_writer.add(get_tile_index_filename(tileset), [coord])
+
+
+def _file_cache_coords(cache_dir):
+    if not os.path.isdir(cache_dir):
+        return
+    for level_name in sorted(os.listdir(cache_dir)):
+        level_dir = os.path.join(cache_dir, level_name)
+        if not level_name.isdigit() or not os.path.isdir(level_dir):
+            continue
+        for root, dirs, files in os.walk(level_dir):
+            rel = os.path.relpath(root, level_dir)
+            rel_parts = [] if rel == os.curdir else rel.split(os.sep)
+            for name in files:
+                coord = _tile_coord(int(level_name), rel_parts + [name])
+                if coord is not None:
+                    yield coord
+
+
+def _sqlite_coords(filename, table):
+    if not os.path.isfile(filename):
+        return
+    db = sqlite3.connect(filename, timeout=30)
+    try:
+        # the tileset caches store the rows of the grid, see cleanup_mbtiles
+        for coord in db.execute('SELECT tile_column, tile_row, zoom_level FROM [{}]'.format(table)):
+            yield tuple(coord)
+    except sqlite3.OperationalError:
+        # nothing was stored yet
+        return
+    finally:
+        db.close()
+
+
+def cached_tile_coords(tileset, tile_manager):
+    """
+    Yields the (x, y, z) coords of the tiles in the EPSG:3857 cache of a
+    tileset, one of INDEXED_CACHE_TYPES.
+    """
+    if tileset.cache_type == 'file':
+        coords = _file_cache_coords(tile_manager.cache.cache_dir)
+    elif tileset.cache_type == 'mbtiles':
+        coords = _sqlite_coords(get_mbtiles_filename(tileset), 'tiles')
+    elif tileset.cache_type == 'geopackage':
+        coords = _sqlite_coords(tile_manager.cache.geopackage_file, tile_manager.cache.table_name)
+    else:
+        raise ValueError('{} caches cannot be indexed'.format(tileset.cache_type))
+    for coord in coords:
+        yield coord
+
+
+def build_tile_index(tileset, batch_size=4096):
+    """
+    Builds the index of a tileset from the tiles in its cache and replaces
+    the current one. Returns the number of indexed tiles, or None if the
+    cache cannot be indexed.
+    """
+    if tileset.cache_type not in INDEXED_CACHE_TYPES:
+        return None
+    mapproxy_cf, seed_cf = generate_confs(tileset)
+    grid, tile_manager = tile_manager_of(mapproxy_cf)
+    filename = get_tile_index_filename(tileset)
+    get_tileset_dir(tileset)
+    building = '{}.{}'.format(filename, os.getpid())
+    if os.path.exists(building):
+        os.remove(building)
+    _connect(building).close()
+
+    tiles = 0
+    batch = []
+    for coord in cached_tile_coords(tileset, tile_manager):
+        batch.append(coord)
+        if len(batch) >= batch_size:
+            tiles += add_tiles(building, batch)
+            batch = []
+    tiles += add_tiles(building, batch)
+    os.rename(building, filename)
+    return tiles
+
+
+def ensure_tile_index(tileset):
+    """
+    Builds the index of a tileset if it has none yet, so the tiles stored by
+    a seed or import complete it. Returns its filename, or None if indexes
+    are disabled or the cache cannot be indexed.
+    """
+    if not DJMP_TILE_INDEX or tileset.cache_type not in INDEXED_CACHE_TYPES:
+        return None
+    filename = get_tile_index_filename(tileset)
+    if not os.path.isfile(filename):
+        build_tile_index(tileset)
+    return filename
+
+
+def record_tile_index(tasks, filename):
+    """
+    Instruments the EPSG:3857 caches of the seed tasks to add the tiles they
+    store to the index `filename`. Has to be called before seeding starts, so
+    the forked workers inherit it.
+    """
+    for task in tasks:
+        _index_stores(task.tile_manager, filename)
+    return tasks
+
+
+def index_stored_tiles(tileset, tile_manager):
+    """
+    Instruments the EPSG:3857 cache of a tile manager that renders tiles
+    outside of tile requests, e.g. for batch tiles, exports or warming, to
+    add the tiles it stores to the index of the tileset, once it has one.
+    """
+    if DJMP_TILE_INDEX and tile_manager is not None:
+        _index_stores(tile_manager, get_tile_index_filename(tileset))
+    return tile_manager
+
+
+def _index_stores(tile_manager, filename):
+    cache = tile_manager.cache
+    if tile_manager.grid.name != 'EPSG3857' or getattr(cache, '_djmp_index_filename', None) is not None:
+        return
+    cache._djmp_index_filename = filename
+    if hasattr(cache, 'on_commit'):
+        # batched mbtiles caches store tiles when they commit them
+        cache.on_commit = lambda coords: tile_index_writer.add(filename, coords)
+        return
+    cache.store_tiles = _indexed_store(cache.store_tiles, filename)
+    cache.store_tile = _indexed_store(cache.store_tile, filename, single=True)
+
+
+def _indexed_store(store_func, filename, single=False):
+    def store(tiles):
+        try:
+            return store_func(tiles)
+        finally:
+            tile_index_writer.add(
+                filename, [t.coord for t in ([tiles] if single else tiles) if t.stored and t.coord is not None])
+    return store
+
+
+def tile_index_stats(tileset):
+    """
+    Returns the indexed tiles of every level of the tileset and their share
+    of the tiles in its bbox, or None without index.
+    """
+    levels = index_levels(get_tile_index_filename(tileset))
+    if levels is None:
+        return None
+    mapproxy_cf, seed_cf = generate_confs(tileset)
+    grid = tile_manager_of(mapproxy_cf)[0]
+    stats = {'tiles': sum(levels.values()), 'levels': {}}
+    for level, (x0, y0, x1, y1) in sorted(tile_ranges(tileset, grid).items()):
+        tiles = levels.get(level, 0)
+        range_tiles = (x1 - x0 + 1) * (y1 - y0 + 1)
+        stats['levels'][level] = {
+            'tiles': tiles,
+            'range_tiles': range_tiles,
+            # tiles outside the bbox are indexed until a cleanup removes them
+            'coverage': round(min(100.0, 100.0 * tiles / range_tiles), 1),
+        }
+    return stats
@@ -0,0 +1,92 @@
+import threading
+
+from .mapproxy_config import cache_grids, grids_conf
+
+
+def level_tile_range(grid, bbox, level):
+    """
+    Returns the (x0, y0, x1, y1) tile range of `bbox` at `level` in the
+    internal coordinates of `grid`, bounds included and limited to the grid.
+    """
+    # remove 1/10 of a pixel so tiles the bbox only touches are skipped
+    delta = grid.resolutions[level] / 10.0
+    x0, y0, _ = grid.tile(bbox[0] + delta, bbox[1] + delta, level)
+    x1, y1, _ = grid.tile(bbox[2] - delta, bbox[3] - delta, level)
+    # e.g. the default bbox reaches beyond the latitudes of EPSG:3857
+    width, height = grid.grid_sizes[level]
+    return (max(min(x0, x1), 0), max(min(y0, y1), 0),
+            min(max(x0, x1), width - 1), min(max(y0, y1), height - 1))
+
+
+def tile_ranges(tileset, grid):
+    """
+    Returns the tile range of the tileset bbox for every level of its zoom
+    range as {level: (x0, y0, x1, y1)}.
+    """
+    bbox = grid_bbox(tileset, grid)
+    return dict(
+        (level, level_tile_range(grid, bbox, level))
+        for level in range(tileset.layer_zoom_start, tileset.layer_zoom_stop + 1)
+    )
+
+
+def grid_bbox(tileset, grid):
+    if grid.srs.srs_code == 'EPSG:4326':
+        return tileset.bbox()
+    return tileset.bbox_3857()
+
+
+def in_tile_ranges(ranges, x, y, z):
+    tile_range = ranges.get(z)
+    if tile_range is None:
+        return False
+    x0, y0, x1, y1 = tile_range
+    return x0 <= x <= x1 and y0 <= y <= y1
+
+
+_grids = {}
+
+
+def named_grid(name):
+    """
+    Returns the tile grid `name` of grids_conf without loading a MapProxy
+    configuration.
+    """
+    from mapproxy.grid import tile_grid
+
+    grid = _grids.get(name)
+    if grid is None:
+        grid = _grids[name] = tile_grid(name=name, **grids_conf()[name])
+    return grid
+
+
+class TilesetRanges(object):
+    """
+    Per process tile ranges of every grid the tilesets cache, computed again
+    once the bbox, zoom range or grids of a tileset change.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ranges = {}
+
+    def get(self, tileset, grid_name):
+        """
+        Returns the tile ranges of the tileset in `grid_name`, or None if it
+        does not cache that grid.
+        """
+        key = (tileset.bbox_x0, tileset.bbox_y0, tileset.bbox_x1, tileset.bbox_y1,
+               tileset.layer_zoom_start, tileset.layer_zoom_stop, tileset.cache_grids)
+        with self._lock:
+            entry = self._ranges.get(tileset.pk)
+        if entry is None or entry[0] != key:
+            entry = key, dict((name, tile_ranges(tileset, named_grid(name))) for name in cache_grids(tileset))
+            with self._lock:
+                self._ranges[tileset.pk] = entry
+        return entry[1].get(grid_name)
+
+    def clear(self):
+        with self._lock:
+            self._ranges.clear()
+
+
+tileset_ranges = TilesetRanges()
@@ -0,0 +1,166 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from .settings import DJMP_SERVER_TIMING
+
+# upper bounds of the latency histogram buckets, larger values are counted in
+# a last overflow bucket
+LATENCY_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_local = threading.local()
+
+
+class RequestTiming(object):
+    """
+    Durations of the stages of one request in the order they first ran.
+    Stages that run more than once are summed up.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.stages = []
+
+    def add(self, name, seconds):
+        for stage in self.stages:
+            if stage[0] == name:
+                stage[1] += seconds
+                return
+        self.stages.append([name, seconds])
+
+    @contextmanager
+    def stage(self, name):
+        # keep nested stages after the stage they run in
+        self.add(name, 0)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def total(self):
+        return time.time() - self.start
+
+    def header_value(self, total=None):
+        if total is None:
+            total = self.total()
+        return ', '.join(
+            '{};dur={:.2f}'.format(name, seconds * 1000.0)
+            for name, seconds in self.stages + [['total', total]]
+        )
+
+
+def get_timing(request):
+    """
+    Returns the timing of a request, started by the first caller (usually the
+    permission decorator).
+    """
+    timing = getattr(request, '_djmp_timing', None)
+    if timing is None:
+        timing = request._djmp_timing = RequestTiming()
+    return timing
+
+
+@contextmanager
+def upstream_timing(timing):
+    """
+    Adds the HTTP requests MapProxy sends to the tileset source from this
+    thread to `timing` as the 'upstream' stage.
+    """
+    _local.timing = timing
+    try:
+        yield
+    finally:
+        _local.timing = None
+
+
+def time_upstream_requests(mapproxy_cf):
+    """
+    Wraps the HTTP clients of the tileset sources so their requests are
+    reported to the timing activated with `upstream_timing`.
+    """
+    for cache_conf in mapproxy_cf.caches.values():
+        for grid, extent, tile_manager in cache_conf.caches():
+            for source in tile_manager.sources:
+                http_client = getattr(getattr(source, 'client', None), 'http_client', None)
+                if http_client is not None and 'open' not in vars(http_client):
+                    http_client.open = _timed_open(http_client.open)
+
+
+def _timed_open(open_func):
+    def open(*args, **kwargs):
+        timing = getattr(_local, 'timing', None)
+        if timing is None:
+            return open_func(*args, **kwargs)
+        with timing.stage('upstream'):
+            return open_func(*args, **kwargs)
+    return open
+
+
+class LatencyHistograms(object):
+    """
+    Per tileset histograms of the request stage durations of this process.
+    """
+    def __init__(self, buckets_ms):
+        self.buckets_ms = buckets_ms
+        self._lock = threading.Lock()
+        self._tilesets = {}
+
+    def _bucket(self, ms):
+        for i, bound in enumerate(self.buckets_ms):
+            if ms <= bound:
+                return i
+        return len(self.buckets_ms)
+
+    def record(self, tileset_pk, timing, total):
+        with self._lock:
+            stages = self._tilesets.setdefault(tileset_pk, {})
+            for name, seconds in timing.stages + [['total', total]]:
+                ms = seconds * 1000.0
+                hist = stages.get(name)
+                if hist is None:
+                    hist = stages[name] = {'count': 0, 'sum_ms': 0.0, 'counts': [0] * (len(self.buckets_ms) + 1)}
+                hist['count'] += 1
+                hist['sum_ms'] += ms
+                hist['counts'][self._bucket(ms)] += 1
+
+    def stats(self, tileset_pk):
+        with self._lock:
+            stages = self._tilesets.get(tileset_pk, {})
+            return {
+                'buckets_ms': list(self.buckets_ms),
+                'stages': dict(
+                    (name, {
+                        'count': hist['count'],
+                        'sum_ms': round(hist['sum_ms'], 3),
+                        'counts': list(hist['counts']),
+                    }) for name, hist in stages.items()
+                ),
+            }
+
+    def snapshot(self):
+        with self._lock:
+            return dict(
+                (str(tileset_pk), dict(
+                    (name, {'count': hist['count'], 'sum_ms': hist['sum_ms'], 'counts': list(hist['counts'])})
+                    for name, hist in stages.items()
+                )) for tileset_pk, stages in self._tilesets.items()
+            )
+
+    def clear(self):
+        with self._lock:
+            self._tilesets.clear()
+
+
+latency_histograms = LatencyHistograms(LATENCY_BUCKETS_MS)
+
+
+def finish_timing(timing, tileset_pk, response):
+    """
+    Records the request in the latency histograms and adds the
+    Server-Timing header if enabled.
+    """
+    total = timing.total()
+    latency_histograms.record(tileset_pk, timing, total)
+    if DJMP_SERVER_TIMING:
+        response['Server-Timing'] = timing.header_value(total)
+    return response
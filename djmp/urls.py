@@ -4,14 +4,18 @@ from django.contrib import admin
 
 from tastypie.api import Api
 
-from .api import TilesetResource
+from .api import SeedJobResource, TilesetResource
 from .decorators import view_tileset_permissions
-from .views import DetailView, seed, tileset_status, tileset_mapproxy
+from .views import (
+    DetailView, metrics, seed, tileset_cleanup, tileset_estimate, tileset_export, tileset_status,
+    tileset_mapproxy, tileset_tiles
+)
 
 admin.autodiscover()
 
 api = Api(api_name='api')
 api.register(TilesetResource())
+api.register(SeedJobResource())
 
 urlpatterns = patterns('',
     url(
@@ -20,12 +24,17 @@ urlpatterns = patterns('',
         name='tileset_detail'
     ),
     url(r'^(?P<pk>\d+)/seed$', seed, name='tileset_seed'),
+    url(r'^(?P<pk>\d+)/estimate$', tileset_estimate, name='tileset_estimate'),
+    url(r'^(?P<pk>\d+)/cleanup$', tileset_cleanup, name='tileset_cleanup'),
     url(r'^(?P<pk>\d+)/status$', tileset_status, name='tileset_status'),
+    url(r'^(?P<pk>\d+)/tiles$', tileset_tiles, name='tileset_tiles'),
+    url(r'^(?P<pk>\d+)/export$', tileset_export, name='tileset_export'),
     url(
         r'^(?P<pk>\d+)/map(?P<path_info>/.*)$',
         tileset_mapproxy,
         name='tileset_mapproxy'
     ),
+    url(r'^metrics$', metrics, name='djmp_metrics'),
     (r'^admin/', include(admin.site.urls)),
     url(r'', include(api.urls)),
 )
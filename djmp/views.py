@@ -3,26 +3,40 @@ import logging
 import os
 import tempfile
 import time
+from io import BytesIO
 
 from django.shortcuts import get_object_or_404, render
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import FileResponse, HttpResponseRedirect, HttpResponse, StreamingHttpResponse
 from django.core.urlresolvers import reverse
 from django.views import generic
 from django.contrib.auth.decorators import login_required
-from django.contrib.auth.models import User
 from django.http import HttpResponse
 from guardian.decorators import permission_required_or_403
-from mapproxy.config.config import load_default_config, load_config
-from mapproxy.util.ext.dictspec.validator import validate, ValidationError
-from mapproxy.config.loader import ProxyConfiguration, ConfigurationError
-from mapproxy.wsgiapp import MapProxyApp
-from webtest import TestApp as TestApp_
-import yaml
 
+from .appcache import tileset_apps
+from .batchtiles import coverage_order, load_tiles, multipart_tiles, parse_tile_list, tile_manager_of
+from .compact import read_bundle_tile
 from .decorators import view_tileset_permissions
+from .heatmap import internal_tile_coord, record_tile_hit
+from .mapproxy_config import get_grid_cache_directory, get_mapproxy_conf, tile_extension, u_to_str
 from .models import Tileset
-from .helpers import get_status, generate_confs
-from .validator import validate_references, validate_options
+from .multiapp import multi_tileset_apps, multi_tileset_path
+from .helpers import get_status, generate_confs, get_seed_generation, get_tileset_dir
+from .metrics import collect, record_tile_request, render_metrics
+from .misspool import MissPoolBusy, MissPoolFull, miss_pool
+from .settings import (
+    DJMP_BATCH_TILES_MAX, DJMP_EXPORT_MAX_TILES, DJMP_OUT_OF_BOUNDS_TILES,
+    DJMP_TILE_INDEX_EMPTY_TILES
+)
+from .tilecache import (
+    TILE_PATH_RE, lookup_tile, parse_tile_path, release_tile, store_tile
+)
+from .tileindex import index_stored_tiles, record_rendered_tile, tile_in_index
+from .tileranges import in_tile_ranges, tile_ranges, tileset_ranges
+from .timing import (
+    LATENCY_BUCKETS_MS, RequestTiming, finish_timing, get_timing, time_upstream_requests,
+    upstream_timing
+)
 
 log = logging.getLogger('mapproxy.config')
 
@@ -35,8 +49,13 @@ class DetailView(generic.DetailView):
 @login_required
 @view_tileset_permissions
 def seed(request, pk):
+    """
+    Starts seeding the tileset, `force=1` starts it even if its estimate
+    exceeds the seed budget.
+    """
     tileset = get_object_or_404(Tileset, pk=pk)
-    return HttpResponse(json.dumps(tileset.seed()))
+    force = request.GET.get('force', '').lower() in ('1', 'true', 'yes')
+    return HttpResponse(json.dumps(tileset.seed(force=force)))
 
 
 @login_required
@@ -46,14 +65,108 @@ def tileset_status(request, pk):
     return HttpResponse(json.dumps(get_status(tileset)))
 
 
-class TestApp(TestApp_):
+@login_required
+@view_tileset_permissions
+def tileset_estimate(request, pk):
+    """
+    Estimates the tiles, disk usage and duration of seeding the tileset,
+    optionally for another `zoom_start`..`zoom_stop`, and whether the seed
+    budget allows it.
+    """
+    from .seedestimate import estimate_seed, over_budget
+
+    tileset = get_object_or_404(Tileset, pk=pk)
+    try:
+        zooms = [int(request.GET[key]) if request.GET.get(key) else None for key in ('zoom_start', 'zoom_stop')]
+    except ValueError as e:
+        return HttpResponse(json.dumps({'error': str(e)}), status=400, content_type='application/json')
+    estimate = estimate_seed(tileset, *zooms)
+    estimate['over_budget'] = over_budget(estimate)
+    return HttpResponse(json.dumps(estimate), content_type='application/json')
+
+
+@login_required
+@view_tileset_permissions
+def tileset_cleanup(request, pk):
+    tileset = get_object_or_404(Tileset, pk=pk)
+    remove_before = None
+    if request.GET.get('before'):
+        from dateutil import parser
+        try:
+            remove_before = time.mktime(parser.parse(request.GET['before']).timetuple())
+        except (ValueError, OverflowError):
+            return HttpResponse(json.dumps({'status': 'unable to start', 'error': 'invalid before date'}), status=400)
+    return HttpResponse(json.dumps(tileset.cleanup(remove_before)))
+
+
+@view_tileset_permissions
+def tileset_tiles(request, pk):
     """
-    Wraps webtest.TestApp and explicitly converts URLs to strings.
-    Behavior changed with webtest from 1.2->1.3.
+    Streams many tiles of a tileset as one multipart/mixed response, listed as
+    `tiles=z/x/y,...` and `range=z/x0/y0/x1/y1` in the XYZ (WMTS) coordinates
+    of the EPSG:3857 grid. Tiles outside the tileset are left out, the others
+    are read in the order the cache stores them. Only cached tiles are sent
+    unless `render=1` asks to render the missing ones.
     """
-    def get(self, url, *args, **kw):
-        kw['expect_errors'] = True
-        return TestApp_.get(self, str(url), *args, **kw)
+    tileset = get_object_or_404(Tileset, pk=pk)
+    mp, mapproxy_cf = get_mapproxy(tileset)
+    grid, tile_manager = tile_manager_of(mapproxy_cf)
+    index_stored_tiles(tileset, tile_manager)
+    try:
+        coords = parse_tile_list(request.GET.getlist('tiles'), request.GET.getlist('range'))
+        coords = coverage_order(coords, tile_ranges(tileset, grid), DJMP_BATCH_TILES_MAX)
+    except ValueError as e:
+        return HttpResponse(json.dumps({'error': str(e)}), status=400, content_type='application/json')
+
+    render = request.GET.get('render') == '1'
+    tiles = ((coord, tile_mimetype(body), body) for coord, body in load_tiles(tile_manager, coords, render))
+    boundary, body = multipart_tiles(tiles)
+    return StreamingHttpResponse(body, content_type='multipart/mixed; boundary={}'.format(boundary))
+
+
+@view_tileset_permissions
+def tileset_export(request, pk):
+    """
+    Sends the cached tiles of a `bbox` (EPSG:4326, the tileset bbox if
+    omitted) and `zoom_start`..`zoom_stop` as a `format=mbtiles` or `gpkg`
+    file. The file is sent with the file wrapper of the WSGI server, which
+    uses sendfile. Missing tiles are only rendered by the djmp_export
+    command, viewers must not be able to start renders of this size.
+    """
+    from .export import EXPORT_FORMATS, count_tiles, export_ranges, export_tiles, parse_bbox
+
+    tileset = get_object_or_404(Tileset, pk=pk)
+    export_format = request.GET.get('format', 'mbtiles')
+    mp, mapproxy_cf = get_mapproxy(tileset)
+    grid = tile_manager_of(mapproxy_cf)[0]
+    try:
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError('unknown format {}'.format(export_format))
+        bbox = parse_bbox(request.GET['bbox']) if request.GET.get('bbox') else None
+        zooms = [int(request.GET[key]) if request.GET.get(key) else None for key in ('zoom_start', 'zoom_stop')]
+        ranges = export_ranges(tileset, grid, bbox, *zooms)
+        if count_tiles(ranges) > DJMP_EXPORT_MAX_TILES:
+            raise ValueError('more than {} tiles requested'.format(DJMP_EXPORT_MAX_TILES))
+    except ValueError as e:
+        return HttpResponse(json.dumps({'error': str(e)}), status=400, content_type='application/json')
+
+    export_dir = os.path.join(get_tileset_dir(tileset), 'exports')
+    if not os.path.isdir(export_dir):
+        os.makedirs(export_dir)
+    fd, filename = tempfile.mkstemp(suffix='.' + export_format, dir=export_dir)
+    os.close(fd)
+    try:
+        export_tiles(tileset, filename, export_format, bbox, zooms[0], zooms[1], mapproxy_cf=mapproxy_cf)
+        export_file = open(filename, 'rb')
+    finally:
+        # the open file is sent, nothing is left behind
+        os.remove(filename)
+
+    content_type = 'application/geopackage+sqlite3' if export_format == 'gpkg' else 'application/x-sqlite3'
+    response = FileResponse(export_file, content_type=content_type)
+    response['Content-Length'] = os.fstat(export_file.fileno()).st_size
+    response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(u_to_str(tileset.name), export_format)
+    return response
 
 
 def simple_name(layer_name):
@@ -65,18 +178,33 @@ def simple_name(layer_name):
     return layer_name
 
 
-def get_mapproxy(tileset):
+def get_mapproxy(tileset, timing=None):
     """Creates a mapproxy config for a given layer-like object.
        Compatible with django-registry and GeoNode.
     """
-    
-    mapproxy_cf, seed_cf = generate_confs(tileset)
+    from mapproxy.wsgiapp import MapProxyApp
+    from .testapp import TestApp
+
+    timing = timing or RequestTiming()
+
+    with timing.stage('config'):
+        fingerprint = get_mapproxy_conf(tileset)
+    cached = tileset_apps.get(tileset.pk, fingerprint)
+    if cached is not None:
+        return cached
+
+    with timing.stage('config'):
+        mapproxy_cf, seed_cf = generate_confs(tileset)
 
     # Create a MapProxy App
-    app = MapProxyApp(mapproxy_cf.configured_services(), mapproxy_cf.base_config)
+    with timing.stage('app'):
+        app = MapProxyApp(mapproxy_cf.configured_services(), mapproxy_cf.base_config)
+        time_upstream_requests(mapproxy_cf)
 
     # Wrap it in an object that allows to get requests by path as a string.
-    return TestApp(app), mapproxy_cf
+    mp = TestApp(app), mapproxy_cf
+    tileset_apps.set(tileset.pk, fingerprint, mp)
+    return mp
 
 
 @view_tileset_permissions
@@ -84,32 +212,224 @@ def tileset_mapproxy(request, pk, path_info):
     # TODO(mvv): this could be handled as a decorator or some
     #            other more generalizable pattern
 
-    tileset = get_object_or_404(Tileset, pk=pk)
-    mp, yaml_config = get_mapproxy(tileset)
+    timing = get_timing(request)
+    with timing.stage('db'):
+        tileset = get_object_or_404(Tileset, pk=pk)
 
-    params = {}
-    headers = {
-       'X-Script-Name': str(request.path_info.replace(path_info.lstrip('/'), '')),
-       'X-Forwarded-Host': request.META['HTTP_HOST'],
-       'HTTP_HOST': request.META['HTTP_HOST'],
-       'SERVER_NAME': request.META['SERVER_NAME'],
-    }
+    response = mapproxy_response(request, tileset, path_info, timing)
+    finish_timing(timing, tileset.pk, response)
+    record_tile_request(tileset.pk, response)
+    if not request.META['QUERY_STRING']:
+        record_tile_hit(tileset, tileset_tile(tileset, path_info), response)
+    return response
 
-    if path_info == '/config':
-        response = HttpResponse(yaml_config, content_type='text/plain')
-        return response
 
+def metrics(request):
+    """
+    Tile traffic and seed metrics of all processes in the Prometheus text format.
+    """
+    text = render_metrics(collect(), LATENCY_BUCKETS_MS)
+    return HttpResponse(text, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def mapproxy_response(request, tileset, path_info, timing):
     query = request.META['QUERY_STRING']
 
-    if len(query) > 0:
-        path_info = path_info + '?' + query
+    tile = None
+    indexed = None
+    owns_lock = False
+    if len(query) == 0:
+        tile = tileset_tile(tileset, path_info)
+    if tile is not None:
+        if DJMP_OUT_OF_BOUNDS_TILES and out_of_bounds(tileset, tile):
+            return out_of_bounds_response(tile)
 
-    # Get a response from MapProxy as if it was running standalone.
-    mp_response = mp.get(path_info, params, headers)
+        if tileset.cache_type == 'compact':
+            with timing.stage('bundle'):
+                body = read_compact_tile(tileset, tile)
+            if body is not None:
+                return tile_response(body, 200, [('Content-Type', tile_mimetype(body))], 'hit-bundle')
 
-    # Create a Django response from the MapProxy WSGI response.
-    response = HttpResponse(mp_response.body, status=mp_response.status_int)
-    for header, value in mp_response.headers.iteritems():
-        response[header] = value
+        with timing.stage('cache'):
+            generation = get_seed_generation(tileset)
+            cached, owns_lock = lookup_tile(tileset.pk, generation, tile)
+        if cached is not None:
+            return tile_response(cached[0], 200, cached[1], cached[2])
+
+        with timing.stage('cache'):
+            indexed = tile_in_index(tileset, tile)
+        if indexed is False and DJMP_TILE_INDEX_EMPTY_TILES:
+            # only seeded tiles are served, nothing to render
+            if owns_lock:
+                release_tile(tileset.pk, generation, tile)
+            return tile_response('tile not cached', 404, [('Content-Type', 'text/plain')], 'empty')
 
+    handed_over = False
+    try:
+        params = {}
+        headers = {
+           'X-Script-Name': str(request.path_info.replace(path_info.lstrip('/'), '')),
+           'X-Forwarded-Host': request.META['HTTP_HOST'],
+           'HTTP_HOST': request.META['HTTP_HOST'],
+           'SERVER_NAME': request.META['SERVER_NAME'],
+        }
+
+        mp = None
+        yaml_config = None
+        cache_conf = None
+        if tile is not None and multi_tileset_apps.serves(tileset):
+            app_path_info = multi_tileset_path(tileset, path_info)
+            if app_path_info is not None:
+                with timing.stage('app'):
+                    mp = multi_tileset_apps.app(tileset)
+                if mp is not None:
+                    path_info = app_path_info
+                    cache_conf = multi_tileset_apps.tileset_cache(tileset)
+        if mp is None:
+            mp, yaml_config = get_mapproxy(tileset, timing)
+            cache_conf = yaml_config.caches['tileset_cache']
+
+        if path_info == '/config':
+            response = HttpResponse(yaml_config, content_type='text/plain')
+            return response
+
+        if len(query) > 0:
+            path_info = path_info + '?' + query
+
+        def render():
+            # Get a response from MapProxy as if it was running standalone.
+            with timing.stage('mapproxy'), upstream_timing(timing):
+                mp_response = mp.get(path_info, params, headers)
+            if tile is not None and mp_response.status_int == 200 \
+                    and mp_response.content_type.startswith('image/'):
+                with timing.stage('cache'):
+                    if owns_lock:
+                        store_tile(tileset.pk, generation, tile, mp_response.body, mp_response.headers.items())
+                    if indexed is False:
+                        record_rendered_tile(tileset, tile)
+            return mp_response
+
+        if tile is not None and miss_pool.enabled and \
+                not (indexed if indexed is not None else tile_is_cached(cache_conf, tile)):
+            submitted = time.time()
+
+            def render_miss():
+                # caches the tile even if the request stopped waiting for it
+                timing.add('queue', time.time() - submitted)
+                try:
+                    return render()
+                finally:
+                    if owns_lock:
+                        release_tile(tileset.pk, generation, tile)
+
+            handed_over = True
+            try:
+                mp_response = miss_pool.run(tileset.pk, render_miss)
+            except MissPoolBusy as e:
+                # a rejected miss never ran, its render lock is released below
+                handed_over = not isinstance(e, MissPoolFull)
+                log.debug('tile request of tileset {} not served: {}'.format(tileset.pk, e))
+                return tile_response(str(e), 503, [('Content-Type', 'text/plain'), ('Retry-After', '1')], 'busy')
+        else:
+            mp_response = render()
+        mp_headers = mp_response.headers.items()
+
+        if tile is not None and mp_response.status_int == 200 \
+                and mp_response.content_type.startswith('image/'):
+            with timing.stage('response'):
+                return tile_response(mp_response.body, 200, mp_headers, 'miss')
+    finally:
+        if owns_lock and not handed_over:
+            release_tile(tileset.pk, generation, tile)
+
+    with timing.stage('response'):
+        return tile_response(mp_response.body, mp_response.status_int, mp_headers)
+
+
+def tile_is_cached(cache_conf, tile):
+    """
+    Returns True if MapProxy has a tile in the cache of the tileset, so it
+    can be served without waiting behind the misses of the miss pool.
+    """
+    coord = internal_tile_coord(tile)
+    if cache_conf is None or coord is None:
+        return False
+    for grid, extent, tile_manager in cache_conf.caches():
+        if grid.name == tile[1]:
+            return tile_manager.is_cached(coord)
+    return False
+
+
+def tileset_tile(tileset, path_info):
+    """
+    Returns the parsed tile request if it asks for the layer of the tileset.
+    Requests for other layers are left to MapProxy, the tile caches only
+    key tiles by the tileset.
+    """
+    match = TILE_PATH_RE.match(path_info)
+    if match is None or match.group('layer') != u_to_str(tileset.name):
+        return None
+    return parse_tile_path(path_info)
+
+
+def out_of_bounds(tileset, tile):
+    """
+    Returns True if a tile request is outside the bbox or zoom range of the
+    tileset in the grid it asks for.
+    """
+    service, grid, z, x, y, ext = tile
+    # wmts requests use the internal tile coordinates (see tilecache.TILE_PATH_RE)
+    coord = (x, y, z) if service == 'wmts' else internal_tile_coord(tile)
+    ranges = tileset_ranges.get(tileset, grid) if coord is not None else None
+    return ranges is not None and not in_tile_ranges(ranges, *coord)
+
+
+_transparent_png = []
+
+
+def transparent_png():
+    if not _transparent_png:
+        from PIL import Image
+
+        buf = BytesIO()
+        Image.new('RGBA', (256, 256), (0, 0, 0, 0)).save(buf, 'png', optimize=True)
+        _transparent_png.append(buf.getvalue())
+    return _transparent_png[0]
+
+
+def out_of_bounds_response(tile):
+    if DJMP_OUT_OF_BOUNDS_TILES == 'transparent' and tile[5] == 'png':
+        return tile_response(transparent_png(), 200, [('Content-Type', 'image/png')], 'out-of-bounds')
+    return tile_response('tile outside the tileset', 404, [('Content-Type', 'text/plain')], 'out-of-bounds')
+
+
+def read_compact_tile(tileset, tile):
+    """
+    Reads a tile straight from the bundle index of a compact cache, without
+    building the MapProxy app.
+    """
+    service, grid, z, x, y, ext = tile
+    # only wmts requests use the internal tile coordinates (see tilecache.TILE_PATH_RE)
+    if service != 'wmts' or grid != 'EPSG3857' or ext != tile_extension(tileset):
+        return None
+    cache_dir = os.path.abspath(get_grid_cache_directory(tileset))
+    return read_bundle_tile(cache_dir, tileset.compact_version, x, y, z)
+
+
+def tile_mimetype(body):
+    # mixed caches contain png and jpeg tiles
+    if body[:2] == b'\xff\xd8':
+        return 'image/jpeg'
+    return 'image/png'
+
+
+def tile_response(body, status, headers, cache_status=None):
+    """
+    Create a Django response from a (cached) MapProxy WSGI response.
+    """
+    response = HttpResponse(body, status=status)
+    for header, value in headers:
+        response[header] = value
+    if cache_status is not None:
+        response['X-Djmp-Cache'] = cache_status
     return response